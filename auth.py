@@ -32,9 +32,90 @@ import hashlib
 import base64
 import random
 import json
+import os
+import functools
+import threading
 import log_system
 
-logger = log_system.init_logging()
+logger = log_system.init_logging(__name__)
+
+TIME_STEP = 30
+_step_struct = struct.Struct('>q')
+_code_struct = struct.Struct('>L')
+
+# secret -> (time step, (previous, current, next) codes), refreshed once per step
+_window_cache = {}
+_WINDOW_CACHE_LIMIT = 10000
+
+# secret -> the time step of the last token accepted for it
+_last_accepted = {}
+_last_accepted_lock = threading.Lock()
+_last_pruned_step = 0
+
+PASSWORD_ALGORITHM = 'pbkdf2_sha256'
+PASSWORD_ITERATIONS = 100000
+
+
+def _normalize_secret(s: str):
+    """
+    Strips the pretty formatting from a secret key, and pads or trims it
+    to the 16 characters the algorithm expects.
+    """
+    if ' ' in s:
+        s = s.replace(' ', '')
+    if '-' in s:
+        s = s.replace('-', '')
+    return s.upper().rjust(16, 'A')[0:16]
+
+
+@functools.lru_cache(maxsize=4096)
+def _decode_secret(raw_secret: str):
+    return base64.b32decode(raw_secret.encode())
+
+
+def _step_code(secret: bytes, step: int):
+    """
+    Computes the 6-digit token for one 30 second time step.
+    """
+    hash_digest = hmac.new(secret, _step_struct.pack(step), hashlib.sha1).digest()
+    offset = hash_digest[-1] & 0x0F
+    code = _code_struct.unpack(hash_digest[offset:offset + 4])[0]
+    code &= 0x7FFFFFFF
+    code %= 1000000
+    return '%06d' % code
+
+
+def _prune_last_accepted(step: int):
+    """
+    Forgets accepted tokens from before the step preceding this one.  Those
+    are outside every window from now on, so they can't block anything.
+    Only does the work once per time step.
+    """
+    global _last_pruned_step
+    if step <= _last_pruned_step:
+        return
+    with _last_accepted_lock:
+        _last_pruned_step = step
+        stale = [k for k, v in _last_accepted.items() if v < step - 1]
+        for k in stale:
+            del _last_accepted[k]
+
+
+def _window_codes(secret: bytes, step: int):
+    """
+    Returns the tokens for the step before, the given step, and the step
+    after.  They are only computed once per step for each secret, no matter
+    how many verification attempts come in.
+    """
+    cached = _window_cache.get(secret)
+    if cached is not None and cached[0] == step:
+        return cached[1]
+    codes = (_step_code(secret, step - 1), _step_code(secret, step), _step_code(secret, step + 1))
+    _prune_last_accepted(step)
+    if len(_window_cache) >= _WINDOW_CACHE_LIMIT:
+        _window_cache.clear()
+    _window_cache[secret] = (step, codes)
+    return codes
 
 
 class TwoFactorAuth:
@@ -75,12 +156,8 @@ class TwoFactorAuth:
         :return:
         :rtype:
         """
-        if ' ' in s:
-            s = s.replace(' ', '')
-        if '-' in s:
-            s = s.replace('-', '')
-        self._raw_secret = s.upper().rjust(16, 'A')[0:16]
-        self._secret = base64.b32decode(self._raw_secret.encode())
+        self._raw_secret = _normalize_secret(s)
+        self._secret = _decode_secret(self._raw_secret)
 
     def time_code(self, moment: int=None):
         """
@@ -94,17 +171,9 @@ class TwoFactorAuth:
         """
         if moment is None:
             moment = time.time()
-        moment = int(moment // 30)
-        time_bytes = struct.pack('>q', moment)
-        hash_digest = hmac.HMAC(self._secret, time_bytes, hashlib.sha1).digest()
-        offset = hash_digest[-1] & 0x0F
-        truncated_digest = hash_digest[offset:offset + 4]
-        code = struct.unpack('>L', truncated_digest)[0]
-        code &= 0x7FFFFFFF
-        code %= 1000000
-        return '%06d' % code
-
-    def verify(self, token):
+        return _step_code(self._secret, int(moment // TIME_STEP))
+
+    def verify(self, token, moment: float=None):
         """
         This method validates the token passed in against the currently generated
         token.  Because of clock skew between the user's device and the application
@@ -114,22 +183,43 @@ class TwoFactorAuth:
         This allows the user's clock to be up to 30 seconds offset from the server's clock
         with a reasonable expectation of success.
 
+        The three tokens are cached per secret and only recomputed when the time step
+        changes.  Every one of them is compared in constant time, so the response time
+        doesn't hint at how close a guess was.  Once a token has been accepted, it (and
+        any token from an earlier step) is refused, so an overheard token can't be
+        replayed.
+
         :param token: user-supplied token to be validated
         :type token: str or int
+        :param moment: A time value, defaulting to now.
+        :type moment: float
         :return: True or False
         :rtype: bool
         """
         if isinstance(token, int):
             token = '%06d' % token
-        if isinstance(token, str):
-            if ' ' in token:
-                token = token.replace(' ', '')
-            if '-' in token:
-                token = token.replace('-', '')
-        trials = [self.time_code(time.time() + offset) for offset in range(-30, 31, 30)]
-        if token in trials:
-            return True
-        return False
+        if not isinstance(token, str):
+            return False
+        if ' ' in token:
+            token = token.replace(' ', '')
+        if '-' in token:
+            token = token.replace('-', '')
+        if moment is None:
+            moment = time.time()
+        step = int(moment // TIME_STEP)
+        token_bytes = token.encode()
+        matched = None
+        for offset, code in zip((-1, 0, 1), _window_codes(self._secret, step)):
+            if hmac.compare_digest(token_bytes, code.encode()):
+                matched = step + offset
+        if matched is None:
+            return False
+        with _last_accepted_lock:
+            if _last_accepted.get(self._secret, matched - 1) >= matched:
+                logger.auth('Rejected replayed 2-factor token.')
+                return False
+            _last_accepted[self._secret] = matched
+        return True
 
     @property
     def secret(self):
@@ -156,12 +246,8 @@ class TwoFactorAuth:
         :return:
         :rtype:
         """
-        if ' ' in s:
-            s = s.replace(' ', '')
-        if '-' in s:
-            s = s.replace('-', '')
-        self._raw_secret = s.upper().rjust(16, 'A')[0:16]
-        self._secret = base64.b32decode(self._raw_secret.encode())
+        self._raw_secret = _normalize_secret(s)
+        self._secret = _decode_secret(self._raw_secret)
 
     def __repr__(self):
         """
@@ -192,6 +278,58 @@ def random_base32_token(length: int=16, rng=random.SystemRandom(),
     return '-'.join((token[0:4], token[4:8], token[8:12], token[12:16]))
 
 
+def verify_token(secret: str, token, moment: float=None):
+    """
+    A plain function version of TwoFactorAuth(secret).verify(token), which
+    is handy for passing to a worker pool.
+
+    :param secret: base32 secret key
+    :param token: user-supplied token
+    :param moment: A time value, defaulting to now.
+    :return: True or False
+    """
+    return TwoFactorAuth(secret).verify(token, moment)
+
+
+def hash_password(password: str, salt: bytes=None, iterations: int=PASSWORD_ITERATIONS):
+    """
+    Hashes a password with PBKDF2-SHA256, returning a string holding
+    everything needed to check it later.  This is deliberately slow, so
+    it should be run through auth_service rather than on the game thread.
+
+    :param password: The password
+    :param salt: Random salt, normally left to us
+    :param iterations: Work factor
+    :return: 'pbkdf2_sha256$iterations$salt$hash'
+    :rtype: str
+    """
+    if salt is None:
+        salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return '%s$%d$%s$%s' % (PASSWORD_ALGORITHM, iterations,
+                            base64.b64encode(salt).decode('ascii'), base64.b64encode(digest).decode('ascii'))
+
+
+def check_password(password: str, stored: str):
+    """
+    Checks a password against a string made by hash_password().
+
+    :param password: The password the user typed
+    :param stored: The saved hash
+    :return: True or False
+    :rtype: bool
+    """
+    try:
+        algorithm, iterations, salt, digest = stored.split('$')
+        if algorithm != PASSWORD_ALGORITHM:
+            return False
+        expected = base64.b64decode(digest)
+        actual = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), base64.b64decode(salt), int(iterations))
+    except (ValueError, TypeError):
+        return False
+    return hmac.compare_digest(expected, actual)
+
+
 def to_json(self: TwoFactorAuth):
     """
     A TwoFactorAuth object can be serialized to JSON by
@@ -247,8 +385,47 @@ def TestMe(code: str):
     else:
         print("Authentication failure.")
 
+def benchmark(secrets: int=500, rounds: int=20):
+    """
+    Measures verifications per second during a login storm, where many
+    players with different secrets try to verify at once.  Each player
+    alternates a right code with a wrong one.  Every right code is for a
+    later time step than the last, so it takes the accept path (with a
+    fresh window computed) without tripping replay protection, and every
+    wrong one hits the cached window and is rejected.
+
+    :param secrets: Number of different players
+    :param rounds: Attempts per player
+    :return: Verifications per second
+    """
+    now = time.time()
+    players = [TwoFactorAuth(random_base32_token()) for _ in range(secrets)]
+    attempts = []
+    for i in range(rounds):
+        moment = now + (i // 2) * TIME_STEP
+        step = int(moment // TIME_STEP)
+        for auth_obj in players:
+            token = auth_obj.time_code(moment)
+            if i % 2:
+                window = _window_codes(auth_obj._secret, step)
+                token = next(code for code in ('%06d' % n for n in range(1000000)) if code not in window)
+            attempts.append((auth_obj.secret, token, moment))
+    _window_cache.clear()
+    start = time.perf_counter()
+    accepted = 0
+    for key, token, moment in attempts:
+        if TwoFactorAuth(key).verify(token, moment):
+            accepted += 1
+    elapsed = time.perf_counter() - start
+    rate = len(attempts) / elapsed
+    print("%d verifications (%d accepted) in %.3f seconds, %.0f per second" %
+          (len(attempts), accepted, elapsed, rate))
+    return rate
+
+
 def Usage():
     print("auth --code <16 digit authenticator code>")
+    print("auth --bench")
     sys.exit()
 
 if __name__ == '__main__':
@@ -258,11 +435,14 @@ if __name__ == '__main__':
     code = 'appy l3en 3d7c jrru'
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hc:", ["help", "code="])
+        opts, args = getopt.getopt(sys.argv[1:], "hbc:", ["help", "bench", "code="])
         for opt, arg in opts:
             if opt in ["-h", "--help"]:
                 Usage()
                 sys.exit()
+            elif opt in ["-b", "--bench"]:
+                benchmark()
+                sys.exit()
             elif opt in ["-c", "--code"]:
                 code = arg
     except getopt.GetoptError:
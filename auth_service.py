@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*- line endings: unix -*-
+__author__ = 'quixadhal'
+
+"""
+This module runs the expensive parts of logging in (password hashing and
+2-factor token checks) in a pool of worker threads, so a crowd of players
+logging in at once doesn't stall everyone else's tick.
+
+Work is handed to the pool with a callback.  The callback is NOT run by
+the worker, it is queued, and the main loop calls poll() once per tick to
+run the callbacks on the game thread.  That way, game code never has to
+worry about being called from another thread.
+
+PBKDF2 releases the GIL while it works, so threads are enough to keep the
+game loop moving.  If hashing ever moves to something that doesn't, pass
+processes=True and password work will go to a process pool instead.
+"""
+
+import queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import log_system
+import auth
+
+logger = log_system.init_logging(__name__)
+
+
+class AuthService(object):
+    """
+    Runs authentication checks off the game thread, and delivers the
+    results back to it through poll().
+    """
+
+    def __init__(self, workers: int=2, processes: bool=False):
+        """
+        :param workers: Number of worker threads (or processes)
+        :param processes: Use a process pool for password hashing
+        """
+        self._threads = ThreadPoolExecutor(max_workers=workers)
+        self._processes = ProcessPoolExecutor(max_workers=workers) if processes else None
+        self._results = queue.Queue()
+        self.pending = 0
+
+    def _submit(self, executor, callback, func, *args):
+        self.pending += 1
+        future = executor.submit(func, *args)
+        future.add_done_callback(lambda done: self._results.put((callback, done)))
+        return future
+
+    def hash_password(self, password: str, callback):
+        """
+        Hashes a new password.  callback(hash_string) is run from poll().
+        """
+        return self._submit(self._processes or self._threads, callback, auth.hash_password, password)
+
+    def check_password(self, password: str, stored: str, callback):
+        """
+        Checks a password.  callback(True or False) is run from poll().
+        """
+        return self._submit(self._processes or self._threads, callback, auth.check_password, password, stored)
+
+    def verify_token(self, secret: str, token, callback):
+        """
+        Checks a 2-factor token.  callback(True or False) is run from poll().
+
+        These always use the thread pool, since replay protection has to
+        be shared by every check.
+        """
+        return self._submit(self._threads, callback, auth.verify_token, secret, token)
+
+    def poll(self, limit: int=None):
+        """
+        Runs the callbacks for any finished work.  This should be called
+        once per tick by the main loop.  A check that blew up is logged
+        and reported to its callback as a failure.
+
+        :param limit: Most callbacks to run this time, or None for all
+        :return: Number of callbacks run
+        """
+        count = 0
+        while limit is None or count < limit:
+            try:
+                callback, future = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending -= 1
+            count += 1
+            try:
+                result = future.result()
+            except Exception as err:
+                logger.error('Authentication worker failed: %s', err)
+                result = False
+            try:
+                callback(result)
+            except Exception:
+                logger.exception('Authentication callback failed')
+        return count
+
+    def shutdown(self):
+        self._threads.shutdown(wait=False)
+        if self._processes is not None:
+            self._processes.shutdown(wait=False)
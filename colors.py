@@ -63,7 +63,7 @@ obtained.  ANSI is a pretty good default these days.
 from collections import namedtuple
 import log_system
 
-logger = log_system.init_logging()
+logger = log_system.init_logging(__name__)
 
 TERMINAL_TYPES = ('unknown', 'pyku', 'rom', 'smaug', 'imc2', 'ansi', 'greyscale', 'i3', 'mxp')
 
@@ -3,9 +3,11 @@ __author__ = 'quixadhal'
 
 import os
 import sys
+import sqlite3
+import time
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import scoped_session
 from alembic.migration import MigrationContext
@@ -13,8 +15,9 @@ from alembic.config import Config
 from alembic.script import ScriptDirectory
 from alembic import command
 import log_system
+import metrics
 
-logger = log_system.init_logging()
+logger = log_system.init_logging(__name__)
 sys.path.append(os.getcwd())
 DB_FILE = 'pyku.db'
 ALEMBIC_CONFIG = 'alembic.ini'
@@ -25,6 +28,49 @@ SessionFactory = sessionmaker(bind=SQLEngine)
 Session = scoped_session(SessionFactory)
 
 
+@event.listens_for(SessionFactory, 'before_commit')
+def _commit_started(session):
+    session.info['commit_started'] = time.time()
+
+
+@event.listens_for(SessionFactory, 'after_commit')
+def _commit_finished(session):
+    started = session.info.pop('commit_started', None)
+    if started is not None:
+        metrics.db_commit_seconds.observe(time.time() - started)
+
+
+@event.listens_for(SQLEngine, 'connect')
+def _enable_wal(dbapi_connection, connection_record):
+    """
+    The game loop is the only writer, but the web server threads want to
+    read at the same time.  In WAL mode, readers see the last committed
+    state and never block the writer (or get blocked by it).
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def _read_only_connect():
+    """
+    Opens the database file in read-only mode, so nothing done through
+    these connections can ever take a write lock the game loop needs.
+    """
+    connection = sqlite3.connect('file:%s?mode=ro' % DB_FILE, uri=True, check_same_thread=False)
+    connection.execute('PRAGMA query_only=1')
+    return connection
+
+
+# Read-only connections for the web server and other non-game threads.
+# ReadSession is scoped per thread, so each CherryPy worker gets its own
+# connection, and should call ReadSession.remove() when the request ends.
+ReadOnlyEngine = create_engine('sqlite://', creator=_read_only_connect)
+ReadOnlySessionFactory = sessionmaker(bind=ReadOnlyEngine, autoflush=False)
+ReadSession = scoped_session(ReadOnlySessionFactory)
+
+
 def init_db():
     connection = SQLEngine.connect()
     context = MigrationContext.configure(connection)
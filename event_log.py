@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*- line endings: unix -*-
+__author__ = 'quixadhal'
+
+"""
+This module keeps a structured, append-only record of game events.
+
+Anything logged at one of the game event levels (AUTH, PLAYER_KILL, BOOT,
+RESET, KILL) is also written as a line of JSON to the current event log
+segment.  Details beyond the message text can be attached with the
+logging "extra" argument, and the actor is what gets indexed:
+
+    logger.kill('%s killed %s', killer.name, victim.name,
+                extra={'data': {'actor': killer.name, 'victim': victim.name}})
+
+Segments are rotated when they get too big or too old.  Rotated segments
+are gzipped, and a small index file is written next to each one, listing
+its time range, how many of each event it holds, and which actors appear
+in it.  EventLogReader uses those indexes to skip any segment that can't
+contain what it's looking for, so finding all kills by one player last week
+only opens the handful of segments that player actually shows up in.
+"""
+
+import os
+import gzip
+import json
+import time
+import shutil
+import logging
+import log_system
+
+logger = log_system.init_logging(__name__)
+
+EVENT_DIR = os.path.join('log', 'events')
+EVENT_LEVELS = {
+    39: 'auth',
+    38: 'player_kill',
+    31: 'boot',
+    29: 'reset',
+    21: 'kill',
+}
+SEGMENT_MAX_BYTES = 16 * 1024 * 1024
+SEGMENT_MAX_AGE = 24 * 60 * 60
+SEGMENT_SUFFIX = '.jsonl'
+INDEX_SUFFIX = '.idx'
+
+
+class SegmentIndex(object):
+    """
+    Summary of one segment, built as events are appended so rotation
+    never has to read the segment back.
+    """
+
+    def __init__(self):
+        self.first = None
+        self.last = None
+        self.count = 0
+        self.events = {}
+        self.actors = {}
+
+    def add(self, event: dict):
+        moment = event['time']
+        if self.first is None or moment < self.first:
+            self.first = moment
+        if self.last is None or moment > self.last:
+            self.last = moment
+        self.count += 1
+        kind = event['event']
+        self.events[kind] = self.events.get(kind, 0) + 1
+        actor = event.get('actor')
+        if actor is not None:
+            kinds = self.actors.setdefault(str(actor), [])
+            if kind not in kinds:
+                kinds.append(kind)
+
+    def matches(self, event: str=None, actor: str=None, since: float=None, until: float=None):
+        """
+        Returns False if the segment can't hold anything matching the query.
+        """
+        if self.count == 0:
+            return False
+        if since is not None and self.last < since:
+            return False
+        if until is not None and self.first > until:
+            return False
+        if event is not None and event not in self.events:
+            return False
+        if actor is not None:
+            kinds = self.actors.get(str(actor))
+            if kinds is None:
+                return False
+            if event is not None and event not in kinds:
+                return False
+        return True
+
+    def to_dict(self):
+        return {'first': self.first, 'last': self.last, 'count': self.count,
+                'events': self.events, 'actors': self.actors}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        index = cls()
+        index.first = data.get('first')
+        index.last = data.get('last')
+        index.count = data.get('count', 0)
+        index.events = data.get('events', {})
+        index.actors = data.get('actors', {})
+        return index
+
+
+def _read_segment(filename: str):
+    """
+    Yields each event in a segment, compressed or not.
+    """
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt', encoding='utf-8') as fp:
+        for line in fp:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+class EventLog(object):
+    """
+    Writes events to the current segment, rotating as needed.
+    """
+
+    def __init__(self, directory: str=EVENT_DIR, max_bytes: int=SEGMENT_MAX_BYTES, max_age: float=SEGMENT_MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._fp = None
+        self._filename = None
+        self._opened = 0.0
+        self._size = 0
+        self._index = None
+        os.makedirs(directory, exist_ok=True)
+        # Anything left uncompressed is from a previous run, and gets rotated now.
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SEGMENT_SUFFIX):
+                self._rotate_file(os.path.join(directory, name), None)
+
+    def append(self, event: dict):
+        """
+        Writes one event, which must have 'time' and 'event' keys.
+        """
+        now = event['time']
+        if self._fp is not None and (self._size >= self.max_bytes or now - self._opened >= self.max_age):
+            self.rotate()
+        if self._fp is None:
+            self._open(now)
+        line = json.dumps(event, sort_keys=True, default=str) + '\n'
+        self._fp.write(line)
+        self._fp.flush()
+        self._size += len(line)
+        self._index.add(event)
+
+    def rotate(self):
+        """
+        Closes the current segment, compresses it, and writes its index.
+        """
+        if self._fp is None:
+            return
+        self._fp.close()
+        self._fp = None
+        self._rotate_file(self._filename, self._index)
+        self._filename = None
+        self._index = None
+
+    def close(self):
+        self.rotate()
+
+    def _open(self, now: float):
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now))
+        serial = 0
+        while True:
+            filename = os.path.join(self.directory, 'events-%s-%03d%s' % (stamp, serial, SEGMENT_SUFFIX))
+            if not os.path.exists(filename) and not os.path.exists(filename + '.gz'):
+                break
+            serial += 1
+        self._fp = open(filename, 'a', encoding='utf-8')
+        self._filename = filename
+        self._opened = now
+        self._size = 0
+        self._index = SegmentIndex()
+
+    def _rotate_file(self, filename: str, index: SegmentIndex or None):
+        if index is None:
+            index = SegmentIndex()
+            for event in _read_segment(filename):
+                if 'time' in event and 'event' in event:
+                    index.add(event)
+        if index.count == 0:
+            os.remove(filename)
+            return
+        with open(filename, 'rb') as source, gzip.open(filename + '.gz', 'wb') as target:
+            shutil.copyfileobj(source, target)
+        with open(filename + '.gz' + INDEX_SUFFIX, 'w', encoding='utf-8') as fp:
+            json.dump(index.to_dict(), fp, sort_keys=True)
+        os.remove(filename)
+
+
+class EventLogHandler(logging.Handler):
+    """
+    A logging handler which passes game events on to an EventLog.  It is
+    meant to be added to the background log writer with log_system.add_handler(),
+    so all the file work happens off the game thread.
+    """
+
+    def __init__(self, event_log: EventLog):
+        super().__init__(min(EVENT_LEVELS))
+        self.event_log = event_log
+
+    def emit(self, record):
+        kind = EVENT_LEVELS.get(record.levelno)
+        if kind is None:
+            return
+        try:
+            event = {
+                'time': record.created,
+                'event': kind,
+                'module': record.module,
+                'message': record.getMessage(),
+            }
+            data = getattr(record, 'data', None)
+            if isinstance(data, dict):
+                for k, v in data.items():
+                    event.setdefault(k, v)
+            self.event_log.append(event)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.event_log.close()
+        super().close()
+
+
+class EventLogReader(object):
+    """
+    Answers queries against the rotated (and current) event log segments.
+    """
+
+    def __init__(self, directory: str=EVENT_DIR):
+        self.directory = directory
+
+    def segments(self):
+        """
+        Returns (filename, SegmentIndex) for every segment, oldest first.
+        The current segment has no index yet, so it is always searched.
+        """
+        results = []
+        if not os.path.isdir(self.directory):
+            return results
+        for name in sorted(os.listdir(self.directory)):
+            filename = os.path.join(self.directory, name)
+            if name.endswith('.gz'):
+                try:
+                    with open(filename + INDEX_SUFFIX, encoding='utf-8') as fp:
+                        results.append((filename, SegmentIndex.from_dict(json.load(fp))))
+                except (OSError, ValueError):
+                    results.append((filename, None))
+            elif name.endswith(SEGMENT_SUFFIX):
+                results.append((filename, None))
+        return results
+
+    def query(self, event: str=None, actor: str=None, since: float=None, until: float=None):
+        """
+        Yields every event matching all the given conditions.
+
+        :param event: Event type, such as 'kill'
+        :param actor: Actor name
+        :param since: Earliest time, as from time.time()
+        :param until: Latest time, as from time.time()
+        :return: generator of event dicts
+        """
+        for filename, index in self.segments():
+            if index is not None and not index.matches(event, actor, since, until):
+                continue
+            for record in _read_segment(filename):
+                if event is not None and record.get('event') != event:
+                    continue
+                if actor is not None and str(record.get('actor')) != str(actor):
+                    continue
+                if since is not None and record.get('time', 0) < since:
+                    continue
+                if until is not None and record.get('time', 0) > until:
+                    continue
+                yield record
+
+
+def start_event_log(directory: str=EVENT_DIR):
+    """
+    Creates the event log and hooks it up to the logging pipeline.
+
+    :return: The EventLogHandler
+    """
+    handler = EventLogHandler(EventLog(directory))
+    log_system.add_handler(handler)
+    return handler
@@ -0,0 +1,695 @@
+# -*- coding: utf-8 -*- line endings: unix -*-
+__author__ = 'quixadhal'
+
+"""
+This module splits the network side of the game out into its own process.
+
+The gateway (run as "python gateway.py") owns the listening port and every
+player's socket.  It does all the telnet work: option negotiation, IAC
+parsing, line assembly, color token conversion and output encoding, using
+miniboa as usual.  The game connects to it over a Unix domain socket, and
+only ever sees whole lines of input, and sends plain (color tokenized) text.
+
+Because the gateway holds the sockets, the game can be stopped, crash, or
+be restarted with new code, and the players stay connected.  While no game
+is attached, they are told to wait, and anything they type is held for it.
+When a game attaches, the gateway replays a CONNECT for every player, then
+a SYNC, so the game can rebuild its view of who is online.
+
+On the game side, GatewayServer and GatewayClient look like miniboa's
+TelnetServer and TelnetClient, so the driver uses them the same way.
+
+Every message on the Unix socket is a frame of:
+
+    kind        1 byte, one of the MSG_ constants
+    client_id   4 bytes, unsigned, network order (the gateway's connection id)
+    length      4 bytes, unsigned, network order
+    payload     length bytes
+
+Connection ids are handed out by the gateway in increasing order, rather
+than being socket file descriptors, which the kernel reuses as soon as they
+are closed.  A frame still in flight for a player who has gone is dropped,
+instead of reaching whoever was given the same descriptor next.
+"""
+
+import os
+import sys
+import json
+import time
+import select
+import socket
+import struct
+import log_system
+import miniboa
+
+logger = log_system.init_logging(__name__)
+
+GATEWAY_SOCKET = 'gateway.sock'
+RECONNECT_DELAY = 2.0
+RECV_SIZE = 65536
+
+FRAME_HEADER = struct.Struct('!BII')
+
+# Gateway to game
+MSG_CONNECT = 1  # payload is JSON with the client's address and terminal
+MSG_DISCONNECT = 2
+MSG_INPUT = 3  # payload is one line of input
+MSG_TERMINAL = 4  # payload is JSON with a new terminal type or size
+MSG_SYNC = 5  # every existing client has been replayed
+# Game to gateway
+MSG_OUTPUT = 6  # payload is the output type (may be empty), a NUL, then the text
+MSG_CLOSE = 7
+MSG_TELNET = 8  # payload is the name of a TELNET_REQUESTS method
+# Either way
+MSG_GMCP = 9  # payload is a GMCP package name, then a space and its JSON data
+
+# Telnet client methods the game may ask the gateway to call for it.
+TELNET_REQUESTS = frozenset((
+    'request_do_sga', 'request_will_echo', 'request_wont_echo', 'password_mode_on',
+    'password_mode_off', 'request_naws', 'request_terminal_type', 'mark_logged_in',
+))
+
+WAIT_MESSAGE = '\nThe game is restarting, please wait a moment...\n'
+
+
+def encode_frame(kind: int, client_id: int, payload: bytes=b''):
+    return FRAME_HEADER.pack(kind, client_id, len(payload)) + payload
+
+
+def decode_frames(buffer: bytearray):
+    """
+    Removes every complete frame from the front of buffer.
+
+    :param buffer: Bytes received so far, which is consumed in place
+    :return: list of (kind, client_id, payload)
+    """
+    frames = []
+    offset = 0
+    size = len(buffer)
+    while size - offset >= FRAME_HEADER.size:
+        kind, client_id, length = FRAME_HEADER.unpack_from(buffer, offset)
+        end = offset + FRAME_HEADER.size + length
+        if end > size:
+            break
+        frames.append((kind, client_id, bytes(buffer[offset + FRAME_HEADER.size:end])))
+        offset = end
+    if offset:
+        del buffer[:offset]
+    return frames
+
+
+def _terminal_info(client):
+    return {'terminal_type': client.terminal_type, 'columns': client.columns, 'rows': client.rows,
+            'gmcp': client.gmcp, 'gmcp_supports': dict(client.gmcp_supports or {})}
+
+
+class _FramedSocket(object):
+    """
+    A non-blocking Unix socket carrying frames in both directions.
+    """
+
+    def __init__(self, sock):
+        sock.setblocking(False)
+        self.sock = sock
+        self.fileno = sock.fileno()
+        self.recv_buffer = bytearray()
+        self.send_buffer = bytearray()
+        self.closed = False
+
+    def queue(self, kind: int, client_id: int, payload: bytes=b''):
+        self.send_buffer += encode_frame(kind, client_id, payload)
+
+    def flush(self):
+        while self.send_buffer and not self.closed:
+            try:
+                sent = self.sock.send(self.send_buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                logger.error('Gateway link send error: %s', err)
+                self.close()
+                return
+            del self.send_buffer[:sent]
+
+    def receive(self):
+        """
+        Reads whatever is waiting, and returns the complete frames.
+        """
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError as err:
+            logger.error('Gateway link receive error: %s', err)
+            data = b''
+        if not data:
+            self.close()
+            return []
+        self.recv_buffer += data
+        return decode_frames(self.recv_buffer)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.sock.close()
+
+
+# --[ Gateway process ]---------------------------------------------------------
+class Gateway(object):
+    """
+    Runs in the gateway process, holding the players' connections and
+    passing lines back and forth to whichever game is attached.
+    """
+
+    def __init__(self, port: int=4400, path: str=GATEWAY_SOCKET, address: str=''):
+        self.path = path
+        self.server = miniboa.TelnetServer(port=port, address=address, timeout=0.0,
+                                           on_connect=self._on_connect, on_disconnect=self._on_disconnect)
+        if os.path.exists(path):
+            os.remove(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(1)
+        self.game = None
+        self.connections = {}  # connection id -> TelnetClient
+        self._ids = {}  # file descriptor -> connection id
+        self._last_id = 0
+        self._terminals = {}  # connection id -> last terminal info sent
+
+    def _new_id(self):
+        """
+        Returns the next unused connection id, wrapping at 32 bits and
+        never handing out 0.
+        """
+        while True:
+            self._last_id = self._last_id % 0xFFFFFFFF + 1
+            if self._last_id not in self.connections:
+                return self._last_id
+
+    def _on_connect(self, client):
+        logger.info('++ Opened connection to %s', client.addrport())
+        client_id = self._new_id()
+        self.connections[client_id] = client
+        self._ids[client.fileno] = client_id
+        self._terminals[client_id] = _terminal_info(client)
+        if self.game is None:
+            client.send(WAIT_MESSAGE)
+        else:
+            self._announce(client_id, client)
+
+    def _on_disconnect(self, client):
+        logger.info('-- Lost connection to %s', client.addrport())
+        client_id = self._ids.pop(client.fileno, None)
+        if client_id is None:
+            return
+        del self.connections[client_id]
+        self._terminals.pop(client_id, None)
+        if self.game is not None:
+            self.game.queue(MSG_DISCONNECT, client_id)
+
+    def _announce(self, client_id: int, client):
+        info = _terminal_info(client)
+        info.update({'address': client.address, 'port': client.port, 'connect_time': client.connect_time,
+                     'logged_in': client.logged_in})
+        self.game.queue(MSG_CONNECT, client_id, json.dumps(info).encode('utf-8'))
+
+    def _attach(self):
+        sock, addr = self.listener.accept()
+        if self.game is not None:
+            logger.warning('A new game attached, dropping the old link.')
+            self.game.close()
+        self.game = _FramedSocket(sock)
+        logger.boot('Game attached, replaying %d connections.', self.server.client_count())
+        for client_id, client in self.connections.items():
+            if client.active:
+                self._announce(client_id, client)
+        self.game.queue(MSG_SYNC, 0)
+
+    def _detach(self):
+        logger.boot('Game detached, holding %d connections.', self.server.client_count())
+        self.game = None
+        for client in self.server.client_list():
+            client.send(WAIT_MESSAGE)
+
+    def _handle_frame(self, kind: int, client_id: int, payload: bytes):
+        client = self.connections.get(client_id)
+        if client is None or not client.active:
+            # Meant for a player who has already gone.
+            return
+        if kind == MSG_OUTPUT:
+            ttype, text = payload.decode('utf-8').split('\0', 1)
+            client.send(text, ttype or None)
+        elif kind == MSG_CLOSE:
+            client.deactivate()
+        elif kind == MSG_GMCP:
+            package, _, text = payload.decode('utf-8').partition(' ')
+            client.gmcp_write(package, text or None)
+        elif kind == MSG_TELNET:
+            request = payload.decode('ascii')
+            if request in TELNET_REQUESTS:
+                getattr(client, request)()
+            else:
+                logger.warning('Game asked for unknown telnet request %r', request)
+        else:
+            logger.warning('Unknown frame kind %d from the game', kind)
+
+    def _forward_input(self):
+        for client_id, client in self.connections.items():
+            if not client.active:
+                continue
+            terminal = _terminal_info(client)
+            if terminal != self._terminals.get(client_id):
+                self._terminals[client_id] = terminal
+                self.game.queue(MSG_TERMINAL, client_id, json.dumps(terminal).encode('utf-8'))
+            while client.cmd_ready:
+                self.game.queue(MSG_INPUT, client_id, client.get_command().encode('utf-8'))
+            if client.gmcp_inbox:
+                for package, data in client.gmcp_inbox:
+                    message = package if data is None else package + ' ' + json.dumps(data)
+                    self.game.queue(MSG_GMCP, client_id, message.encode('utf-8'))
+                client.gmcp_inbox = None
+
+    def run(self, timeout: float=0.1):
+        logger.boot('Gateway listening on port %d, game socket %s', self.server.port, self.path)
+        while True:
+            watch = [self.listener, self.server.server_fileno]
+            watch.extend(c.fileno for c in self.server.client_list() if c.active)
+            writers = [c.fileno for c in self.server.client_list() if c.send_wire]
+            if self.game is not None:
+                watch.append(self.game.fileno)
+                if self.game.send_buffer:
+                    writers.append(self.game.fileno)
+            try:
+                readable, writable, _ = select.select(watch, writers, [], timeout)
+            except InterruptedError:
+                continue
+            if self.listener in readable:
+                self._attach()
+            if self.game is not None and self.game.fileno in readable:
+                for frame in self.game.receive():
+                    self._handle_frame(*frame)
+                if self.game.closed:
+                    self._detach()
+            self.server.poll()
+            if self.game is not None:
+                # Input waits in each client's command_list while no game is attached.
+                self._forward_input()
+                self.game.flush()
+                if self.game.closed:
+                    self._detach()
+            self.server.flush()
+
+    def stop(self):
+        self.server.stop()
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# --[ Game side ]---------------------------------------------------------------
+class GatewayClient(object):
+    """
+    The game's view of a player connected through the gateway.  It has the
+    same interface as miniboa.TelnetClient, but only queues frames.
+    """
+
+    def __init__(self, server, client_id: int, info: dict):
+        self.protocol = 'gateway'
+        self.client_id = miniboa.next_client_id()
+        self.server = server
+        self.active = True
+        self.fileno = client_id
+        self.address = info.get('address')
+        self.port = info.get('port')
+        self.terminal_type = info.get('terminal_type', 'ANSI')
+        self.columns = info.get('columns', 80)
+        self.rows = info.get('rows', 24)
+        self.cmd_ready = False
+        self.command_list = []
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.connect_time = info.get('connect_time', time.time())
+        self.last_input_time = time.time()
+        self.logged_in = info.get('logged_in', False)
+        self.gmcp = info.get('gmcp', False)
+        self.gmcp_supports = info.get('gmcp_supports', {})
+        self.gmcp_state = miniboa.GmcpState()
+        self.gmcp_inbox = []
+
+    def get_command(self):
+        cmd = None
+        if self.command_list:
+            cmd = self.command_list.pop(0)
+        self.cmd_ready = len(self.command_list) > 0
+        return cmd
+
+    def send(self, text: str, ttype: str or None=None):
+        if text and isinstance(text, str) and self.active:
+            payload = (ttype or '').encode('utf-8') + b'\0' + text.encode('utf-8')
+            self.bytes_sent += len(payload)
+            self.server.link.queue(MSG_OUTPUT, self.fileno, payload)
+
+    def deactivate(self):
+        self.active = False
+
+    def addrport(self):
+        return "{}:{}".format(self.address, self.port)
+
+    def idle(self):
+        return time.time() - self.last_input_time
+
+    def duration(self):
+        return time.time() - self.connect_time
+
+    def gmcp_update(self, package: str, data: dict):
+        self.gmcp_state.update(package, data)
+
+    def gmcp_flush(self):
+        if self.gmcp and self.gmcp_state.pending:
+            for package, fields in self.gmcp_state.changes():
+                self.gmcp_send(package, fields)
+
+    def gmcp_send(self, package: str, data=None):
+        if data is None:
+            self.gmcp_write(package, None)
+        else:
+            self.gmcp_write(package, json.dumps(data, separators=(',', ':')))
+
+    def gmcp_write(self, package: str, text: str or None):
+        if self.gmcp and self.active:
+            message = package if text is None else package + ' ' + text
+            self.server.link.queue(MSG_GMCP, self.fileno, message.encode('utf-8'))
+
+    def _telnet(self, request: str):
+        if self.active:
+            self.server.link.queue(MSG_TELNET, self.fileno, request.encode('ascii'))
+
+    def request_do_sga(self):
+        self._telnet('request_do_sga')
+
+    def request_will_echo(self):
+        self._telnet('request_will_echo')
+
+    def request_wont_echo(self):
+        self._telnet('request_wont_echo')
+
+    def password_mode_on(self):
+        self._telnet('password_mode_on')
+
+    def password_mode_off(self):
+        self._telnet('password_mode_off')
+
+    def request_naws(self):
+        self._telnet('request_naws')
+
+    def request_terminal_type(self):
+        self._telnet('request_terminal_type')
+
+    def mark_logged_in(self):
+        self.logged_in = True
+        self._telnet('mark_logged_in')
+
+
+class GatewayServer(object):
+    """
+    The game's end of the gateway link, used in place of miniboa.TelnetServer.
+    """
+
+    def __init__(self, path: str=GATEWAY_SOCKET, on_connect=miniboa._on_connect,
+                 on_disconnect=miniboa._on_disconnect, timeout: float=miniboa.DEFAULT_TIMEOUT,
+                 announce: bool=True):
+        """
+        Connects to the gateway, and waits for it to replay the players
+        already connected.
+
+        :param path: The gateway's Unix socket
+        :param on_connect: Called for each new player
+        :param on_disconnect: Called when a player goes away
+        :param timeout: How long poll() waits for traffic
+        :param announce: Call on_connect for players replayed at startup
+        """
+        self.path = path
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.timeout = timeout
+        self.clients = {}
+        self.link = None
+        self._replay = None  # A link still receiving its replay, when reconnecting
+        self._replay_announce = True
+        self._replay_deadline = 0.0
+        self._next_attempt = 0.0
+
+        self.connections_accepted = 0
+        self.connections_refused = 0
+        self.commands_received = 0
+        self.closed_bytes_sent = 0
+        self.closed_bytes_received = 0
+
+        self._connect(announce, wait=True)
+
+    def _connect(self, announce: bool, wait: bool=False):
+        """
+        Opens the link to the gateway, which starts by replaying everyone
+        already connected.
+
+        :param announce: Call on_connect for the replayed players
+        :param wait: Read the whole replay before returning, as at boot, when
+            the clients have to exist before we go on.  Otherwise poll()
+            finishes it, so a reconnect never stalls the game loop.
+        :return: True if the link was opened
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if not wait:
+                sock.setblocking(False)
+            sock.connect(self.path)
+        except OSError as err:
+            sock.close()
+            self._next_attempt = time.time() + RECONNECT_DELAY
+            logger.error('Unable to reach the gateway at %s: %s', self.path, err)
+            return False
+        link = _FramedSocket(sock)
+        if not wait:
+            self._replay = link
+            self._replay_announce = announce
+            self._replay_deadline = time.time() + RECONNECT_DELAY * 5
+            return True
+        sock.settimeout(RECONNECT_DELAY * 5)
+        synced = False
+        try:
+            while not synced:
+                data = sock.recv(RECV_SIZE)
+                if not data:
+                    raise ConnectionError('gateway closed the link during replay')
+                link.recv_buffer += data
+                synced = self._replay_frames(decode_frames(link.recv_buffer), announce)
+        except OSError as err:
+            link.close()
+            self._next_attempt = time.time() + RECONNECT_DELAY
+            logger.error('Gateway replay failed: %s', err)
+            return False
+        sock.setblocking(False)
+        self._attached(link)
+        return True
+
+    def _replay_frames(self, frames: list, announce: bool):
+        """
+        Handles frames received during a replay.
+
+        :return: True once the SYNC that ends the replay has been seen
+        """
+        synced = False
+        for kind, client_id, payload in frames:
+            if kind == MSG_SYNC:
+                synced = True
+            else:
+                self._handle_frame(kind, client_id, payload, announce or synced)
+        return synced
+
+    def _continue_replay(self):
+        """
+        Reads whatever has arrived of a reconnect's replay, without waiting.
+        """
+        link = self._replay
+        if self._replay_frames(link.receive(), self._replay_announce):
+            self._replay = None
+            self._attached(link)
+        elif link.closed or time.time() > self._replay_deadline:
+            logger.error('Gateway replay failed: %s', 'link closed' if link.closed else 'timed out')
+            link.close()
+            self._replay = None
+            for client in list(self.clients.values()):
+                client.active = False
+            self._reap()
+            self._next_attempt = time.time() + RECONNECT_DELAY
+
+    def _attached(self, link):
+        self.link = link
+        logger.boot('Attached to gateway at %s with %d connections.', self.path, len(self.clients))
+
+    def _lost_link(self):
+        logger.critical('Lost the gateway link, dropping %d connections.', len(self.clients))
+        self.link = None
+        for client in list(self.clients.values()):
+            client.active = False
+        self._reap()
+        self._next_attempt = time.time() + RECONNECT_DELAY
+
+    def hotboot_state(self):
+        """
+        The gateway keeps the players, so only our counters need saving.
+        """
+        return {
+            'path': self.path,
+            'connections_accepted': self.connections_accepted,
+            'connections_refused': self.connections_refused,
+            'commands_received': self.commands_received,
+            'closed_bytes_sent': self.closed_bytes_sent,
+            'closed_bytes_received': self.closed_bytes_received,
+        }
+
+    @classmethod
+    def from_hotboot(cls, state: dict, **kwargs):
+        """
+        Reattaches after a hotboot.  Players are replayed by the gateway, but
+        not announced, since the hotboot code reattaches their logins itself.
+        """
+        kwargs.setdefault('path', state['path'])
+        server = cls(announce=False, **kwargs)
+        for k in ('connections_accepted', 'connections_refused', 'commands_received',
+                  'closed_bytes_sent', 'closed_bytes_received'):
+            setattr(server, k, state.get(k, 0))
+        return server
+
+    def stop(self):
+        if self._replay is not None:
+            self._replay.close()
+            self._replay = None
+        if self.link is not None:
+            self.link.flush()
+            self.link.close()
+            self.link = None
+
+    def client_count(self):
+        return len(self.clients)
+
+    def flush_gmcp(self):
+        if self.link is None:
+            return
+        for client in self.clients.values():
+            if client.active:
+                client.gmcp_flush()
+
+    def client_list(self):
+        return self.clients.values()
+
+    def flush(self):
+        """
+        Sends everything queued for every client to the gateway, which is
+        a single send() as they all share the one link.
+        """
+        if self.link is not None and self.link.send_buffer:
+            self.link.flush()
+            if self.link.closed:
+                self._lost_link()
+
+    def _handle_frame(self, kind: int, client_id: int, payload: bytes, announce: bool=True):
+        if kind == MSG_CONNECT:
+            old = self.clients.get(client_id)
+            if old is not None:
+                logger.warning('Gateway reused connection id %d, dropping %s.', client_id, old.addrport())
+                old.active = False
+                self.on_disconnect(old)
+                self.closed_bytes_sent += old.bytes_sent
+                self.closed_bytes_received += old.bytes_received
+            client = GatewayClient(self, client_id, json.loads(payload.decode('utf-8')))
+            self.clients[client_id] = client
+            self.connections_accepted += 1
+            if announce:
+                self.on_connect(client)
+            return
+        client = self.clients.get(client_id)
+        if client is None:
+            return
+        if kind == MSG_INPUT:
+            client.command_list.append(payload.decode('utf-8'))
+            client.cmd_ready = True
+            client.bytes_received += len(payload)
+            client.last_input_time = time.time()
+            self.commands_received += 1
+        elif kind == MSG_TERMINAL:
+            for k, v in json.loads(payload.decode('utf-8')).items():
+                setattr(client, k, v)
+        elif kind == MSG_GMCP:
+            package, _, text = payload.decode('utf-8').partition(' ')
+            client.gmcp_inbox.append((package, json.loads(text) if text else None))
+        elif kind == MSG_DISCONNECT:
+            client.active = False
+        else:
+            logger.warning('Unknown frame kind %d from the gateway', kind)
+
+    def _reap(self):
+        for client in [c for c in self.clients.values() if not c.active]:
+            self.on_disconnect(client)
+            if self.link is not None:
+                self.link.queue(MSG_CLOSE, client.fileno)
+            self.closed_bytes_sent += client.bytes_sent
+            self.closed_bytes_received += client.bytes_received
+            del self.clients[client.fileno]
+
+    def poll(self):
+        """
+        Sends queued output to the gateway, and processes whatever it has
+        sent us, waiting up to timeout seconds for it.
+        """
+        if self.link is None:
+            if self._replay is not None:
+                self._continue_replay()
+            elif time.time() >= self._next_attempt:
+                self._connect(True)
+            return
+        self._reap()
+        writers = [self.link.fileno] if self.link.send_buffer else []
+        try:
+            readable, writable, _ = select.select([self.link.fileno], writers, [], self.timeout)
+        except InterruptedError:
+            return
+        if writable:
+            self.link.flush()
+        if readable:
+            for frame in self.link.receive():
+                self._handle_frame(*frame)
+        if self.link.closed:
+            self._lost_link()
+
+
+def Usage():
+    print("gateway [--port <port>] [--socket <path>]")
+    sys.exit()
+
+if __name__ == '__main__':
+    import getopt
+
+    port = 4400
+    path = GATEWAY_SOCKET
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hp:s:", ["help", "port=", "socket="])
+        for opt, arg in opts:
+            if opt in ["-h", "--help"]:
+                Usage()
+            elif opt in ["-p", "--port"]:
+                port = int(arg)
+            elif opt in ["-s", "--socket"]:
+                path = arg
+    except (getopt.GetoptError, ValueError):
+        Usage()
+        sys.exit(2)
+
+    gateway = Gateway(port, path)
+    try:
+        gateway.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gateway.stop()
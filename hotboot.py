@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*- line endings: unix -*-
+__author__ = 'quixadhal'
+
+"""
+This module implements hotboot (often called copyover in other Diku
+derivatives), which restarts the driver with fresh code without dropping
+anyone's connection.
+
+The running driver writes the state of the TelnetServer, every connected
+TelnetClient, and their Login rows to HOTBOOT_FILE, sets the hotboot flag
+in the option table, and then exec's a new Python interpreter in its own
+place.  The listening socket and client sockets are marked inheritable, so
+they survive the exec with the same file descriptor numbers.
+
+When the new driver boots and finds the hotboot flag set, it calls
+restore() to take those sockets back over, instead of opening a new port.
+The descriptor numbers are also passed in the environment (HOTBOOT_FDS),
+so that if the state file is lost they can still be closed, rather than
+leaving the port held open by a socket nobody is listening to.
+Players see a pause while the new code loads, but their connection, screen
+size, terminal type and any half-typed input are all kept.
+
+A hotboot can be requested with request(), or with kill -USR2 from the
+shell.  The main loop checks for it at the top of each tick.
+"""
+
+import os
+import sys
+import json
+import signal
+import log_system
+
+logger = log_system.init_logging(__name__)
+
+HOTBOOT_FILE = 'hotboot.json'
+HOTBOOT_FDS = 'PYKUMUD_HOTBOOT_FDS'
+
+requested = False
+
+
+def request():
+    """
+    Asks the main loop to hotboot at the start of its next tick.
+    """
+    global requested
+    requested = True
+
+
+def install_signal_handler():
+    if hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, lambda signum, frame: request())
+
+
+def _login_states(session):
+    from login import Login
+    results = []
+    for login in session.query(Login).all():
+        results.append({'descriptor': login.descriptor, 'state': login.state.name})
+    return results
+
+
+def _inherited_fds(server_state: dict):
+    fds = []
+    if 'fileno' in server_state:
+        fds.append(server_state['fileno'])
+    fds.extend(client['fileno'] for client in server_state.get('clients', []))
+    return fds
+
+
+def _close_inherited(fds: str):
+    """
+    Closes sockets inherited across a hotboot which can't be restored.
+    """
+    closed = 0
+    for fd in fds.split(','):
+        if not fd:
+            continue
+        try:
+            os.close(int(fd))
+            closed += 1
+        except (OSError, ValueError):
+            pass
+    if closed:
+        logger.error('Closed %d inherited sockets, their connections are lost.', closed)
+
+
+def perform(server, session, options):
+    """
+    Saves the state of the server and its clients, and replaces this
+    process with a new driver.  This does not return, unless the exec fails.
+
+    :param server: The running TelnetServer
+    :param session: Database session
+    :param options: The Option row
+    :return:
+    """
+    global requested
+    requested = False
+    logger.boot('Hotboot in progress, saving %d connections.', server.client_count())
+    state = {
+        'server': server.hotboot_state(),
+        'logins': _login_states(session),
+    }
+    with open(HOTBOOT_FILE, 'w') as fp:
+        json.dump(state, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.environ[HOTBOOT_FDS] = ','.join(str(fd) for fd in _inherited_fds(state['server']))
+    options.hotboot = True
+    session.commit()
+    log_system.shutdown_logging()
+    try:
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+    except OSError as err:
+        log_system.restart_logging()
+        logger.critical('Hotboot failed: %s', err)
+        os.environ.pop(HOTBOOT_FDS, None)
+        options.hotboot = False
+        session.commit()
+
+
+def restore(session, options, server_class=None, **kwargs):
+    """
+    Called at boot when the hotboot flag is set.  Rebuilds the TelnetServer
+    from the inherited sockets, and reattaches each Login to its client.
+
+    :param session: Database session
+    :param options: The Option row
+    :param server_class: The server's class, if not miniboa.TelnetServer
+    :param kwargs: Passed on to the server
+    :return: The server, or None if there was nothing to restore
+    """
+    import miniboa
+    from login import Login, LoginState
+
+    options.hotboot = False
+    session.commit()
+    fds = os.environ.pop(HOTBOOT_FDS, '')
+    try:
+        with open(HOTBOOT_FILE) as fp:
+            state = json.load(fp)
+    except (OSError, ValueError) as err:
+        logger.error('Hotboot flag set, but the state file could not be read: %s', err)
+        _close_inherited(fds)
+        return None
+    os.remove(HOTBOOT_FILE)
+
+    if server_class is None:
+        server_class = miniboa.TelnetServer
+    server = server_class.from_hotboot(state['server'], **kwargs)
+    login_states = {entry['descriptor']: entry['state'] for entry in state['logins']}
+    for login in session.query(Login).all():
+        client = server.clients.get(login.descriptor)
+        if client is None:
+            login.state = LoginState.disconnected
+            continue
+        login.client = client
+        login.state = LoginState[login_states.get(login.descriptor, 'connected')]
+        if login.state == LoginState.authenticating:
+            # The AuthService that was checking them died with the old
+            # process, so nothing would ever finish it.  Ask them again.
+            login.state = LoginState.connected
+    session.commit()
+    logger.boot('Hotboot recovered %d connections.', server.client_count())
+    return server
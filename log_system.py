@@ -1,46 +1,162 @@
 # -*- coding: utf-8 -*- line endings: unix -*-
 __author__ = 'quixadhal'
 
+import atexit
+import queue
 import logging
+import logging.handlers
 
 # Define a few custom log levels
 # WileyMUD had INFO, ERROR, FATAL, BOOT, AUTH, KILL, DEATH, RESET, and IMC
 # Default Python logging levels are CRITICAL 50, ERROR 40, WARNING 30, INFO 20, DEBUG 10
 
+# Log records are handed off to a queue, and a background thread does the
+# formatting and writing, so the game thread never waits on the terminal or
+# a log file.  If the writer falls too far behind, new records are dropped
+# (and counted) rather than blocking the game.
+#
+# Messages are formatted lazily, in the writer thread, so pass arguments as
+# logger.debug('Thing %s', value) rather than building the string yourself.
+# Arguments should be simple values, since they are read after the call returns.
+
+LOG_FORMAT = '%(asctime)s %(levelname)-8s %(module)16s| %(message)s'
+LOG_LEVEL = logging.DEBUG
+LOG_QUEUE_SIZE = 10000
+
+# Per-module level overrides, keyed by the name passed to init_logging().
+LOG_LEVELS = {
+    # 'miniboa': logging.INFO,
+    # 'pulse': logging.INFO,
+}
 
 master_logger = None
+log_handler = None
+log_listener = None
+stopped_handlers = ()  # Outputs of the listener last shut down, for restart_logging()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler which never blocks.  If the queue is full, the record
+    is thrown away and counted, and a warning about the loss is queued up
+    once there's room again.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._unreported = 0
+
+    def prepare(self, record):
+        # The stock version formats the message here, on the game thread.
+        # We only render tracebacks early, since they refer to live frames.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self._unreported:
+                warning = logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                                            'Log queue overflowed, dropped %d records.', (self._unreported,), None)
+                self.queue.put_nowait(warning)
+                self._unreported = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._unreported += 1
+
+
+def dropped_records():
+    """
+    Returns the number of log records thrown away because the writer
+    thread couldn't keep up.
+    """
+    if log_handler is None:
+        return 0
+    return log_handler.dropped
+
+
+def add_handler(handler: logging.Handler):
+    """
+    Adds another output to the background writer, such as a log file.
+    """
+    if log_listener is not None:
+        log_listener.handlers = log_listener.handlers + (handler,)
 
 
 def auth_log(self, message, *args, **kws):
-    if self.level <= 39:
+    if self.isEnabledFor(39):
+        kws.setdefault('stacklevel', 2)
         self._log(39, message, args, **kws)
 
 
 def player_kill_log(self, message, *args, **kws):
-    if self.level <= 38:
+    if self.isEnabledFor(38):
+        kws.setdefault('stacklevel', 2)
         self._log(38, message, args, **kws)
 
 
 def boot_log(self, message, *args, **kws):
-    if self.level <= 31:
+    if self.isEnabledFor(31):
+        kws.setdefault('stacklevel', 2)
         self._log(31, message, args, **kws)
 
 
 def reset_log(self, message, *args, **kws):
-    if self.level <= 29:
+    if self.isEnabledFor(29):
+        kws.setdefault('stacklevel', 2)
         self._log(29, message, args, **kws)
 
 
 def kill_log(self, message, *args, **kws):
-    if self.level <= 21:
+    if self.isEnabledFor(21):
+        kws.setdefault('stacklevel', 2)
         self._log(21, message, args, **kws)
 
 
-def init_logging():
-    global master_logger
+def shutdown_logging():
+    """
+    Writes out anything still queued, and closes all the log outputs.
+    """
+    global log_listener, stopped_handlers
+    if log_listener is not None:
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            handler.close()
+        stopped_handlers = log_listener.handlers
+        log_listener = None
+
+
+def restart_logging():
+    """
+    Starts the background writer again after shutdown_logging(), with the
+    same outputs, for when the process turns out not to be exiting after
+    all (such as a hotboot whose exec failed).  Records logged in between
+    are still in the queue, and are written now.  Closed handlers reopen
+    their files as they're next used.
+    """
+    global log_listener
+    if log_listener is not None or log_handler is None:
+        return
+    log_listener = logging.handlers.QueueListener(log_handler.queue, *stopped_handlers,
+                                                  respect_handler_level=True)
+    log_listener.start()
+
+
+def init_logging(name: str=None):
+    """
+    Sets up the logging pipeline the first time it is called, and returns
+    a logger.  Modules should pass their __name__, so their level can be
+    adjusted separately through LOG_LEVELS.
+
+    :param name: Logger name, or None for the root logger
+    :return: logger
+    """
+    global master_logger, log_handler, log_listener
 
     if master_logger is None:
-        logging.basicConfig(format='%(asctime)s %(levelname)-8s %(module)16s| %(message)s', level=logging.DEBUG)
         logging.addLevelName(39, 'AUTH')
         logging.addLevelName(38, 'PLAYER_KILL')
         logging.addLevelName(31, 'BOOT')
@@ -51,5 +167,27 @@ def init_logging():
         logging.Logger.boot = boot_log
         logging.Logger.reset = reset_log
         logging.Logger.kill = kill_log
+
+        # We never use these, and they cost a few lookups per record.
+        logging.logThreads = False
+        logging.logProcesses = False
+        logging.logMultiprocessing = False
+
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        log_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        log_listener = logging.handlers.QueueListener(log_handler.queue, stream_handler,
+                                                      respect_handler_level=True)
+        log_listener.start()
+        atexit.register(shutdown_logging)
+
         master_logger = logging.getLogger()
-    return master_logger
+        master_logger.setLevel(LOG_LEVEL)
+        master_logger.addHandler(log_handler)
+
+    if name is None:
+        return master_logger
+    logger = logging.getLogger(name)
+    if name in LOG_LEVELS:
+        logger.setLevel(LOG_LEVELS[name])
+    return logger
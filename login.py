@@ -8,13 +8,14 @@ import log_system
 from miniboa import TelnetClient
 from db_system import DataBase, Session
 
-logger = log_system.init_logging()
+logger = log_system.init_logging(__name__)
 
 
 class LoginState(Enum):
     disconnected = 1
     connected = 2
     at_menu = 3
+    authenticating = 4
 
 
 class Login(DataBase):
@@ -37,6 +38,47 @@ class Login(DataBase):
         if not hasattr(self, 'state'):
             self.state = LoginState.disconnected
 
+    def check_password(self, service, password: str, stored: str):
+        """
+        Starts checking a password in the background.  The login stays in
+        the authenticating state, ignoring input, until the result arrives
+        through service.poll().
+
+        Nothing calls this yet.  There is no account table to hold the
+        stored hash, and no login prompt handler to drive the connected ->
+        authenticating -> at_menu transitions, so it's here for that to
+        hook into once it exists.
+
+        :param service: The AuthService
+        :param password: What the user typed
+        :param stored: The saved password hash
+        :return:
+        """
+        self.state = LoginState.authenticating
+        service.check_password(password, stored, self._authenticated)
+
+    def check_token(self, service, secret: str, token: str):
+        """
+        Starts checking a 2-factor token in the background, like check_password().
+        """
+        self.state = LoginState.authenticating
+        service.verify_token(secret, token, self._authenticated)
+
+    def _authenticated(self, ok: bool):
+        if self.state != LoginState.authenticating:
+            # They gave up and disconnected while we were busy.
+            return
+        if ok:
+            logger.auth('Login on descriptor %d authenticated.', self.descriptor)
+            self.state = LoginState.at_menu
+            if self.client is not None:
+                self.client.mark_logged_in()
+        else:
+            logger.auth('Login on descriptor %d failed to authenticate.', self.descriptor)
+            self.state = LoginState.connected
+            if self.client is not None:
+                self.client.send('Authentication failed.\n', None)
+
     @classmethod
     def on_connect(cls, client: TelnetClient):
         session = Session()
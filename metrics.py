@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*- line endings: unix -*-
+__author__ = 'quixadhal'
+
+"""
+This module keeps rolling counters and histograms about the running game,
+and renders them in the Prometheus text exposition format.
+
+Recording a value is just an addition (or a bisect, for histograms), so the
+game loop can update metrics every tick without noticing.  All the string
+formatting happens in render(), which only runs when something scrapes the
+/metrics page of the web server.
+
+Values which already exist elsewhere, like the byte counters on each
+TelnetClient, are not copied into metrics on every change.  Instead, a
+collector function is registered, and it gathers those values at scrape time.
+"""
+
+import bisect
+import time
+import threading
+import log_system
+
+logger = log_system.init_logging(__name__)
+
+# Buckets, in seconds, for things measured against a single tick.
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _format_labels(labels: dict or None, extra: dict or None=None):
+    """
+    Formats a dict of labels as {name="value",...}, or an empty string.
+    """
+    merged = dict(labels or {})
+    if extra:
+        merged.update(extra)
+    if not merged:
+        return ''
+    pairs = ('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(merged.items()))
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+class Counter(object):
+    """
+    A value which only ever goes up, such as bytes sent or ticks overrun.
+    """
+    kind = 'counter'
+
+    def __init__(self, name: str, labels: dict=None):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, _format_labels(self.labels), self.value
+
+
+class Gauge(object):
+    """
+    A value which can go up and down, such as the number of connections.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, labels: dict=None):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self):
+        yield self.name, _format_labels(self.labels), self.value
+
+
+class Histogram(object):
+    """
+    Counts observations into fixed buckets, and keeps their running sum,
+    so percentiles and averages can be worked out by whoever scrapes us.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, labels: dict=None, buckets: tuple=TIME_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """
+        Returns a context manager which observes the time spent inside it.
+        """
+        return _Timer(self)
+
+    def samples(self):
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            running += count
+            yield self.name + '_bucket', _format_labels(self.labels, {'le': _format_value(float(bound))}), running
+        yield self.name + '_sum', _format_labels(self.labels), self.sum
+        yield self.name + '_count', _format_labels(self.labels), self.count
+
+
+class _Timer(object):
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.time() - self.start)
+        return False
+
+
+class MetricsRegistry(object):
+    """
+    Holds every metric, grouped into families by name, and any collector
+    functions which are asked for their values at scrape time.
+
+    A collector is a callable returning an iterable of
+    (name, kind, help, labels, value) tuples.
+    """
+
+    def __init__(self):
+        self._families = {}
+        self._help = {}
+        self._kinds = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name: str, help: str, labels: dict=None, **kwargs):
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            family = self._families.setdefault(name, {})
+            if key in family:
+                return family[key]
+            if name in self._kinds and self._kinds[name] != cls.kind:
+                raise ValueError('Metric %s already registered as a %s' % (name, self._kinds[name]))
+            metric = cls(name, labels, **kwargs)
+            family[key] = metric
+            self._help[name] = help
+            self._kinds[name] = cls.kind
+        return metric
+
+    def counter(self, name: str, help: str, labels: dict=None):
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: dict=None):
+        return self._register(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str, labels: dict=None, buckets: tuple=TIME_BUCKETS):
+        return self._register(Histogram, name, help, labels, buckets=buckets)
+
+    def add_collector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+
+        :return: Text suitable for a /metrics page
+        :rtype: str
+        """
+        lines = []
+        with self._lock:
+            families = [(name, list(family.values())) for name, family in sorted(self._families.items())]
+            collectors = list(self._collectors)
+        for name, metrics in families:
+            lines.append('# HELP %s %s' % (name, self._help[name]))
+            lines.append('# TYPE %s %s' % (name, self._kinds[name]))
+            for metric in metrics:
+                for sample_name, label_text, value in metric.samples():
+                    lines.append('%s%s %s' % (sample_name, label_text, _format_value(value)))
+        # Several collectors may report the same family (one per server), and
+        # a family's samples have to be listed together.
+        collected_families = {}
+        for collector in collectors:
+            try:
+                collected = list(collector())
+            except Exception as err:
+                logger.error('Metrics collector %r failed: %s', collector, err)
+                continue
+            for name, kind, help, labels, value in collected:
+                family = collected_families.setdefault(name, (kind, help, []))
+                family[2].append((labels, value))
+        for name, (kind, help, samples) in collected_families.items():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+registry = MetricsRegistry()
+
+# Metrics updated directly by the main loop.
+tick_seconds = registry.histogram('pykumud_tick_seconds', 'Time spent doing work in each main loop tick.')
+tick_overruns = registry.counter('pykumud_tick_overruns_total', 'Ticks which took longer than the pulse width.')
+db_commit_seconds = registry.histogram('pykumud_db_commit_seconds', 'Time spent committing database sessions.')
+
+
+def pulse_seconds(category: str):
+    """
+    Returns the histogram used to time one category of pulse updates.
+    """
+    return registry.histogram('pykumud_pulse_seconds', 'Time spent in each category of pulse updates.',
+                              {'category': category})
+
+
+def watch_telnet_server(server, name: str or None=None):
+    """
+    Registers a collector which reports connection, traffic and command
+    counts from a miniboa.TelnetServer at scrape time.  The gateway and
+    WebSocket servers have the same counters, and can be watched too.
+
+    :param server: The running TelnetServer
+    :param name: Reported as the server label, to tell several servers apart
+    :return: The collector, in case it needs to be removed later
+    """
+    labels = {'server': name} if name else None
+
+    def collector():
+        sent = server.closed_bytes_sent
+        received = server.closed_bytes_received
+        raw = getattr(server, 'closed_mccp_raw_bytes', 0)
+        compressed = getattr(server, 'closed_mccp_compressed_bytes', 0)
+        for client in list(server.client_list()):
+            sent += client.bytes_sent
+            received += client.bytes_received
+            raw += getattr(client, 'mccp_raw_bytes', 0)
+            compressed += getattr(client, 'mccp_compressed_bytes', 0)
+        return (
+            ('pykumud_connections', 'gauge', 'Currently connected telnet clients.', labels, server.client_count()),
+            ('pykumud_connections_accepted_total', 'counter', 'Telnet connections accepted.', labels,
+             server.connections_accepted),
+            ('pykumud_connections_refused_total', 'counter', 'Telnet connections refused.', labels,
+             server.connections_refused),
+            ('pykumud_connections_reaped_total', 'counter', 'Telnet connections dropped for idling.', labels,
+             getattr(server, 'connections_reaped', 0)),
+            ('pykumud_bytes_sent_total', 'counter', 'Bytes sent to telnet clients.', labels, sent),
+            ('pykumud_bytes_received_total', 'counter', 'Bytes received from telnet clients.', labels, received),
+            ('pykumud_commands_total', 'counter', 'Command lines received from telnet clients.', labels,
+             server.commands_received),
+            ('pykumud_mccp_raw_bytes_total', 'counter', 'Bytes of output fed into MCCP compression.', labels, raw),
+            ('pykumud_mccp_compressed_bytes_total', 'counter', 'Bytes of output after MCCP compression.', labels,
+             compressed),
+            ('pykumud_output_flushes_total', 'counter', 'End of tick output flushes.', labels,
+             getattr(server, 'flushes', 0)),
+            ('pykumud_output_flush_sends_total', 'counter', 'Sends made by end of tick output flushes.', labels,
+             getattr(server, 'flush_sends', 0)),
+        )
+    registry.add_collector(collector)
+    return collector
@@ -35,13 +35,18 @@ limitations under the License.
 ```
 """
 
+import os
+import json
+import heapq
+import itertools
 import socket
 import select
 import sys
 import time
+import zlib
 import log_system
 
-logger = log_system.init_logging()
+logger = log_system.init_logging(__name__)
 
 DEFAULT_PORT = 23
 DEFAULT_TIMEOUT = 0.5
@@ -51,6 +56,43 @@ if sys.platform == 'win32':
     MAX_CONNECTIONS = 500
 else:
     MAX_CONNECTIONS = 1000
+# zlib level for MCCP, from 1 (fastest) to 9 (smallest), or 0 not to offer it
+MCCP_LEVEL = 6
+# Offer GMCP to new clients?
+OFFER_GMCP = True
+# Longest subnegotiation we'll collect, GMCP messages can be much longer
+SB_MAX_LENGTH = 64
+GMCP_MAX_LENGTH = 8192
+GMCP_INBOX_SIZE = 32
+# Connection limits
+LISTEN_BACKLOG = 128
+MAX_PER_IP = 8  # Simultaneous connections from one address, 0 for no limit
+ACCEPT_RATE = 1.0  # New connections per second from one address...
+ACCEPT_BURST = 5  # ...after an initial burst of this many
+IDLE_PRE_LOGIN = 300  # Seconds a connection may idle before logging in, 0 for no limit
+IDLE_LOGGED_IN = 3600  # Seconds a logged in connection may idle, 0 for no limit
+IDLE_MESSAGE = "\nYou have been idle too long, disconnecting.\n"
+ACCEPT_PRUNE_INTERVAL = 60.0  # Seconds between sweeps of the accept rate buckets
+# Output is coalesced and written once per tick by flush(), so Nagle's
+# algorithm would only hold the last segment of each tick back.
+TCP_NODELAY = True
+# Keep client sockets corked between flushes, so anything written mid-tick
+# (negotiation replies, short-write leftovers) goes out with the tick's output
+# in full segments.  Linux only, and costs two extra syscalls per flush.
+TCP_CORK = False
+
+
+_client_ids = itertools.count(1)
+
+
+def next_client_id():
+    """
+    Returns a number no other client in this process has been given.  Every
+    kind of client (telnet, gateway, websocket) takes one, so clients of
+    different servers can share a table.  File descriptors can't do that,
+    since a gateway client's is the gateway's, not ours.
+    """
+    return next(_client_ids)
 
 
 # --[ Stub functions ]----------------------------------------------------------
@@ -58,7 +100,7 @@ def _on_connect(client):
     """
     Placeholder new connection handler.
     """
-    logger.info("++ Opened connection to {}, sending greeting...".format(client.addrport()))
+    logger.info("++ Opened connection to %s, sending greeting...", client.addrport())
     client.send("Greetings from Miniboa-py3!\n")
 
 
@@ -66,7 +108,7 @@ def _on_disconnect(client):
     """
     Placeholder lost connection handler.
     """
-    logger.info("-- Lost connection to %s".format(client.addrport()))
+    logger.info("-- Lost connection to %s", client.addrport())
 
 
 def _term_handler(text: str or None, input_type='pyku', output_type='ANSI'):
@@ -76,15 +118,150 @@ def _term_handler(text: str or None, input_type='pyku', output_type='ANSI'):
     return text
 
 
+# --[ Connection Limits ]-------------------------------------------------------
+class ConnectionLimits(object):
+    """
+    Per-address connection limits and idle reaping, shared by TelnetServer
+    and websocket_gateway.WebSocketServer.  A server using it keeps its
+    clients in self.clients, keyed by file descriptor, calls _init_limits()
+    when it starts, _accept_allowed() and _track() for each new connection,
+    _untrack() when one closes, and _check_limits() at the top of poll().
+    """
+
+    def _init_limits(self, max_per_ip=MAX_PER_IP, accept_rate=ACCEPT_RATE, accept_burst=ACCEPT_BURST,
+                     idle_pre_login=IDLE_PRE_LOGIN, idle_logged_in=IDLE_LOGGED_IN):
+        self.max_per_ip = max_per_ip
+        self.accept_rate = accept_rate
+        self.accept_burst = accept_burst
+        self.idle_pre_login = idle_pre_login
+        self.idle_logged_in = idle_logged_in
+        self.connections_reaped = 0
+        self._per_ip = {}  # address -> open connections
+        self._accept_buckets = {}  # address -> (tokens, time last topped up)
+        self._idle_heap = []  # (deadline, id(client), client), at most one entry per client
+        self._next_prune = time.time() + ACCEPT_PRUNE_INTERVAL
+
+    def _check_limits(self, now: float):
+        """
+        Does whatever limit work is due, called at the start of each poll().
+        """
+        if self._idle_heap and self._idle_heap[0][0] <= now:
+            self.reap_idle(now)
+        if now >= self._next_prune:
+            self.prune_accept_buckets(now)
+
+    def _track(self, client):
+        """
+        Starts counting a new client against its address, and watching it
+        for idleness.
+        """
+        self._per_ip[client.address] = self._per_ip.get(client.address, 0) + 1
+        deadline = self._idle_deadline(client)
+        if deadline is None and (self.idle_pre_login or self.idle_logged_in):
+            # No limit yet, but there will be one once it logs in.  Look again
+            # when that limit could first have run out.
+            deadline = client.last_input_time + max(self.idle_pre_login, self.idle_logged_in)
+        if deadline is not None:
+            heapq.heappush(self._idle_heap, (deadline, id(client), client))
+
+    def _untrack(self, client):
+        count = self._per_ip.get(client.address, 0) - 1
+        if count > 0:
+            self._per_ip[client.address] = count
+        else:
+            self._per_ip.pop(client.address, None)
+
+    def _idle_deadline(self, client):
+        """
+        Returns when the client will have been idle too long, or None if
+        there is no limit for it.
+        """
+        limit = self.idle_logged_in if client.logged_in else self.idle_pre_login
+        if not limit:
+            return None
+        return client.last_input_time + limit
+
+    def _accept_allowed(self, address: str, now: float):
+        """
+        Checks a new connection against the per-address limits.
+        """
+        if self.max_per_ip and self._per_ip.get(address, 0) >= self.max_per_ip:
+            return False
+        if not self.accept_rate:
+            return True
+        tokens, last = self._accept_buckets.get(address, (self.accept_burst, now))
+        tokens = min(self.accept_burst, tokens + (now - last) * self.accept_rate)
+        if tokens < 1.0:
+            self._accept_buckets[address] = (tokens, now)
+            return False
+        self._accept_buckets[address] = (tokens - 1.0, now)
+        return True
+
+    def reap_idle(self, now: float=None):
+        """
+        Disconnects clients which have been idle too long.  Only clients whose
+        deadline has passed are looked at, and input doesn't touch the heap:
+        a client found to have typed something since is simply pushed back
+        with its new deadline.
+
+        :return: The number of clients disconnected
+        """
+        if now is None:
+            now = time.time()
+        heap = self._idle_heap
+        reaped = 0
+        while heap and heap[0][0] <= now:
+            deadline, key, client = heapq.heappop(heap)
+            if self.clients.get(client.fileno) is not client or not client.active:
+                continue
+            deadline = self._idle_deadline(client)
+            if deadline is None:
+                # No limit now, check again once the other limit would apply.
+                deadline = now + max(self.idle_pre_login, self.idle_logged_in)
+            if deadline > now:
+                heapq.heappush(heap, (deadline, key, client))
+                continue
+            logger.info("Disconnecting %s after %d seconds idle", client.addrport(), client.idle())
+            client.send(IDLE_MESSAGE)
+            client.socket_send()
+            client.deactivate()
+            reaped += 1
+        if reaped:
+            self.connections_reaped += reaped
+        return reaped
+
+    def prune_accept_buckets(self, now: float=None):
+        """
+        Forgets addresses whose accept allowance has filled back up, as
+        they're no different from addresses never seen.  poll() calls this
+        every ACCEPT_PRUNE_INTERVAL seconds, so a flood of addresses can't
+        grow the table without bound.
+        """
+        if now is None:
+            now = time.time()
+        self._next_prune = now + ACCEPT_PRUNE_INTERVAL
+        if not self.accept_rate:
+            self._accept_buckets.clear()
+            return
+        full = self.accept_burst / self.accept_rate
+        for address, (tokens, last) in list(self._accept_buckets.items()):
+            if now - last >= full:
+                del self._accept_buckets[address]
+
+
 # --[ Telnet Server ]-----------------------------------------------------------
-class TelnetServer(object):
+class TelnetServer(ConnectionLimits):
     """
     Poll sockets for new connections and sending/receiving data from clients.
     """
 
     def __init__(self, port=DEFAULT_PORT, address='', on_connect=_on_connect,
                  on_disconnect=_on_disconnect, max_connections=MAX_CONNECTIONS,
-                 timeout=DEFAULT_TIMEOUT, term_handler=_term_handler):
+                 timeout=DEFAULT_TIMEOUT, term_handler=_term_handler, server_socket=None,
+                 compression_level=MCCP_LEVEL, gmcp=OFFER_GMCP, negotiation=None,
+                 listen_backlog=LISTEN_BACKLOG, max_per_ip=MAX_PER_IP, accept_rate=ACCEPT_RATE,
+                 accept_burst=ACCEPT_BURST, idle_pre_login=IDLE_PRE_LOGIN, idle_logged_in=IDLE_LOGGED_IN,
+                 nodelay=TCP_NODELAY, cork=TCP_CORK):
         """
         Create a new Telnet Server.
 
@@ -109,6 +286,35 @@ class TelnetServer(object):
 
         term_handler -- function to convert color/terminal tokens into
             byte sequences the remote terminal can use.
+
+        server_socket -- an already listening socket to use, such as one
+            inherited across a hotboot, instead of opening a new one.
+
+        compression_level -- zlib level used for MCCP compressed output.
+            MCCP is offered to every new client unless this is 0.
+
+        gmcp -- offer GMCP to every new client.
+
+        negotiation -- (command, option) pairs sent to every new client,
+            INITIAL_NEGOTIATION if not given.  MCCP and GMCP offers are
+            added to these as configured.
+
+        listen_backlog -- how many connections the kernel will queue for
+            us between polls.
+
+        max_per_ip -- most simultaneous connections from one address.
+
+        accept_rate, accept_burst -- new connections per second allowed
+            from one address, after an initial burst.
+
+        idle_pre_login, idle_logged_in -- seconds without input before a
+            connection is dropped, before and after the game calls the
+            client's mark_logged_in().  0 means no limit.
+
+        nodelay -- turn off Nagle's algorithm on client sockets.
+
+        cork -- keep client sockets corked between calls to flush(), where
+            the platform has TCP_CORK.
         """
 
         self.port = port
@@ -118,16 +324,30 @@ class TelnetServer(object):
         self.max_connections = min(max_connections, MAX_CONNECTIONS)
         self.timeout = timeout
         self.term_handler = term_handler
+        self.compression_level = compression_level
+        self.gmcp = gmcp
+        if negotiation is None:
+            negotiation = INITIAL_NEGOTIATION
+        requests = tuple(negotiation)
+        if compression_level:
+            requests += ((WILL, MCCP2),)
+        if gmcp:
+            requests += ((WILL, GMCP),)
+        self.negotiation = build_negotiation(requests)
+        self._init_limits(max_per_ip, accept_rate, accept_burst, idle_pre_login, idle_logged_in)
+        self.nodelay = nodelay
+        self.cork = cork and hasattr(socket, 'TCP_CORK')
+
+        if server_socket is None:
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        try:
-            server_socket.bind((address, port))
-            server_socket.listen(5)
-        except socket.error as err:
-            logger.critical("Unable to create the server socket: " + str(err))
-            raise
+            try:
+                server_socket.bind((address, port))
+                server_socket.listen(listen_backlog)
+            except socket.error as err:
+                logger.critical("Unable to create the server socket: %s", err)
+                raise
 
         self.server_socket = server_socket
         self.server_fileno = server_socket.fileno()
@@ -136,6 +356,112 @@ class TelnetServer(object):
         # key = file descriptor, value = TelnetClient (see miniboa.telnet)
         self.clients = {}
 
+        # Running totals, for statistics.  Byte counts from live clients are
+        # kept on each client, and added in here when they disconnect.
+        self.connections_accepted = 0
+        self.connections_refused = 0
+        self.commands_received = 0
+        self.closed_bytes_sent = 0
+        self.closed_bytes_received = 0
+        self.closed_mccp_raw_bytes = 0
+        self.closed_mccp_compressed_bytes = 0
+        self.flushes = 0
+        self.flush_sends = 0
+
+    def hotboot_state(self):
+        """
+        Returns everything needed to rebuild the server, and all its clients,
+        in a new process which inherits the sockets.  The sockets are marked
+        inheritable as a side effect.
+        """
+        os.set_inheritable(self.server_fileno, True)
+        clients = []
+        for client in self.client_list():
+            if client.active:
+                os.set_inheritable(client.fileno, True)
+                clients.append(client.hotboot_state())
+        return {
+            'fileno': self.server_fileno,
+            'port': self.port,
+            'address': self.address,
+            'clients': clients,
+            'connections_accepted': self.connections_accepted,
+            'connections_refused': self.connections_refused,
+            'commands_received': self.commands_received,
+            'closed_bytes_sent': self.closed_bytes_sent,
+            'closed_bytes_received': self.closed_bytes_received,
+            'closed_mccp_raw_bytes': self.closed_mccp_raw_bytes,
+            'closed_mccp_compressed_bytes': self.closed_mccp_compressed_bytes,
+            'connections_reaped': self.connections_reaped,
+        }
+
+    @classmethod
+    def from_hotboot(cls, state: dict, **kwargs):
+        """
+        Rebuilds a server from hotboot_state(), taking over the inherited
+        listening socket and client connections.
+        """
+        server_socket = socket.socket(fileno=state['fileno'])
+        server = cls(port=state['port'], address=state['address'], server_socket=server_socket, **kwargs)
+        for k in ('connections_accepted', 'connections_refused', 'commands_received',
+                  'closed_bytes_sent', 'closed_bytes_received',
+                  'closed_mccp_raw_bytes', 'closed_mccp_compressed_bytes', 'connections_reaped'):
+            setattr(server, k, state.get(k, 0))
+        for client_state in state['clients']:
+            client = TelnetClient.from_hotboot(client_state, server.term_handler, server.compression_level)
+            server.clients[client.fileno] = client
+            server._track(client)
+            server._tune_socket(client.sock)
+        return server
+
+    def _tune_socket(self, sock):
+        """
+        Makes a client socket non-blocking, so flush() can never stall the
+        game loop, and applies the server's TCP_NODELAY and TCP_CORK settings.
+        """
+        sock.setblocking(False)
+        try:
+            if self.nodelay:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.cork:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        except OSError as err:
+            logger.debug("Unable to set TCP options: %s", err)
+
+    def flush_gmcp(self):
+        """
+        Sends each client the GMCP values changed since the last call.
+        The game loop calls this once per tick, after its updates.
+        """
+        for client in self.clients.values():
+            if client.active:
+                client.gmcp_flush()
+
+    def flush(self):
+        """
+        Writes each client's queued output with a single send().  The game
+        loop calls this once per tick, right after its updates, so output
+        leaves in the tick it was produced in, as few segments as possible.
+        Anything the kernel won't take yet is sent by poll() when the socket
+        is writable.
+
+        :return: The number of sends made
+        """
+        sends = 0
+        for client in self.clients.values():
+            if client.active and client.send_pending:
+                client.socket_send()
+                sends += 1
+                if self.cork:
+                    try:
+                        client.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+                        client.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+                    except OSError:
+                        pass
+        self.flushes += 1
+        self.flush_sends += sends
+        return sends
+
     def stop(self):
         """
         Disconnects the clients and shuts down the server
@@ -163,6 +489,9 @@ class TelnetServer(object):
         read incoming data, and send outgoing data.  Sends and receives may
         be partial.
         """
+        now = time.time()
+        self._check_limits(now)
+
         # Build a list of connections to test for receive data pending
         recv_list = [self.server_fileno]  # always add the server
 
@@ -175,15 +504,21 @@ class TelnetServer(object):
                 self.on_disconnect(client)
                 del_list.append(client.fileno)
                 client.sock.close()
+                self.closed_bytes_sent += client.bytes_sent
+                self.closed_bytes_received += client.bytes_received
+                self.closed_mccp_raw_bytes += client.mccp_raw_bytes
+                self.closed_mccp_compressed_bytes += client.mccp_compressed_bytes
+                self._untrack(client)
 
         # Delete inactive connections from the dictionary
         for client in del_list:
             del self.clients[client]
 
-        # Build a list of connections that need to send data
+        # Build a list of connections with output left over from a short
+        # write.  New output waits for flush() at the end of the tick.
         send_list = []
         for client in self.clients.values():
-            if client.send_pending:
+            if client.send_wire:
                 send_list.append(client.fileno)
 
         # Get active socket file descriptors from select.select()
@@ -192,7 +527,7 @@ class TelnetServer(object):
                                                 self.timeout)
         except select.error as err:
             # If we can't even use select(), game over man, game over
-            logger.critical("SELECT socket error '{}'".format(str(err)))
+            logger.critical("SELECT socket error '%s'", err)
             raise
 
         # Process socket file descriptors with data to receive
@@ -204,26 +539,38 @@ class TelnetServer(object):
                 try:
                     sock, addr_tup = self.server_socket.accept()
                 except socket.error as err:
-                    logger.error("ACCEPT socket error '{}:{}'.".format(err[0], err[1]))
+                    logger.error("ACCEPT socket error '%s'.", err)
                     continue
 
                 # Check for maximum connections
                 if self.client_count() >= self.max_connections:
                     logger.warning("Refusing new connection, maximum already in use.")
                     sock.close()
+                    self.connections_refused += 1
+                    continue
+
+                if not self._accept_allowed(addr_tup[0], now):
+                    logger.debug("Refusing new connection from %s, too many or too fast.", addr_tup[0])
+                    sock.close()
+                    self.connections_refused += 1
                     continue
 
+                self._tune_socket(sock)
+
                 # Create the client instance
-                new_client = TelnetClient(sock, addr_tup, self.term_handler)
+                new_client = TelnetClient(sock, addr_tup, self.term_handler, self.compression_level)
 
                 # Add the connection to our dictionary and call handler
                 self.clients[new_client.fileno] = new_client
+                self.connections_accepted += 1
+                self._track(new_client)
+                new_client.negotiate(*self.negotiation)
                 self.on_connect(new_client)
 
             else:
                 # Call the connection's receive method
                 try:
-                    self.clients[sock_fileno].socket_recv()
+                    self.commands_received += self.clients[sock_fileno].socket_recv()
                 except ConnectionLost:
                     self.clients[sock_fileno].deactivate()
 
@@ -298,6 +645,8 @@ SGA = chr(3)  # Suppress Go-Ahead
 TTYPE = chr(24)  # Terminal Type
 NAWS = chr(31)  # Negotiate About Window Size
 LINEMO = chr(34)  # Line Mode
+MCCP2 = chr(86)  # Mud Client Compression Protocol, version 2
+GMCP = chr(201)  # Generic Mud Communication Protocol
 
 
 # --[ Lost Connection Exception Handler ]---------------------------------------
@@ -308,16 +657,77 @@ class ConnectionLost(Exception):
     pass
 
 
-# --[ Telnet Option ]-----------------------------------------------------------
-class TelnetOption(object):
+# Options requested from every new client, unless the server is told otherwise.
+INITIAL_NEGOTIATION = ((DO, SGA), (DO, NAWS), (DO, TTYPE), (WILL, ECHO))
+
+
+def build_negotiation(requests):
+    """
+    Precomputes the opening burst of option requests, so a new connection
+    gets them all in a single write.
+
+    :param requests: sequence of (command, option), such as INITIAL_NEGOTIATION
+    :return: (bytes to send, bitmask of options awaiting a reply, whether we echo)
+    """
+    text = ''.join(IAC + cmd + option for cmd, option in requests)
+    pending = 0
+    for cmd, option in requests:
+        pending |= 1 << ord(option)
+    return bytes(text, 'latin-1'), pending, (WILL, ECHO) in requests
+
+
+# --[ GMCP State ]--------------------------------------------------------------
+def _gmcp_message(package: str, text: str or None):
     """
-    Simple class used to track the status of an extended Telnet option.
+    Wraps one GMCP package, and its already JSON encoded data, in a
+    subnegotiation.
+    """
+    message = package if text is None else package + ' ' + text
+    # json.dumps only produces ASCII, so there is nothing to escape but IAC.
+    message = message.replace(IAC, IAC + IAC)
+    return "{}{}{}{}{}{}".format(IAC, SB, GMCP, message, IAC, SE)
+
+
+class GmcpState(object):
+    """
+    Remembers the GMCP values last sent to a client, and which have been
+    changed since, so each tick only the fields that differ go out.
+
+    Values are compared with ==, so pass a new list or dict rather than
+    changing the one given last time in place.
     """
 
     def __init__(self):
-        self.local_option = UNKNOWN  # Local state of an option
-        self.remote_option = UNKNOWN  # Remote state of an option
-        self.reply_pending = False  # Are we expecting a reply?
+        self.sent = {}  # package -> {field: value} as last sent
+        self.pending = {}  # package -> {field: value} waiting to go out
+
+    def update(self, package: str, data: dict):
+        """
+        Records the current value of some fields in a package.
+        """
+        last = self.sent.get(package, {})
+        pending = self.pending.get(package)
+        for k, v in data.items():
+            if k not in last or last[k] != v:
+                if pending is None:
+                    pending = self.pending[package] = {}
+                pending[k] = v
+            elif pending is not None:
+                pending.pop(k, None)
+
+    def changes(self):
+        """
+        Returns the changed fields, and marks them as sent.
+
+        :return: list of (package, {field: value})
+        """
+        results = []
+        for package, fields in self.pending.items():
+            if fields:
+                self.sent.setdefault(package, {}).update(fields)
+                results.append((package, fields))
+        self.pending = {}
+        return results
 
 
 # --[ Telnet Client ]-----------------------------------------------------------
@@ -328,10 +738,23 @@ class TelnetClient(object):
     First argument is the socket discovered by the Telnet Server.
     Second argument is the tuple (ip address, port number).
     Third (optional) argument is the terminal token handler.
+    Fourth (optional) argument is the zlib level used if MCCP is agreed.
     """
 
-    def __init__(self, sock, addr_tup, term_handler=_term_handler):
+    __slots__ = (
+        'protocol', 'active', 'sock', 'fileno', 'address', 'port', 'terminal_type', 'term_handler',
+        'use_ansi', 'columns', 'rows', 'send_pending', 'send_buffer', 'send_wire', 'recv_buffer',
+        'bytes_sent', 'bytes_received', 'compression_level', 'compressor', 'mccp_raw_bytes',
+        'mccp_compressed_bytes', 'gmcp', 'gmcp_state', 'gmcp_supports', 'gmcp_inbox', 'cmd_ready',
+        'command_list', 'connect_time', 'last_input_time', 'telnet_got_iac', 'telnet_got_cmd',
+        'telnet_got_sb', 'telnet_local_known', 'telnet_local_on', 'telnet_remote_known',
+        'telnet_remote_on', 'telnet_pending', 'telnet_echo', 'telnet_echo_password', 'telnet_sb_buffer',
+        'logged_in', 'client_id',
+    )
+
+    def __init__(self, sock, addr_tup, term_handler=_term_handler, compression_level=MCCP_LEVEL):
         self.protocol = 'telnet'
+        self.client_id = next_client_id()  # Unique in this process, unlike fileno
         self.active = True  # Turns False when the connection is lost
         self.sock = sock  # The connection's socket
         self.fileno = sock.fileno()  # The socket's file descriptor
@@ -343,31 +766,128 @@ class TelnetClient(object):
         self.columns = 80
         self.rows = 24
         self.send_pending = False
-        self.send_buffer = ''
+        self.send_buffer = ''  # Text queued by send(), not yet encoded
+        self.send_wire = None  # Encoded (and maybe compressed) bytes, not yet sent
         self.recv_buffer = ''
         self.bytes_sent = 0
         self.bytes_received = 0
+        self.compression_level = compression_level
+        self.compressor = None  # zlib stream while MCCP is active
+        self.mccp_raw_bytes = 0  # Bytes fed into the compressor
+        self.mccp_compressed_bytes = 0  # Bytes it produced
+        self.gmcp = False  # Has the client agreed to GMCP?
+        self.gmcp_state = None  # GmcpState, once something is published
+        self.gmcp_supports = None  # Modules from Core.Supports, with their versions
+        self.gmcp_inbox = None  # (package, data) received from the client
         self.cmd_ready = False
-        self.command_list = []
-        self.connect_time = time.time()
-        self.last_input_time = time.time()
+        self.command_list = None  # Complete lines waiting for get_command()
+        self.connect_time = self.last_input_time = time.time()
+        self.logged_in = False  # Set by mark_logged_in(), for the idle limits
 
         # State variables for interpreting incoming telnet commands
         self.telnet_got_iac = False  # Are we inside an IAC sequence?
         self.telnet_got_cmd = None  # Did we get a telnet command?
         self.telnet_got_sb = False  # Are we inside a subnegotiation?
-        self.telnet_opt_dict = {}  # Mapping for up to 256 TelnetOptions
+        # Option states, one bit per option number.  Local and remote
+        # options are UNKNOWN until their "known" bit is set.
+        self.telnet_local_known = 0
+        self.telnet_local_on = 0
+        self.telnet_remote_known = 0
+        self.telnet_remote_on = 0
+        self.telnet_pending = 0  # Are we expecting a reply?
         self.telnet_echo = False  # Echo input back to the client?
         self.telnet_echo_password = False  # Echo back '*' for passwords?
         self.telnet_sb_buffer = ''  # Buffer for sub-negotiations
 
+    def hotboot_state(self):
+        """
+        Returns the connection's state as a JSON-friendly dict, so it can be
+        carried across a hotboot.  The socket itself is passed on by file
+        descriptor.
+
+        A zlib stream can't be carried over, so MCCP is ended here, and
+        offered again once the new driver has the connection.
+        """
+        mccp = self.compressor is not None
+        self.end_compression()
+        return {
+            'fileno': self.fileno,
+            'address': self.address,
+            'port': self.port,
+            'terminal_type': self.terminal_type,
+            'use_ansi': self.use_ansi,
+            'columns': self.columns,
+            'rows': self.rows,
+            'send_buffer': self.send_buffer,
+            'send_wire': self.send_wire.decode('latin-1') if self.send_wire else '',
+            'mccp': mccp,
+            'mccp_raw_bytes': self.mccp_raw_bytes,
+            'mccp_compressed_bytes': self.mccp_compressed_bytes,
+            'gmcp': self.gmcp,
+            'gmcp_supports': self.gmcp_supports,
+            'gmcp_sent': self.gmcp_state.sent if self.gmcp_state else {},
+            'gmcp_pending': self.gmcp_state.pending if self.gmcp_state else {},
+            'recv_buffer': self.recv_buffer,
+            'command_list': list(self.command_list or ()),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'connect_time': self.connect_time,
+            'last_input_time': self.last_input_time,
+            'logged_in': self.logged_in,
+            'telnet_echo': self.telnet_echo,
+            'telnet_echo_password': self.telnet_echo_password,
+            'telnet_option_bits': [self.telnet_local_known, self.telnet_local_on, self.telnet_remote_known,
+                                   self.telnet_remote_on, self.telnet_pending],
+        }
+
+    @classmethod
+    def from_hotboot(cls, state: dict, term_handler=_term_handler, compression_level=MCCP_LEVEL):
+        """
+        Rebuilds a client from hotboot_state(), on its inherited socket.
+        """
+        sock = socket.socket(fileno=state['fileno'])
+        client = cls(sock, (state['address'], state['port']), term_handler, compression_level)
+        for k in ('terminal_type', 'use_ansi', 'columns', 'rows', 'send_buffer', 'recv_buffer',
+                  'bytes_sent', 'bytes_received', 'connect_time', 'last_input_time',
+                  'telnet_echo', 'telnet_echo_password'):
+            setattr(client, k, state[k])
+        if state.get('send_wire'):
+            client.send_wire = bytearray(state['send_wire'].encode('latin-1'))
+        client.mccp_raw_bytes = state.get('mccp_raw_bytes', 0)
+        client.mccp_compressed_bytes = state.get('mccp_compressed_bytes', 0)
+        client.gmcp = state.get('gmcp', False)
+        client.gmcp_supports = state.get('gmcp_supports')
+        if state.get('gmcp_sent') or state.get('gmcp_pending'):
+            client.gmcp_state = GmcpState()
+            client.gmcp_state.sent = state.get('gmcp_sent', {})
+            client.gmcp_state.pending = state.get('gmcp_pending', {})
+        if state['command_list']:
+            client.command_list = list(state['command_list'])
+            client.cmd_ready = True
+        client.send_pending = bool(client.send_buffer or client.send_wire)
+        client.logged_in = state.get('logged_in', False)
+        if 'telnet_option_bits' in state:
+            (client.telnet_local_known, client.telnet_local_on, client.telnet_remote_known,
+             client.telnet_remote_on, client.telnet_pending) = state['telnet_option_bits']
+        else:
+            # Saved by a driver which still kept a TelnetOption per option.
+            for option, (local, remote, pending) in state.get('telnet_options', {}).items():
+                option = chr(int(option))
+                client._note_local_option(option, local)
+                client._note_remote_option(option, remote)
+                client._note_reply_pending(option, pending)
+        if state.get('mccp'):
+            client._note_local_option(MCCP2, UNKNOWN)
+            client.request_mccp()
+        return client
+
     def get_command(self):
         """
         Get a line of text that was received from the client. The class's
         cmd_ready attribute will be true if lines are available.
         """
         cmd = None
-        count = len(self.command_list)
+        count = len(self.command_list) if self.command_list else 0
         if count > 0:
             cmd = self.command_list.pop(0)
 
@@ -376,7 +896,7 @@ class TelnetClient(object):
             self.cmd_ready = False
         return cmd
 
-    def send(self, text: str, ttype: str or None):
+    def send(self, text: str, ttype: str or None=None):
         """
         Send raw text to the distant end.
         """
@@ -401,6 +921,13 @@ class TelnetClient(object):
         """
         self.active = False
 
+    def mark_logged_in(self):
+        """
+        Tells the server this connection has logged in, so the longer idle
+        limit applies to it.
+        """
+        self.logged_in = True
+
     def addrport(self):
         """
         Return the client's IP address and port number as a string.
@@ -420,6 +947,27 @@ class TelnetClient(object):
         """
         return time.time() - self.connect_time
 
+    def negotiate(self, data: bytes, pending: int, echo: bool):
+        """
+        Sends the opening option requests from build_negotiation() straight to
+        the socket, in one write, and notes that replies are expected.
+        """
+        self.telnet_pending |= pending
+        if echo:
+            self.telnet_echo = True
+        try:
+            sent = self.sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except socket.error as err:
+            logger.error("SEND error '%s' from %s", err, self.addrport())
+            self.active = False
+            return
+        self.bytes_sent += sent
+        if sent < len(data):
+            self._queue_wire(data[sent:])
+            self.send_pending = True
+
     def request_do_sga(self):
         """
         Request client to Suppress Go-Ahead.  See RFC 858.
@@ -473,32 +1021,150 @@ class TelnetClient(object):
         self._iac_do(TTYPE)
         self._note_reply_pending(TTYPE, True)
 
+    def request_mccp(self):
+        """
+        Offer to compress our output with MCCP version 2.
+        """
+        self._iac_will(MCCP2)
+        self._note_reply_pending(MCCP2, True)
+
+    def request_gmcp(self):
+        """
+        Offer to exchange GMCP messages.
+        """
+        self._iac_will(GMCP)
+        self._note_reply_pending(GMCP, True)
+
+    def gmcp_update(self, package: str, data: dict):
+        """
+        Publishes the current state of a GMCP package, such as Char.Vitals.
+        Nothing is sent until gmcp_flush(), and then only the changed fields.
+        """
+        if self.gmcp_state is None:
+            self.gmcp_state = GmcpState()
+        self.gmcp_state.update(package, data)
+
+    def gmcp_flush(self):
+        """
+        Sends the fields changed since the last flush, as one batch.  GMCP
+        allows only one package per subnegotiation, so there is still one
+        message per package, but they're built together and queued with a
+        single append, to go out in the tick's one write.  Changes are held
+        until the client has agreed to GMCP.
+        """
+        if self.gmcp and self.gmcp_state is not None and self.gmcp_state.pending:
+            self.send_buffer += ''.join(_gmcp_message(package, json.dumps(fields, separators=(',', ':')))
+                                        for package, fields in self.gmcp_state.changes())
+            self.send_pending = True
+
+    def gmcp_send(self, package: str, data=None):
+        """
+        Sends a GMCP message right away, for events rather than state,
+        such as Comm.Channel.Text.
+        """
+        if data is None:
+            self.gmcp_write(package, None)
+        else:
+            self.gmcp_write(package, json.dumps(data, separators=(',', ':')))
+
+    def gmcp_write(self, package: str, text: str or None):
+        """
+        Sends a GMCP message whose data is already JSON encoded.  This skips
+        the terminal handler, which would mangle the JSON.
+        """
+        if not self.gmcp:
+            return
+        self.send_buffer += _gmcp_message(package, text)
+        self.send_pending = True
+
+    def start_compression(self):
+        """
+        Tells the client everything from here on is compressed, and starts
+        the zlib stream.  Anything queued before this goes out uncompressed.
+        """
+        if self.compressor is not None:
+            return
+        self.send("{}{}{}{}{}".format(IAC, SB, MCCP2, IAC, SE))
+        self._encode_pending()
+        self.compressor = zlib.compressobj(self.compression_level)
+        logger.debug("MCCP started for %s at level %d", self.addrport(), self.compression_level)
+
+    def end_compression(self):
+        """
+        Finishes the zlib stream, which tells the client that what follows
+        is uncompressed again.
+        """
+        if self.compressor is None:
+            return
+        self._encode_pending()
+        tail = self.compressor.flush(zlib.Z_FINISH)
+        self.mccp_compressed_bytes += len(tail)
+        self._queue_wire(tail)
+        self.send_pending = True
+        self.compressor = None
+
+    def _encode_pending(self):
+        """
+        Encodes the queued text onto the wire buffer, compressing it if
+        MCCP is on.  The stream is flushed each time, so the client can
+        decode each batch of output as soon as it arrives.
+        """
+        if not self.send_buffer:
+            return
+        # convert to ansi before sending
+        data = bytes(self.send_buffer, "cp1252")
+        self.send_buffer = ''
+        if self.compressor is not None:
+            self.mccp_raw_bytes += len(data)
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.mccp_compressed_bytes += len(data)
+        self._queue_wire(data)
+
+    def _queue_wire(self, data: bytes):
+        """
+        Adds bytes to the wire buffer, which only exists while there's
+        something in it, as most connections are idle most of the time.
+        """
+        if self.send_wire is None:
+            self.send_wire = bytearray(data)
+        else:
+            self.send_wire += data
+
     def socket_send(self):
         """
-        Called by TelnetServer when send data is ready.
+        Called by TelnetServer to write everything queued, in one send().
         """
-        if len(self.send_buffer):
+        self._encode_pending()
+        if self.send_wire:
             try:
-                # convert to ansi before sending
-                sent = self.sock.send(bytes(self.send_buffer, "cp1252"))
+                sent = self.sock.send(self.send_wire)
+            except (BlockingIOError, InterruptedError):
+                return
             except socket.error as err:
-                logger.error("SEND error '{}' from {}".format(err, self.addrport()))
+                logger.error("SEND error '%s' from %s", err, self.addrport())
                 self.active = False
                 return
             self.bytes_sent += sent
-            self.send_buffer = self.send_buffer[sent:]
+            if sent == len(self.send_wire):
+                self.send_wire = None
+                self.send_pending = False
+            else:
+                del self.send_wire[:sent]
         else:
             self.send_pending = False
 
     def socket_recv(self):
         """
         Called by TelnetServer when recv data is ready.
+        Returns the number of complete command lines received.
         """
         try:
             # Encode recieved bytes in ansi
             data = str(self.sock.recv(2048), "cp1252")
+        except (BlockingIOError, InterruptedError):
+            return 0
         except socket.error as err:
-            logger.error("RECEIVE socket error '{}' from {}".format(err, self.addrport()))
+            logger.error("RECEIVE socket error '%s' from %s", err, self.addrport())
             raise ConnectionLost()
 
         # Did they close the connection?
@@ -516,14 +1182,19 @@ class TelnetClient(object):
             self._iac_sniffer(byte)
 
         # Look for newline characters to get whole lines from the buffer
+        count = 0
         while True:
             mark = self.recv_buffer.find('\n')
             if mark == -1:
                 break
             cmd = self.recv_buffer[:mark].strip()
+            if self.command_list is None:
+                self.command_list = []
             self.command_list.append(cmd)
             self.cmd_ready = True
             self.recv_buffer = self.recv_buffer[mark + 1:]
+            count += 1
+        return count
 
     def _recv_byte(self, byte):
         """
@@ -562,7 +1233,11 @@ class TelnetClient(object):
             # Are we currenty in a sub-negotion?
             elif self.telnet_got_sb is True:
                 # Sanity check on length
-                if len(self.telnet_sb_buffer) < 64:
+                if self.telnet_sb_buffer[:1] == GMCP:
+                    limit = GMCP_MAX_LENGTH
+                else:
+                    limit = SB_MAX_LENGTH
+                if len(self.telnet_sb_buffer) < limit:
                     self.telnet_sb_buffer += byte
                 else:
                     self.telnet_got_sb = False
@@ -608,7 +1283,7 @@ class TelnetClient(object):
         """
         Handle incoming Telnet commands that are two bytes long.
         """
-        logger.debug("Got two byte cmd '{}'".format(ord(cmd)))
+        logger.debug("Got two byte cmd '%d'", ord(cmd))
 
         if cmd == SB:
             # Begin capturing a sub-negotiation string
@@ -645,7 +1320,7 @@ class TelnetClient(object):
         Handle incoming Telnet commands that are three bytes long.
         """
         cmd = self.telnet_got_cmd
-        logger.debug("Got three byte cmd {}:{}".format(ord(cmd), ord(option)))
+        logger.debug("Got three byte cmd %d:%d", ord(cmd), ord(option))
 
         # Incoming DO's and DONT's refer to the status of this end
         if cmd == DO:
@@ -662,6 +1337,32 @@ class TelnetClient(object):
                     if option == ECHO:
                         self.telnet_echo = True
 
+            elif option == GMCP:
+                if self._check_reply_pending(GMCP):
+                    self._note_reply_pending(GMCP, False)
+                    self._note_local_option(GMCP, True)
+                    self.gmcp = True
+
+                elif self._check_local_option(GMCP) is not True:
+                    self._note_local_option(GMCP, True)
+                    self._iac_will(GMCP)
+                    self.gmcp = True
+
+            elif option == MCCP2:
+                if self._check_reply_pending(MCCP2):
+                    self._note_reply_pending(MCCP2, False)
+                    self._note_local_option(MCCP2, True)
+                    self.start_compression()
+
+                elif self._check_local_option(MCCP2) is not True and self.compression_level:
+                    self._note_local_option(MCCP2, True)
+                    self._iac_will(MCCP2)
+                    self.start_compression()
+
+                elif not self.compression_level:
+                    self._note_local_option(MCCP2, False)
+                    self._iac_wont(MCCP2)
+
             else:
                 # All other options = Default to refusing once
                 if self._check_local_option(option) is UNKNOWN:
@@ -681,6 +1382,17 @@ class TelnetClient(object):
                     # Just nod unless setting echo
                     if option == ECHO:
                         self.telnet_echo = False
+
+            elif option == MCCP2:
+                self._note_reply_pending(MCCP2, False)
+                self._note_local_option(MCCP2, False)
+                self.end_compression()
+
+            elif option == GMCP:
+                self._note_reply_pending(GMCP, False)
+                self._note_local_option(GMCP, False)
+                self.gmcp = False
+
             else:
                 # All other options = Default to ignoring
                 pass
@@ -750,23 +1462,56 @@ class TelnetClient(object):
         Figures out what to do with a received sub-negotiation block.
         """
         bloc = self.telnet_sb_buffer
-        if len(bloc) > 2:
+        if bloc[:1] == GMCP and len(bloc) > 1:
+            self._gmcp_decoder(bloc[1:])
+
+        elif len(bloc) > 2:
 
             if bloc[0] == TTYPE and bloc[1] == IS:
                 self.terminal_type = bloc[2:]
-                logger.debug("Terminal type = '{}'".format(self.terminal_type))
+                logger.debug("Terminal type = '%s'", self.terminal_type)
 
             if bloc[0] == NAWS:
                 if len(bloc) != 5:
-                    logger.warning("Bad length on NAWS SB: " + str(len(bloc)))
+                    logger.warning("Bad length on NAWS SB: %d", len(bloc))
                 else:
                     self.columns = (256 * ord(bloc[1])) + ord(bloc[2])
                     self.rows = (256 * ord(bloc[3])) + ord(bloc[4])
 
-                logger.info("Screen is {} x {}".format(self.columns, self.rows))
+                logger.info("Screen is %d x %d", self.columns, self.rows)
 
         self.telnet_sb_buffer = ''
 
+    def _gmcp_decoder(self, message):
+        """
+        Handles a GMCP message from the client.  Core.Supports is tracked
+        here, anything else is left in gmcp_inbox for the game.
+        """
+        message = message.encode('cp1252', 'replace').decode('utf-8', 'replace')
+        package, _, text = message.partition(' ')
+        data = None
+        if text.strip():
+            try:
+                data = json.loads(text)
+            except ValueError:
+                logger.warning("Bad GMCP data for %s from %s", package, self.addrport())
+                return
+        key = package.lower()
+        if key in ('core.supports.set', 'core.supports.add', 'core.supports.remove'):
+            if key == 'core.supports.set' or self.gmcp_supports is None:
+                self.gmcp_supports = {}
+            for entry in data or []:
+                module, _, version = str(entry).partition(' ')
+                if key == 'core.supports.remove':
+                    self.gmcp_supports.pop(module, None)
+                else:
+                    self.gmcp_supports[module] = int(version) if version.isdigit() else 1
+            logger.debug("GMCP modules for %s: %s", self.addrport(), self.gmcp_supports)
+        elif self.gmcp_inbox is None:
+            self.gmcp_inbox = [(package, data)]
+        elif len(self.gmcp_inbox) < GMCP_INBOX_SIZE:
+            self.gmcp_inbox.append((package, data))
+
     # ---[ State Juggling for Telnet Options ]----------------------------------
 
     # Sometimes verbiage is tricky. I use 'note' rather than 'set' here
@@ -774,39 +1519,54 @@ class TelnetClient(object):
 
     def _check_local_option(self, option):
         """Test the status of local negotiated Telnet options."""
-        if option not in self.telnet_opt_dict:
-            self.telnet_opt_dict[option] = TelnetOption()
-        return self.telnet_opt_dict[option].local_option
+        bit = 1 << ord(option)
+        if not self.telnet_local_known & bit:
+            return UNKNOWN
+        return bool(self.telnet_local_on & bit)
 
     def _note_local_option(self, option, state):
         """Record the status of local negotiated Telnet options."""
-        if option not in self.telnet_opt_dict:
-            self.telnet_opt_dict[option] = TelnetOption()
-        self.telnet_opt_dict[option].local_option = state
+        bit = 1 << ord(option)
+        if state == UNKNOWN:
+            self.telnet_local_known &= ~bit
+            self.telnet_local_on &= ~bit
+        else:
+            self.telnet_local_known |= bit
+            if state:
+                self.telnet_local_on |= bit
+            else:
+                self.telnet_local_on &= ~bit
 
     def _check_remote_option(self, option):
         """Test the status of remote negotiated Telnet options."""
-        if option not in self.telnet_opt_dict:
-            self.telnet_opt_dict[option] = TelnetOption()
-        return self.telnet_opt_dict[option].remote_option
+        bit = 1 << ord(option)
+        if not self.telnet_remote_known & bit:
+            return UNKNOWN
+        return bool(self.telnet_remote_on & bit)
 
     def _note_remote_option(self, option, state):
-        """Record the status of local negotiated Telnet options."""
-        if option not in self.telnet_opt_dict:
-            self.telnet_opt_dict[option] = TelnetOption()
-        self.telnet_opt_dict[option].remote_option = state
+        """Record the status of remote negotiated Telnet options."""
+        bit = 1 << ord(option)
+        if state == UNKNOWN:
+            self.telnet_remote_known &= ~bit
+            self.telnet_remote_on &= ~bit
+        else:
+            self.telnet_remote_known |= bit
+            if state:
+                self.telnet_remote_on |= bit
+            else:
+                self.telnet_remote_on &= ~bit
 
     def _check_reply_pending(self, option):
         """Test the status of requested Telnet options."""
-        if option not in self.telnet_opt_dict:
-            self.telnet_opt_dict[option] = TelnetOption()
-        return self.telnet_opt_dict[option].reply_pending
+        return bool(self.telnet_pending & (1 << ord(option)))
 
     def _note_reply_pending(self, option, state):
         """Record the status of requested Telnet options."""
-        if option not in self.telnet_opt_dict:
-            self.telnet_opt_dict[option] = TelnetOption()
-        self.telnet_opt_dict[option].reply_pending = state
+        if state:
+            self.telnet_pending |= 1 << ord(option)
+        else:
+            self.telnet_pending &= ~(1 << ord(option))
 
     # ---[ Telnet Command Shortcuts ]-------------------------------------------
 
@@ -825,3 +1585,59 @@ class TelnetClient(object):
     def _iac_wont(self, option):
         """Send a Telnet IAC "WONT" sequence."""
         self.send("{}{}{}".format(IAC, WONT, option))
+
+
+# --[ Memory Benchmark ]--------------------------------------------------------
+def benchmark(count: int=10000):
+    """
+    Measures how much memory idle connections cost, by opening count of them
+    and comparing the process RSS before and after.  Only our end of each
+    socket pair is kept open, so this needs one file descriptor per connection.
+
+    :param count: Number of connections
+    :return: Bytes per connection for the TelnetClient alone, and in total
+    """
+    import gc
+    import resource
+    import sysutils
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = count + 64
+    if soft < wanted:
+        if hard != resource.RLIM_INFINITY and hard < wanted:
+            count = hard - 64
+            print("File descriptor limit is %d, only opening %d connections." % (hard, count))
+            wanted = hard
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+    negotiation = build_negotiation(INITIAL_NEGOTIATION)
+    gc.collect()
+    before = sysutils.ResourceSnapshot().process_memory(True)
+    sockets = []
+    for i in range(count):
+        ours, theirs = socket.socketpair()
+        theirs.close()
+        sockets.append(ours)
+    gc.collect()
+    opened = sysutils.ResourceSnapshot().process_memory(True)
+    clients = []
+    for i, sock in enumerate(sockets):
+        client = TelnetClient(sock, ('127.0.0.1', 10000 + i))
+        # What a fresh connection looks like after the opening negotiation.
+        client.telnet_pending |= negotiation[1]
+        client.telnet_echo = negotiation[2]
+        clients.append(client)
+    gc.collect()
+    after = sysutils.ResourceSnapshot().process_memory(True)
+
+    per_client = (after - opened) / count
+    per_connection = (after - before) / count
+    print("%d idle connections: %.0f bytes each for the TelnetClient, %.0f bytes each with its socket." % (
+        count, per_client, per_connection))
+    for sock in sockets:
+        sock.close()
+    return per_client, per_connection
+
+
+if __name__ == '__main__':
+    benchmark()
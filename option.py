@@ -6,7 +6,7 @@ from datetime import datetime
 import log_system
 from db_system import DataBase
 
-logger = log_system.init_logging()
+logger = log_system.init_logging(__name__)
 
 
 class Option(DataBase):
@@ -17,3 +17,6 @@ class Option(DataBase):
     port = Column(Integer, default=4400)
     wizlock = Column(Boolean, default=False)
     hotboot = Column(Boolean, default=False)
+    shards = Column(Integer, default=0)
+    gateway = Column(String, nullable=True)
+    websocket_port = Column(Integer, default=0)
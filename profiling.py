@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*- line endings: unix -*-
+__author__ = 'quixadhal'
+
+"""
+This module provides a sampling profiler which can be switched on and off
+while the game is running.
+
+When enabled, a background thread wakes up every few milliseconds, looks at
+what the game thread is doing, and counts the call stack it finds.  When it
+is stopped, the counts are written out in the "collapsed stack" format used
+by flamegraph.pl, speedscope, and friends:
+
+    phase;module:function;module:function 42
+
+The first element of each stack is the phase the game loop was in, which is
+simply whatever was last assigned to profiler.phase.  The main loop, the
+pulse categories and (eventually) the command interpreter set this as they
+go, so their cost shows up as separate towers in the flame graph.  Time
+spent inside miniboa's poll is further split into poll, recv and send.
+
+When the profiler is disabled, no thread exists, and the only cost to the
+game is those phase assignments.
+
+It can be turned on and off by an admin (toggle() or SIGUSR1), or it can
+switch itself on after a number of consecutive ticks overrun their slice.
+"""
+
+import os
+import sys
+import time
+import signal
+import threading
+from collections import Counter
+import log_system
+
+logger = log_system.init_logging(__name__)
+
+PROFILE_DIR = 'profiles'
+
+# Functions inside miniboa's poll which mark a more specific network phase.
+NETWORK_PHASES = {
+    'socket_recv': 'recv',
+    'socket_send': 'send',
+}
+
+
+class SamplingProfiler(object):
+    """
+    Periodically samples the call stack of one thread (the game loop).
+    """
+
+    def __init__(self, interval: float=0.005, auto_trigger: int=0, auto_duration: float=10.0):
+        """
+        :param interval: Seconds between samples
+        :param auto_trigger: Start automatically after this many consecutive
+            overruns, or never if 0
+        :param auto_duration: How long an automatic run lasts, in seconds
+        """
+        self.interval = interval
+        self.auto_trigger = auto_trigger
+        self.auto_duration = auto_duration
+        self.phase = 'idle'
+        self.enabled = False
+        self.toggle_requested = False
+        self.last_output = None
+        self._target = threading.get_ident()
+        self._stacks = Counter()
+        self._samples = 0
+        self._started = 0.0
+        self._deadline = None
+        self._overruns = 0
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._lock = threading.RLock()
+
+    def start(self, duration: float=None):
+        """
+        Begins sampling the thread that created this profiler.
+
+        :param duration: If given, stop (and write output) after this many seconds
+        :return:
+        """
+        with self._lock:
+            if self.enabled:
+                return
+            self._stacks = Counter()
+            self._samples = 0
+            self._started = time.time()
+            self._deadline = self._started + duration if duration else None
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self.enabled = True
+            self._thread.start()
+        logger.info('Profiler started, sampling every %.1fms.', self.interval * 1000.0)
+
+    def stop(self):
+        """
+        Stops sampling and writes the collected stacks to disk.
+
+        :return: The filename written, or None
+        """
+        with self._lock:
+            if not self.enabled:
+                return None
+            self.enabled = False
+            self._stop_event.set()
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        return self.write()
+
+    def request_toggle(self):
+        """
+        Asks the main loop to toggle the profiler at the start of its next
+        tick.  This is all a signal handler should do, since stopping joins
+        the sampler thread and writes a file.
+        """
+        self.toggle_requested = True
+
+    def toggle(self):
+        self.toggle_requested = False
+        if self.enabled:
+            return self.stop()
+        self.start()
+
+    def note_tick(self, overrun: bool):
+        """
+        Called by the main loop once per tick, so the profiler can start
+        itself when the game keeps running over its time slice.
+
+        :param overrun: True if this tick took longer than the pulse width
+        :return:
+        """
+        if not overrun:
+            self._overruns = 0
+            return
+        self._overruns += 1
+        if self.auto_trigger and self._overruns >= self.auto_trigger and not self.enabled:
+            logger.warning('%d consecutive overruns, starting profiler for %.1f seconds.',
+                           self._overruns, self.auto_duration)
+            self.start(self.auto_duration)
+
+    def phase_summary(self):
+        """
+        Returns the estimated number of seconds spent in each phase
+        during the most recent run.
+
+        :return: dict of phase name to seconds
+        """
+        totals = Counter()
+        for stack, count in self._stacks.items():
+            totals[stack.split(';', 1)[0]] += count
+        return {phase: count * self.interval for phase, count in totals.items()}
+
+    def write(self, filename: str=None):
+        """
+        Writes the collected stacks in collapsed format.
+
+        :param filename: Output file, default is a timestamped one in PROFILE_DIR
+        :return: The filename written, or None if nothing was collected
+        """
+        if not self._stacks:
+            logger.info('Profiler collected no samples.')
+            return None
+        if filename is None:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            filename = os.path.join(PROFILE_DIR, time.strftime('pykumud-%Y%m%d-%H%M%S.folded',
+                                                               time.localtime(self._started)))
+        with open(filename, 'w') as fp:
+            for stack, count in sorted(self._stacks.items()):
+                fp.write('%s %d\n' % (stack, count))
+        self.last_output = filename
+        logger.info('Profiler wrote %d samples to %s', self._samples, filename)
+        return filename
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is not None:
+                self._stacks[self._collapse(frame)] += 1
+                self._samples += 1
+            if self._deadline is not None and time.time() >= self._deadline:
+                self.stop()
+                return
+
+    def _collapse(self, frame):
+        """
+        Turns a frame into a collapsed stack string, outermost call first,
+        prefixed with the phase the game loop was in.
+        """
+        names = []
+        phase = self.phase
+        network = None
+        while frame is not None:
+            code = frame.f_code
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            names.append('%s:%s' % (module, code.co_name))
+            if network is None and module == 'miniboa':
+                network = NETWORK_PHASES.get(code.co_name)
+            frame = frame.f_back
+        names.reverse()
+        if phase == 'network':
+            phase = 'network:' + (network or 'poll')
+        return ';'.join([phase] + names)
+
+
+profiler = SamplingProfiler(auto_trigger=5)
+
+
+def install_signal_handler():
+    """
+    Lets an admin toggle the profiler from the shell with kill -USR1.  The
+    main loop does the actual toggling, at the top of its next tick.
+    """
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.request_toggle())
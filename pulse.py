@@ -17,9 +17,14 @@ from sqlalchemy import orm
 import time
 import random
 import log_system
+import metrics
+from profiling import profiler
 from db_system import DataBase
 
-logger = log_system.init_logging()
+logger = log_system.init_logging(__name__)
+
+# The update categories, in the order they are checked each tick.
+CATEGORIES = ('violence', 'river', 'teleport', 'nature', 'mobile', 'sound', 'zone', 'update', 'resource')
 
 
 class Pulse(DataBase):
@@ -44,49 +49,59 @@ class Pulse(DataBase):
     zone = Column(Float, default=60.0)  # zone updates
     update = Column(Float, default=70.0)  # weather, spell effects, healing
     variation = Column(Float, default=7.5)  # variability in update
+    resource = Column(Float, default=30.0)  # driver resource sampling
 
     def __init__(self):
         self._point = dict()
+        self._timers = dict()
+        self._handlers = dict()
 
     @orm.reconstructor
     def init_on_load(self):
         now = time.time()
         self._point = dict()
-        self._point['violence'] = now + self.violence
-        self._point['river'] = now + self.river
-        self._point['teleport'] = now + self.teleport
-        self._point['nature'] = now + self.nature
-        self._point['mobile'] = now + self.mobile
-        self._point['sound'] = now + self.sound
-        self._point['zone'] = now + self.zone
-        self._point['update'] = now + self.update
+        self._timers = dict()
+        self._handlers = dict()
+        for category in CATEGORIES:
+            self._point[category] = now + getattr(self, category)
+            self._timers[category] = metrics.pulse_seconds(category)
         logger.debug('now == %s (%f)', time.ctime(now), now)
         logger.debug('tick len == %f', self.violence)
         logger.debug('tick time == %s (%f)', time.ctime(self._point['violence']), self._point['violence'])
 
+    def add_handler(self, category: str, handler):
+        """
+        Arranges for handler() to be called each time the given category
+        of updates comes due.
+
+        :param category: One of the CATEGORIES
+        :param handler: A callable taking no arguments
+        :return:
+        """
+        if category not in CATEGORIES:
+            raise ValueError('Unknown pulse category %r' % category)
+        self._handlers.setdefault(category, []).append(handler)
+
+    def next_interval(self, category: str):
+        """
+        Returns the number of seconds until the given category should be run
+        again.  General updates are fuzzed, so they aren't predictable.
+
+        :param category: One of the CATEGORIES
+        :return: seconds
+        """
+        if category == 'update':
+            return self.update + random.uniform(-self.variation, self.variation)
+        return getattr(self, category)
+
     def perform_updates(self):
         now = time.time()
-        if now >= self._point['violence']:
-            logger.debug('Doing violence')
-            self._point['violence'] = time.time() + self.violence
-        if now >= self._point['river']:
-            logger.debug('Doing river')
-            self._point['river'] = time.time() + self.river
-        if now >= self._point['teleport']:
-            logger.debug('Doing teleport')
-            self._point['teleport'] = time.time() + self.teleport
-        if now >= self._point['nature']:
-            logger.debug('Doing nature')
-            self._point['nature'] = time.time() + self.nature
-        if now >= self._point['mobile']:
-            logger.debug('Doing mobile')
-            self._point['mobile'] = time.time() + self.mobile
-        if now >= self._point['sound']:
-            logger.debug('Doing sound')
-            self._point['sound'] = time.time() + self.sound
-        if now >= self._point['zone']:
-            logger.debug('Doing zone')
-            self._point['zone'] = time.time() + self.zone
-        if now >= self._point['update']:
-            logger.debug('Doing update')
-            self._point['update'] = time.time() + self.update + random.uniform(-self.variation, self.variation)
+        for category in CATEGORIES:
+            if now >= self._point[category]:
+                start = time.time()
+                profiler.phase = 'pulse:' + category
+                logger.debug('Doing %s', category)
+                for handler in self._handlers.get(category, ()):
+                    handler()
+                self._point[category] = time.time() + self.next_interval(category)
+                self._timers[category].observe(time.time() - start)
@@ -8,13 +8,23 @@ import sysutils
 import log_system
 import db_system
 import miniboa
+import metrics
+import event_log
+import hotboot
+import shard
+import gateway
+import snapshot
+import websocket_gateway
+from auth_service import AuthService
+from profiling import profiler, install_signal_handler
 
 
-logger = log_system.init_logging()
+logger = log_system.init_logging(__name__)
 sys.path.append(os.getcwd())
 
 
 def PykuMUD():
+    event_log.start_event_log()
     logger.boot('System booting.')
     start_snapshot = sysutils.ResourceSnapshot()
     logger.boot(start_snapshot.log_data())
@@ -26,21 +36,116 @@ def PykuMUD():
     logger.boot('Using database version %s, created on %s', options.version, options.date_created)
     from pulse import Pulse
     pulse = session.query(Pulse).first()
-    server = miniboa.TelnetServer(port=options.port, timeout=0.0)
+    sampler = sysutils.ResourceSampler()
+    pulse.add_handler('resource', sampler.sample)
+    server = None
+    server_class = gateway.GatewayServer if options.gateway else miniboa.TelnetServer
+    if options.hotboot:
+        server = hotboot.restore(session, options, server_class, timeout=0.0)
+    if server is None:
+        if options.gateway:
+            server = gateway.GatewayServer(options.gateway, timeout=0.0)
+        else:
+            server = miniboa.TelnetServer(port=options.port, timeout=0.0)
+    servers = [server]
+    watched = {server: metrics.watch_telnet_server(server, 'gateway' if options.gateway else 'telnet')}
+    websockets = None
+    if options.websocket_port:
+        websockets = websocket_gateway.WebSocketServer(port=options.websocket_port, timeout=0.0)
+        servers.append(websockets)
+        watched[websockets] = metrics.watch_telnet_server(websockets, 'websocket')
+        logger.boot('WebSocket gateway ready on port %d', options.websocket_port)
+    # Idle until the login prompts exist, see Login.check_password().
+    auth_service = AuthService()
+    install_signal_handler()
+    hotboot.install_signal_handler()
+    shards = None
+    if options.shards:
+        zones = shard.read_zone_ranges()
+        shards = shard.ShardManager(zones, options.shards, shard.count_rooms(zones))
+        shards.start()
     logger.boot('PykuMUD ready on port %d', options.port)
     import web
     web.start_web_server()
+    snapshot_writer = snapshot.SnapshotWriter()
+    who_writer = snapshot.SnapshotWriter(snapshot.WHO_FILE, snapshot.WHO_SIZE)
+    next_who = 0.0
+    boot_time = time.time()
+    tick = 0
+    client_count = sum(s.client_count() for s in servers)
     done = False
     while not done:
+        if hotboot.requested:
+            if shards is not None:
+                shards.stop()
+            if websockets is not None:
+                # Browsers can't be handed over, they just reconnect.
+                websockets.stop()
+            hotboot.perform(server, session, options)
+            # Still here, so the exec failed.  Reopen what was shut down for it.
+            if shards is not None:
+                shards.start()
+            if websockets is not None:
+                servers.remove(websockets)
+                metrics.registry.remove_collector(watched.pop(websockets))
+                websockets = websocket_gateway.WebSocketServer(port=options.websocket_port, timeout=0.0)
+                servers.append(websockets)
+                watched[websockets] = metrics.watch_telnet_server(websockets, 'websocket')
+        if profiler.toggle_requested:
+            profiler.toggle()
         top_of_loop = time.time()
+        sampler.tick()
+        profiler.phase = 'network'
         server.poll()
+        if websockets is not None:
+            websockets.poll()
+        if sum(s.client_count() for s in servers) != client_count:
+            client_count = sum(s.client_count() for s in servers)
+            web.page_cache.invalidate()
+        auth_service.poll()
         # process input
+        if shards is not None:
+            # File descriptors aren't unique across servers, client_id is.
+            by_id = {}
+            for s in servers:
+                for client in s.client_list():
+                    by_id[client.client_id] = client
+                    while client.active and client.cmd_ready:
+                        shards.route_command(client.client_id, client.get_command())
+            for client_id in [k for k in shards.rooms if k not in by_id]:
+                shards.forget(client_id)
+            for client_id, text in shards.poll():
+                client = by_id.get(client_id)
+                if client is not None:
+                    client.send(text)
         pulse.perform_updates()
+        profiler.phase = 'network'
+        for s in servers:
+            s.flush_gmcp()
+            s.flush()
+        profiler.phase = 'idle'
+        tick += 1
         time_spent = time.time() - top_of_loop
+        snapshot_writer.publish({
+            'tick': tick,
+            'time': top_of_loop,
+            'boot_time': boot_time,
+            'connections': client_count,
+            'commands': sum(s.commands_received for s in servers),
+            'tick_seconds': time_spent,
+            'overruns': metrics.tick_overruns.value,
+        })
+        if top_of_loop >= next_who:
+            next_who = top_of_loop + snapshot.WHO_INTERVAL
+            who_writer.publish(snapshot.who_summary([c for s in servers for c in s.client_list()],
+                                                    shards.rooms if shards is not None else None))
+        metrics.tick_seconds.observe(time_spent)
         nap_time = pulse.width - time_spent
+        profiler.note_tick(nap_time <= 0.0)
         if nap_time > 0.0:
             time.sleep(nap_time)
         else:
+            metrics.tick_overruns.inc()
             logger.warn('Exceeded time slice by %.3f seconds!', abs(nap_time))
 
     logger.critical('System halted.')
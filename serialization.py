@@ -5,9 +5,58 @@ import re
 from collections import OrderedDict, namedtuple
 import copy
 import json
+import os
+import time
+import queue
+import struct
+import threading
+import hashlib
+import importlib
 import log_system
 
-logger = log_system.init_logging()
+logger = log_system.init_logging(__name__)
+
+# Matches the "__class__/module.Class" keys written by to_json() methods.
+CLASS_TAG = re.compile(r'__class__/((?:\w+)\.)*(\w+)')
+
+# (module name, class name, import_module override) -> class
+_class_cache = {}
+
+# "__class__/module.Class" tag -> class, filled in by @register_class
+_class_registry = {}
+
+# (type name, field names) -> namedtuple class
+_namedtuple_cache = {}
+
+
+def register_class(cls):
+    """
+    Class decorator which maps a class's "__class__/module.Class" tag to
+    the class itself, so from_json() can find it without any imports.
+    The class needs to_json() and from_json() methods, as ExampleThing has.
+
+    :param cls: The class to register
+    :return: The same class
+    """
+    _class_registry['__class__/' + cls.__module__ + '.' + cls.__name__] = cls
+    return cls
+
+
+def namedtuple_type(type_name: str, fields):
+    """
+    Returns the namedtuple class with the given name and fields, creating
+    it only the first time it is asked for.
+
+    :param type_name: Name of the namedtuple type
+    :param fields: Sequence of field names
+    :return: namedtuple class
+    """
+    key = (type_name, tuple(fields))
+    nt_class = _namedtuple_cache.get(key)
+    if nt_class is None:
+        nt_class = namedtuple(type_name, key[1])
+        _namedtuple_cache[key] = nt_class
+    return nt_class
 
 
 def isnamedtuple(obj):
@@ -115,43 +164,33 @@ def from_json(data):
     if data is None or isinstance(data, (bool, int, float, str)):
         return data
 
-    # Basic types we've labeled are easy to reconstruct.
-    if "__type__/tuple" in data:
-        return tuple(data["__type__/tuple"])
-
-    if "__type__/set" in data:
-        return set(data["__type__/set"])
-
-    if "__type__/dict" in data:
-        return dict(data["__type__/dict"])
-
-    # In the case of an OrderedDict(), we just pass the data to the class.
-    if "__type__/OrderedDict" in data:
-        return OrderedDict(data["__type__/OrderedDict"])
-
-    # For a namedtuple, we have to rebuild it as a class and then make an instance.
-    if "__type__/namedtuple" in data:
-        tmp = data["__type__/namedtuple"]
-        return namedtuple(tmp["type"], tmp["fields"])(*tmp["values"])
-
-    # If we're a dict, we can check to see if we're a custom class.
-    # If we are, we need to find out class definition and make sure
-    # there's a from_json() method to call.  If so, let it handle things.
+    # Every tagged dict has its tag as a key, so one dict lookup per key
+    # finds both our basic types and any registered class.
     if hasattr(data, 'keys'):
-        for k in data.keys():
-            found = re.findall('__class__/((?:\w+)\.)*(\w+)', k)
+        for k in data:
+            decoder = _TYPE_DECODERS.get(k)
+            if decoder is not None:
+                return decoder(data[k])
+            class_ref = _class_registry.get(k)
+            if class_ref is not None:
+                return class_ref.from_json(data, from_json)
+
+            # A class nobody registered.  We need to find its definition and
+            # make sure there's a from_json() method to call.  If so, let it
+            # handle things, and remember it for next time.
+            if not k.startswith('__class__/'):
+                continue
+            found = CLASS_TAG.match(k)
             if found:
-                import importlib
-                module_name = found[0][0].rstrip('.')
-                class_name = found[0][1]
+                module_name = (found.group(1) or '').rstrip('.')
+                class_name = found.group(2)
 
                 if module_name != '' and class_name != '':
-                    if data[k].get('import_module', None):
-                        module_ref = importlib.import_module(data[k]['import_module'])
-                    else:
-                        module_ref = importlib.import_module(module_name)
-                    class_ref = getattr(module_ref, class_name)
+                    import_module = data[k].get('import_module', None)
+                    class_ref = _resolve_class(module_name, class_name, import_module)
                     if hasattr(class_ref, 'from_json'):
+                        if import_module is None:
+                            _class_registry[k] = class_ref
                         return class_ref.from_json(data, from_json)
 
     # If we have no idea, return whatever we are and hope someone else
@@ -159,37 +198,587 @@ def from_json(data):
     return data
 
 
-def pack(data):
+def _namedtuple_from_json(tmp):
+    return namedtuple_type(tmp["type"], tmp["fields"])(*tmp["values"])
+
+
+# Basic types we've labeled are easy to reconstruct.
+_TYPE_DECODERS = {
+    "__type__/tuple": tuple,
+    "__type__/set": set,
+    "__type__/dict": dict,
+    # In the case of an OrderedDict(), we just pass the data to the class.
+    "__type__/OrderedDict": OrderedDict,
+    # For a namedtuple, we have to find (or build) its class and then make an instance.
+    "__type__/namedtuple": _namedtuple_from_json,
+}
+
+
+def _resolve_class(module_name: str, class_name: str, import_module: str or None=None):
+    """
+    Finds the class named by a "__class__/" tag, importing its module the
+    first time it is seen, and remembering the answer after that.
+
+    :param module_name: Module named in the tag
+    :param class_name: Class named in the tag
+    :param import_module: Optional module to import instead
+    :return: The class
+    """
+    key = (module_name, class_name, import_module)
+    class_ref = _class_cache.get(key)
+    if class_ref is None:
+        module_ref = importlib.import_module(import_module or module_name)
+        class_ref = getattr(module_ref, class_name)
+        _class_cache[key] = class_ref
+    return class_ref
+
+
+class JsonCodec(object):
+    """
+    The original, human readable format: JSON text with tagged dicts for
+    anything JSON can't hold natively.
+    """
+    name = 'json'
+
+    def encode(self, data):
+        return json.dumps(data, default=to_json, sort_keys=True)
+
+    def decode(self, blob):
+        if isinstance(blob, (bytes, bytearray, memoryview)):
+            blob = bytes(blob).decode('utf-8')
+        return json.loads(blob, object_hook=from_json)
+
+
+class BinaryCodec(object):
+    """
+    A compact binary encoding of the same tagged structure the JSON codec
+    writes, using only the standard library.
+
+    Every value is a one byte tag followed by its payload.  Integers are
+    stored in the smallest of 1, 4 or 8 bytes that holds them, and dict keys
+    are written out once and then referred to by number, so the field names
+    and "__type__/" tags repeated across thousands of objects cost a few
+    bytes each instead of their full length.
+
+    Decoding calls from_json() on every dict, innermost first, exactly as
+    json.loads() does with object_hook.
+    """
+    name = 'binary'
+    MAGIC = b'PKB\x01'
+
+    _int8 = struct.Struct('<b')
+    _int32 = struct.Struct('<i')
+    _int64 = struct.Struct('<q')
+    _uint32 = struct.Struct('<I')
+    _float = struct.Struct('<d')
+
+    def encode(self, data):
+        out = bytearray(self.MAGIC)
+        self._encode(to_json(data), out, {})
+        return bytes(out)
+
+    def _encode(self, value, out, keys):
+        if value is None:
+            out += b'N'
+        elif value is True:
+            out += b'T'
+        elif value is False:
+            out += b'F'
+        elif isinstance(value, int):
+            if -128 <= value <= 127:
+                out += b'b'
+                out += self._int8.pack(value)
+            elif -2147483648 <= value <= 2147483647:
+                out += b'j'
+                out += self._int32.pack(value)
+            elif -9223372036854775808 <= value <= 9223372036854775807:
+                out += b'i'
+                out += self._int64.pack(value)
+            else:
+                raw = str(value).encode('ascii')
+                out += b'I'
+                out += self._uint32.pack(len(raw))
+                out += raw
+        elif isinstance(value, float):
+            out += b'f'
+            out += self._float.pack(value)
+        elif isinstance(value, str):
+            raw = value.encode('utf-8')
+            out += b's'
+            out += self._uint32.pack(len(raw))
+            out += raw
+        elif isinstance(value, (list, tuple)):
+            out += b'l'
+            out += self._uint32.pack(len(value))
+            for item in value:
+                self._encode(item, out, keys)
+        elif isinstance(value, dict):
+            out += b'd'
+            out += self._uint32.pack(len(value))
+            for k in sorted(value):
+                index = keys.get(k)
+                if index is None:
+                    keys[k] = len(keys)
+                    raw = k.encode('utf-8')
+                    out += b'K'
+                    out += self._uint32.pack(len(raw))
+                    out += raw
+                else:
+                    out += b'k'
+                    out += self._uint32.pack(index)
+                self._encode(value[k], out, keys)
+        else:
+            # to_json() has already dealt with anything it knows about.
+            raise TypeError('Type %r not data-serializable' % type(value))
+
+    def decode(self, blob):
+        blob = bytes(blob)
+        if not blob.startswith(self.MAGIC):
+            raise ValueError('Not a binary serialization')
+        value, offset = self._decode(blob, len(self.MAGIC), [])
+        return value
+
+    def _decode(self, blob, offset, keys):
+        tag = blob[offset:offset + 1]
+        offset += 1
+        if tag == b'd':
+            count = self._uint32.unpack_from(blob, offset)[0]
+            offset += 4
+            data = {}
+            for _ in range(count):
+                key_tag = blob[offset:offset + 1]
+                if key_tag == b'k':
+                    k = keys[self._uint32.unpack_from(blob, offset + 1)[0]]
+                    offset += 5
+                else:
+                    size = self._uint32.unpack_from(blob, offset + 1)[0]
+                    offset += 5
+                    k = blob[offset:offset + size].decode('utf-8')
+                    offset += size
+                    keys.append(k)
+                data[k], offset = self._decode(blob, offset, keys)
+            return from_json(data), offset
+        if tag == b's':
+            size = self._uint32.unpack_from(blob, offset)[0]
+            offset += 4
+            return blob[offset:offset + size].decode('utf-8'), offset + size
+        if tag == b'b':
+            return self._int8.unpack_from(blob, offset)[0], offset + 1
+        if tag == b'j':
+            return self._int32.unpack_from(blob, offset)[0], offset + 4
+        if tag == b'l':
+            count = self._uint32.unpack_from(blob, offset)[0]
+            offset += 4
+            items = []
+            for _ in range(count):
+                item, offset = self._decode(blob, offset, keys)
+                items.append(item)
+            return items, offset
+        if tag == b'N':
+            return None, offset
+        if tag == b'T':
+            return True, offset
+        if tag == b'F':
+            return False, offset
+        if tag == b'f':
+            return self._float.unpack_from(blob, offset)[0], offset + 8
+        if tag == b'i':
+            return self._int64.unpack_from(blob, offset)[0], offset + 8
+        if tag == b'I':
+            size = self._uint32.unpack_from(blob, offset)[0]
+            offset += 4
+            return int(blob[offset:offset + size].decode('ascii')), offset + size
+        raise ValueError('Bad tag %r at offset %d' % (tag, offset - 1))
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    """
+    Makes a codec available to pack() by name.
+    """
+    CODECS[codec.name] = codec
+    return codec
+
+register_codec(JsonCodec())
+register_codec(BinaryCodec())
+
+
+def pack(data, codec: str='json'):
     """
     A convenience method to avoid having to remember all the arguments.
     :param data: Thing to be serialized
-    :return: String representation of thing
+    :param codec: Name of the codec to use, 'json' or 'binary'
+    :return: String (or bytes) representation of thing
     """
-    js = json.dumps(data, default=to_json, sort_keys=True)
-    return js
+    return CODECS[codec].encode(data)
 
 
 def unpack(jso):
     """
     A convenience method to avoid having to remember all the arguments.
+    Binary data is recognized by its header, anything else is taken as JSON.
     :param jso: Thing to be deserialized
     :return: Thing
     """
-    obj = json.loads(jso, object_hook=from_json)
-    return obj
+    if isinstance(jso, (bytes, bytearray, memoryview)) and bytes(jso[:4]) == BinaryCodec.MAGIC:
+        return CODECS['binary'].decode(jso)
+    return CODECS['json'].decode(jso)
+
+
+class DirtyTracking(object):
+    """
+    Mixin which remembers which attributes have been assigned since the
+    object was last saved, so periodic saves can skip anything unchanged.
+
+    Assignment is caught automatically.  Changing a list or dict in place
+    is not, so code doing that should call mark_dirty() itself.
+
+    After a save, the md5 of what was written is kept in _md5.  If an object
+    was touched but ends up serializing to the same thing, it isn't written
+    again.  _last_saved holds the time of the last save.
+    """
+    __slots__ = ()
+    TRANSIENT = ('_last_saved', '_md5', '_dirty')
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name not in DirtyTracking.TRANSIENT:
+            self.mark_dirty(name)
+
+    def mark_dirty(self, name: str='*'):
+        """
+        Flags an attribute (or, by default, the whole object) as changed.
+        """
+        dirty = getattr(self, '_dirty', None)
+        if dirty is None:
+            object.__setattr__(self, '_dirty', {name})
+        else:
+            dirty.add(name)
+
+    def mark_clean(self, md5: str or None=None, when: float or None=None):
+        """
+        Records that the object has been saved (or freshly loaded).
+        """
+        object.__setattr__(self, '_dirty', None)
+        if md5 is not None:
+            object.__setattr__(self, '_md5', md5)
+        object.__setattr__(self, '_last_saved', when)
+
+    @property
+    def is_dirty(self):
+        return bool(getattr(self, '_dirty', None))
+
+    def dirty_attributes(self):
+        """
+        Returns the set of attribute names changed since the last save.
+        """
+        return set(getattr(self, '_dirty', None) or ())
+
+    def save_key(self):
+        """
+        Returns the identity an object is saved under.  Later records with
+        the same key replace earlier ones when loading.
+        """
+        return getattr(self, 'instance_id', None) or getattr(self, 'vnum', None)
+
+
+FRAME_MAGIC = b'PKF\x01'
+_frame_header = struct.Struct('<I')
+
+
+class RecordWriter(object):
+    """
+    Writes a sequence of serialized objects to a binary file, one record
+    at a time, so nothing ever has to hold the whole sequence in memory.
+
+    With the json codec, records are newline-delimited, which keeps the file
+    readable (and greppable).  With the binary codec, the file starts with
+    FRAME_MAGIC and each record is prefixed with its length.
+    """
+
+    def __init__(self, fp, codec: str='json'):
+        self.fp = fp
+        self.codec = CODECS[codec]
+        self.framed = codec != 'json'
+        if self.framed and fp.tell() == 0:
+            fp.write(FRAME_MAGIC)
+
+    def encode(self, data):
+        """
+        Returns the bytes which write() would append for data.
+        """
+        return self.frame(self.codec.encode(data))
+
+    def frame(self, blob):
+        """
+        Wraps an already encoded record for this file.
+        """
+        if self.framed:
+            return _frame_header.pack(len(blob)) + blob
+        return blob.encode('utf-8') + b'\n'
+
+    def write(self, data):
+        self.fp.write(self.encode(data))
+
+    def write_many(self, items):
+        for data in items:
+            self.fp.write(self.encode(data))
+
+
+def iter_records(fp):
+    """
+    Lazily decodes the records in a file written by RecordWriter,
+    recognizing which format it is from the first few bytes.
+
+    :param fp: File opened in binary mode
+    :return: generator of objects
+    """
+    head = fp.read(len(FRAME_MAGIC))
+    if head == FRAME_MAGIC:
+        codec = CODECS['binary']
+        while True:
+            header = fp.read(_frame_header.size)
+            if len(header) < _frame_header.size:
+                return
+            size = _frame_header.unpack(header)[0]
+            blob = fp.read(size)
+            if len(blob) < size:
+                raise ValueError('Truncated record in %s' % getattr(fp, 'name', 'stream'))
+            yield codec.decode(blob)
+    else:
+        codec = CODECS['json']
+        first = head + fp.readline()
+        if first.strip():
+            yield codec.decode(first)
+        for line in fp:
+            if line.strip():
+                yield codec.decode(line)
+
+
+def prefetch(records, size: int=256):
+    """
+    Runs a record generator in a background thread, handing finished
+    objects over through a bounded queue.  Loading can then overlap with
+    other boot work (the file reads release the GIL), while never holding
+    more than size objects that haven't been consumed yet.
+
+    :param records: Any iterable, usually from iter_records()
+    :param size: Most objects to decode ahead of the consumer
+    :return: generator of objects
+    """
+    done = object()
+    pipe = queue.Queue(size)
+    failure = []
+    stop = threading.Event()
+
+    def hand_over(item):
+        # Gives up if the consumer has gone away, rather than blocking forever.
+        while not stop.is_set():
+            try:
+                pipe.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in records:
+                if not hand_over(item):
+                    return
+        except Exception as err:
+            failure.append(err)
+        hand_over(done)
+
+    threading.Thread(target=producer, name='prefetch', daemon=True).start()
+    try:
+        while True:
+            item = pipe.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        # Runs when the consumer stops early too (close() or garbage collection).
+        stop.set()
+    if failure:
+        raise failure[0]
+
+
+def _record_codec(fp):
+    """
+    Works out which codec a file written by RecordWriter uses, from its
+    first few bytes, and rewinds it.
+
+    :param fp: Seekable file opened in binary mode
+    :return: Codec name, or None if the file is empty
+    """
+    fp.seek(0)
+    head = fp.read(len(FRAME_MAGIC))
+    fp.seek(0)
+    if not head:
+        return None
+    return 'binary' if head == FRAME_MAGIC else 'json'
+
+
+def _raw_records(fp):
+    """
+    Walks the records in a file written by RecordWriter without decoding
+    them.
+
+    :param fp: Seekable file opened in binary mode
+    :return: generator of (offset, raw, blob), where raw is the whole record
+        as stored (framing included) and blob is the encoded record itself
+    """
+    if _record_codec(fp) == 'binary':
+        offset = len(FRAME_MAGIC)
+        fp.seek(offset)
+        while True:
+            header = fp.read(_frame_header.size)
+            if len(header) < _frame_header.size:
+                return
+            size = _frame_header.unpack(header)[0]
+            blob = fp.read(size)
+            if len(blob) < size:
+                raise ValueError('Truncated record in %s' % getattr(fp, 'name', 'stream'))
+            yield offset, header + blob, blob
+            offset += _frame_header.size + size
+    else:
+        offset = 0
+        for line in fp:
+            if line.strip():
+                yield offset, line, line
+            offset += len(line)
 
 
-class ExampleThing(object):
+def save_changed(objects, filename: str, codec: str='json'):
+    """
+    Appends every dirty object in objects to a save file, as one batch.
+
+    Only objects that were changed since the last save are serialized, and
+    the whole batch goes out in a single write and fsync, so saving a world
+    where 1% of objects changed costs about 1% of saving all of it.
+
+    Each record is a dict holding the object's save_key() and the object,
+    written with RecordWriter.
+
+    :param objects: Iterable of DirtyTracking objects
+    :param filename: Save file to append to
+    :param codec: Codec name, which must match the file's if it already exists
+    :return: Number of objects written
+    """
+    now = time.time()
+    batch = []
+    with open(filename, 'ab+') as fp:
+        existing = _record_codec(fp)
+        if existing is not None and existing != codec:
+            raise ValueError('%s holds %s records, not %s' % (filename, existing, codec))
+        fp.seek(0, os.SEEK_END)
+        writer = RecordWriter(fp, codec)
+        for obj in objects:
+            if not obj.is_dirty:
+                continue
+            key = obj.save_key()
+            if key is None:
+                raise ValueError('%r has no save key' % obj)
+            blob = writer.codec.encode({'key': key, 'data': obj})
+            md5 = hashlib.md5(blob.encode('utf-8') if isinstance(blob, str) else blob).hexdigest()
+            if md5 != getattr(obj, '_md5', None):
+                batch.append(writer.frame(blob))
+            obj.mark_clean(md5, now)
+        if batch:
+            fp.write(b''.join(batch))
+            fp.flush()
+            os.fsync(fp.fileno())
+    return len(batch)
+
+
+def iter_saved(filename: str):
+    """
+    Yields (key, object) for every record in a save file, oldest first.
+    Objects come back clean, with the md5 of the record they were read
+    from, so save_changed() skips them until they really change.
+    """
+    with open(filename, 'rb') as fp:
+        codec = CODECS[_record_codec(fp) or 'json']
+        for offset, raw, blob in _raw_records(fp):
+            if codec.name == 'json':
+                blob = blob.rstrip(b'\r\n')
+            record = codec.decode(blob)
+            obj = record['data']
+            if isinstance(obj, DirtyTracking):
+                obj.mark_clean(hashlib.md5(blob).hexdigest())
+            yield record['key'], obj
+
+
+def load_saved(filename: str):
+    """
+    Reads a save file written by save_changed(), keeping only the newest
+    record for each key.
+
+    :param filename: Save file to read
+    :return: dict of save key to object
+    """
+    return dict(iter_saved(filename))
+
+
+def compact_saved(filename: str, codec: str='json'):
+    """
+    Rewrites a save file so it only holds the newest record for each key.
+
+    The file is streamed twice.  The first pass decodes one record at a
+    time, only to find its key, and remembers where the newest record for
+    each key is.  The second copies those records across as they are,
+    unless the file is being converted to another codec.
+    """
+    with open(filename, 'rb') as source:
+        source_codec = _record_codec(source)
+        if source_codec is None:
+            return
+        decoder = CODECS[source_codec]
+        latest = {}
+        for offset, raw, blob in _raw_records(source):
+            latest[decoder.decode(blob)['key']] = (offset, len(raw))
+        temp_name = filename + '.tmp'
+        with open(temp_name, 'wb') as fp:
+            writer = RecordWriter(fp, codec)
+            for offset, size in sorted(latest.values()):
+                source.seek(offset)
+                raw = source.read(size)
+                if codec == source_codec:
+                    fp.write(raw if writer.framed or raw.endswith(b'\n') else raw + b'\n')
+                else:
+                    blob = raw[_frame_header.size:] if source_codec == 'binary' else raw
+                    writer.write(decoder.decode(blob))
+            fp.flush()
+            os.fsync(fp.fileno())
+    os.replace(temp_name, filename)
+
+
+@register_class
+class ExampleThing(DirtyTracking):
+    """
+    A prototype (template) object.  Values passed in are kept as given,
+    not copied.
+
+    Passing template= doesn't build another ExampleThing, it returns an
+    ExampleInstance which shares everything with the template except what
+    it changes.  spawn() does the same thing.
+    """
     template_count = 0
     instance_count = 0
 
+    def __new__(cls, template=None, **kwargs):
+        if template is not None:
+            return ExampleInstance(template, **kwargs)
+        return super().__new__(cls)
+
     def __init__(self, template=None, **kwargs):
         super().__init__()
         self.foo = 'pfft'
         if kwargs:
-            [setattr(self, k, copy.deepcopy(v)) for k, v in kwargs.items()]
-        if template:
-            [setattr(self, k, copy.deepcopy(v)) for k, v in template.__dict__.items()]
+            [setattr(self, k, v) for k, v in kwargs.items()]
         if hasattr(self, 'instance_id'):
             if self.instance_id:
                 self.instance_init()
@@ -225,7 +814,7 @@ class ExampleThing(object):
         for k, v in self.__dict__.items():
             if str(type(v)) in ("<class 'function'>", "<class 'method'>"):
                 continue
-            elif str(k) in ('_last_saved', '_md5'):
+            elif str(k) in DirtyTracking.TRANSIENT:
                 continue
             else:
                 tmp_dict[k] = v
@@ -247,11 +836,170 @@ class ExampleThing(object):
         cls_name = '__class__/' + __name__ + '.' + cls.__name__
         if cls_name in data:
             tmp_data = outer_decoder(data[cls_name])
-            return cls(**tmp_data)
+            obj = cls(**tmp_data)
+            obj.mark_clean()
+            return obj
         return data
 
+    def spawn(self, **kwargs):
+        """
+        Creates a copy-on-write instance of this template.
+
+        :param kwargs: Attributes the instance should override, such as instance_id
+        :return: ExampleInstance
+        """
+        return ExampleInstance(self, **kwargs)
+
+    def instance_init(self):
+        pass
+
+    def instance_destructor(self):
+        pass
+
+
+class ExampleInstance(DirtyTracking):
+    """
+    An instance of an ExampleThing template, such as one of the mobs loaded
+    by a zone reset.
+
+    Instead of deep copying everything the template has, an instance only
+    stores the attributes it overrides, and looks anything else up on the
+    template.  Strings, numbers and tuples are simply shared.  Lists, dicts
+    and sets are copied the first time the instance reads them, so changing
+    one in place never touches the template.
+
+    __slots__ keeps each instance down to a handful of pointers, no matter
+    how many attributes its template has.
+
+    Instances are saved with all their template's values filled in, and
+    load back as ordinary ExampleThing objects with an instance_id.
+    """
+    __slots__ = ('_template', '_overrides', 'instance_id', '_last_saved', '_md5', '_dirty', '__weakref__')
+    MUTABLE = (list, dict, set)
+
+    def __init__(self, template, instance_id=None, **kwargs):
+        object.__setattr__(self, '_template', template)
+        object.__setattr__(self, '_overrides', kwargs)
+        object.__setattr__(self, 'instance_id', instance_id)
+        object.__setattr__(self, '_last_saved', None)
+        object.__setattr__(self, '_md5', None)
+        object.__setattr__(self, '_dirty', {'*'})
+        ExampleThing.instance_count += 1
+        self.instance_init()
+
+    def __del__(self):
+        ExampleThing.instance_count -= 1
+
+    def __getattr__(self, name):
+        # Only called when name isn't a slot, or is a slot not yet set.
+        if name in ExampleInstance.__slots__:
+            raise AttributeError(name)
+        overrides = object.__getattribute__(self, '_overrides')
+        if name in overrides:
+            return overrides[name]
+        value = getattr(object.__getattribute__(self, '_template'), name)
+        if isinstance(value, ExampleInstance.MUTABLE):
+            value = copy.deepcopy(value)
+            overrides[name] = value
+        return value
+
+    def __setattr__(self, name, value):
+        if name in ExampleInstance.__slots__:
+            object.__setattr__(self, name, value)
+        else:
+            self._overrides[name] = value
+        if name not in DirtyTracking.TRANSIENT:
+            self.mark_dirty(name)
+
+    def __delattr__(self, name):
+        """
+        Removes an override, so the template's value shows through again.
+        """
+        if name in ExampleInstance.__slots__:
+            object.__delattr__(self, name)
+        else:
+            del self._overrides[name]
+        self.mark_dirty(name)
+
+    @property
+    def template(self):
+        return self._template
+
+    def overrides(self):
+        """
+        Returns the attributes this instance stores itself.
+        """
+        return dict(self._overrides)
+
+    def to_json(self, outer_encoder=None):
+        """
+        Serializes the instance as an ExampleThing, with the template's
+        values and this instance's overrides merged together.
+        """
+        if outer_encoder is None:
+            outer_encoder = json.JSONEncoder.default
+
+        template_data = self._template.to_json(lambda d: d)
+        tmp_dict = dict(next(iter(template_data.values())))
+        tmp_dict.pop('instance_id', None)
+        tmp_dict.update(self._overrides)
+        if self.instance_id is not None:
+            tmp_dict['instance_id'] = self.instance_id
+
+        cls_name = '__class__/' + __name__ + '.' + ExampleThing.__name__
+        return {cls_name: outer_encoder(tmp_dict)}
+
     def instance_init(self):
         pass
 
     def instance_destructor(self):
         pass
+
+
+def benchmark(count: int=2000, rounds: int=5):
+    """
+    Times a round trip of a list of nested game-like objects through each
+    codec, and checks that what comes back matches what went in.
+
+    :param count: Number of objects to serialize
+    :param rounds: Number of times to repeat, the best time is reported
+    :return: dict of codec name to (bytes, pack seconds, unpack seconds)
+    """
+    Stats = namedtuple('Stats', ('hp', 'mana', 'move'))
+    things = []
+    for i in range(count):
+        things.append(ExampleThing(
+            name='a goblin %d' % i,
+            vnum=3000 + i,
+            stats=Stats(i, i * 2, i * 3),
+            flags={'aggressive', 'sentinel'},
+            exits=OrderedDict([('north', 3001), ('south', 2999)]),
+            position=(i, -i, 0),
+            weight=12.5,
+            inventory=[{'vnum': 3010, 'count': 2}, {1: 'one', 2: 'two'}],
+        ))
+    reference = pack(things)
+    results = {}
+    for name, codec in sorted(CODECS.items()):
+        best_pack = best_unpack = None
+        blob = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            blob = codec.encode(things)
+            middle = time.perf_counter()
+            restored = unpack(blob)
+            end = time.perf_counter()
+            if best_pack is None or middle - start < best_pack:
+                best_pack = middle - start
+            if best_unpack is None or end - middle < best_unpack:
+                best_unpack = end - middle
+        if pack(restored) != reference:
+            raise ValueError('Codec %s did not round trip correctly' % name)
+        results[name] = (len(blob), best_pack, best_unpack)
+        print('%-8s %9d bytes  pack %7.1fms  unpack %7.1fms  (%d objects)' % (
+            name, len(blob), best_pack * 1000.0, best_unpack * 1000.0, count))
+    return results
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*- line endings: unix -*-
+__author__ = 'quixadhal'
+
+"""
+This module lets the world be split up by zone across several worker
+processes, so the game can use more than one CPU core.
+
+Each worker owns a set of zones (taken from the vnum ranges in the .zon
+file), and loads the rooms and exits of only those zones from the .wld
+file.  The front process (the normal driver) keeps the TelnetServer and all
+the sockets.  It sends each command to the worker that owns the room the
+player is in, and passes any output the workers produce back to the right
+client.
+
+Workers handle movement and look themselves, as the command interpreter
+doesn't exist yet.  A move within the worker's own zones is reported to
+the front with 'moved', so it knows where to send that player's next
+command.  When something leaves for a zone owned by another worker, the
+worker serializes it and sends it to the front as a handoff (with the
+client_id, if it's a player), and the front notes the player's new room
+and passes it on to whichever worker owns it.
+
+Each worker also runs the Pulse scheduler, but nothing registers zone
+updates with it yet (resets, mobile AI and so on are still to come), so
+for now it only keeps the worker's tick.
+
+Workers are started with the "spawn" method, so each one gets a clean
+interpreter with its own database connections and log writer, rather than
+a forked copy of the front's.
+
+Messages between the front and the workers are tuples sent over a
+multiprocessing Pipe:
+
+    front -> worker     ('command', client_id, vnum, text)
+                        ('enter', client_id or None, vnum, serialized_entity)
+                        ('stop',)
+    worker -> front     ('output', client_id, text)
+                        ('moved', client_id, vnum)
+                        ('handoff', client_id or None, vnum, serialized_entity)
+"""
+
+import os
+import time
+import bisect
+import heapq
+import multiprocessing
+from collections import namedtuple
+import log_system
+import serialization
+
+logger = log_system.init_logging(__name__)
+
+ZONE_FILE = os.path.join('legacy', 'wld', 'tinyworld.zon')
+WORLD_FILE = os.path.join('legacy', 'wld', 'tinyworld.wld')
+START_ROOM = 3001
+RESTART_DELAY = 5.0  # Seconds before a dead worker is started again
+
+ZoneRange = namedtuple('ZoneRange', ('vnum', 'name', 'bottom', 'top'))
+Room = namedtuple('Room', ('vnum', 'name', 'exits'))  # exits is direction name -> vnum
+
+DIRECTIONS = ('north', 'east', 'south', 'west', 'up', 'down')
+
+
+def read_zone_ranges(filename: str=ZONE_FILE):
+    """
+    Reads the zone headers from a DikuMUD .zon file.  Each zone only gives
+    its top room vnum, so a zone covers everything above the previous zone's
+    top, up to and including its own.
+
+    :param filename: The .zon file
+    :return: list of ZoneRange, in vnum order
+    """
+    headers = []
+    with open(filename, encoding='latin-1') as fp:
+        lines = iter(fp)
+        for line in lines:
+            if line.startswith('#'):
+                vnum = int(line[1:].strip())
+                name = next(lines).strip().rstrip('~')
+                top = int(next(lines).split()[0])
+                headers.append((top, vnum, name))
+    headers.sort()
+    zones = []
+    bottom = 0
+    for top, vnum, name in headers:
+        zones.append(ZoneRange(vnum, name, bottom, top))
+        bottom = top + 1
+    return zones
+
+
+def count_rooms(zones: list, filename: str=WORLD_FILE):
+    """
+    Counts how many rooms in a .wld file fall in each zone, so zones can be
+    shared out by how much world they actually hold.
+
+    :param zones: list of ZoneRange
+    :param filename: The .wld file
+    :return: dict of zone vnum to room count
+    """
+    tops = [zone.top for zone in zones]
+    counts = {zone.vnum: 0 for zone in zones}
+    with open(filename, encoding='latin-1') as fp:
+        for line in fp:
+            if line.startswith('#'):
+                try:
+                    room = int(line[1:].strip())
+                except ValueError:
+                    continue
+                i = bisect.bisect_left(tops, room)
+                if i < len(zones):
+                    counts[zones[i].vnum] += 1
+    return counts
+
+
+def _read_string(lines):
+    """
+    Reads a ~ terminated string, which may run over several lines.
+    """
+    text = []
+    for line in lines:
+        line = line.rstrip('\n')
+        if line.endswith('~'):
+            text.append(line[:-1])
+            break
+        text.append(line)
+    return '\n'.join(text)
+
+
+def read_rooms(zones: list, filename: str=WORLD_FILE):
+    """
+    Loads the rooms of the given zones from a DikuMUD .wld file, with just
+    their names and exits.  Rooms in other zones are skipped.
+
+    :param zones: list of ZoneRange
+    :param filename: The .wld file
+    :return: dict of vnum to Room
+    """
+    ranges = sorted((zone.bottom, zone.top) for zone in zones)
+    bottoms = [r[0] for r in ranges]
+    rooms = {}
+    with open(filename, encoding='latin-1') as fp:
+        lines = iter(fp)
+        for line in lines:
+            if not line.startswith('#'):
+                continue
+            try:
+                vnum = int(line[1:].strip())
+            except ValueError:
+                continue
+            name = _read_string(lines)
+            _read_string(lines)  # description
+            next(lines)  # zone, flags, sector
+            exits = {}
+            for line in lines:
+                if line.startswith('S'):
+                    break
+                if line.startswith('D'):
+                    direction = int(line[1:].strip())
+                    _read_string(lines)  # description
+                    _read_string(lines)  # keywords
+                    to_room = int(next(lines).split()[2])
+                    if 0 <= direction < len(DIRECTIONS) and to_room >= 0:
+                        exits[DIRECTIONS[direction]] = to_room
+                elif line.startswith('E'):
+                    _read_string(lines)  # keywords
+                    _read_string(lines)  # description
+            i = bisect.bisect_right(bottoms, vnum) - 1
+            if i >= 0 and vnum <= ranges[i][1]:
+                rooms[vnum] = Room(vnum, name, exits)
+    return rooms
+
+
+def partition_zones(zones: list, workers: int, weights: dict=None):
+    """
+    Shares zones out between workers so each gets about the same amount of
+    world, biggest zones first, each to whichever worker has least so far.
+
+    :param zones: list of ZoneRange
+    :param workers: Number of worker processes
+    :param weights: Optional dict of zone vnum to weight, such as room counts
+    :return: list (one per worker) of lists of ZoneRange
+    """
+    shares = [[] for _ in range(workers)]
+    loads = [(0, i) for i in range(workers)]
+    heapq.heapify(loads)
+    if weights is None:
+        weights = {zone.vnum: zone.top - zone.bottom + 1 for zone in zones}
+    for zone in sorted(zones, key=lambda z: weights.get(z.vnum, 0), reverse=True):
+        load, i = heapq.heappop(loads)
+        shares[i].append(zone)
+        heapq.heappush(loads, (load + max(weights.get(zone.vnum, 0), 1), i))
+    for share in shares:
+        share.sort(key=lambda z: z.bottom)
+    return shares
+
+
+class ShardMap(object):
+    """
+    Finds which worker owns a given room vnum.
+    """
+
+    def __init__(self, shares: list):
+        ranges = []
+        for i, share in enumerate(shares):
+            for zone in share:
+                ranges.append((zone.bottom, zone.top, i))
+        ranges.sort()
+        self._bottoms = [r[0] for r in ranges]
+        self._ranges = ranges
+
+    def owner(self, vnum: int):
+        """
+        :param vnum: Room vnum
+        :return: Worker index, or None if no zone covers the room
+        """
+        i = bisect.bisect_right(self._bottoms, vnum) - 1
+        if i < 0:
+            return None
+        bottom, top, owner = self._ranges[i]
+        if vnum > top:
+            return None
+        return owner
+
+
+class ZoneWorker(object):
+    """
+    The game loop run inside each worker process, for the zones it owns.
+    """
+
+    def __init__(self, index: int, zones: list, conn):
+        self.index = index
+        self.zones = zones
+        self.conn = conn
+        self.rooms = {}  # vnum -> Room, for our zones only
+        self.players = {}  # client_id -> vnum, for players in our rooms
+        self.entities = {}
+        self.done = False
+
+    def send_output(self, client_id: int, text: str):
+        self.conn.send(('output', client_id, text))
+
+    def hand_off(self, vnum: int, entity, client_id: int or None=None):
+        """
+        Sends an entity to the front, to be passed to the owner of vnum.
+
+        :param vnum: The room it's going to
+        :param entity: Anything serialization can pack
+        :param client_id: The player's client, if the entity is a player
+        """
+        self.conn.send(('handoff', client_id, vnum, serialization.pack(entity, 'binary')))
+
+    def show_room(self, client_id: int, vnum: int):
+        room = self.rooms[vnum]
+        exits = ' '.join(d for d in DIRECTIONS if d in room.exits) or 'none'
+        self.send_output(client_id, '%s\n[ Exits: %s ]\n' % (room.name, exits))
+
+    def move_player(self, client_id: int, vnum: int):
+        """
+        Moves a player to another room, telling the front where it went, or
+        handing the player off if the room belongs to another worker.
+        """
+        if vnum in self.rooms:
+            self.players[client_id] = vnum
+            self.conn.send(('moved', client_id, vnum))
+            self.show_room(client_id, vnum)
+        else:
+            self.players.pop(client_id, None)
+            self.hand_off(vnum, {'client_id': client_id}, client_id)
+
+    def handle_command(self, client_id: int, vnum: int, text: str):
+        """
+        Runs a player's command in one of our rooms.  Only movement and
+        look are understood, until the command interpreter hooks in here.
+        """
+        logger.debug('Shard %d: command from %d in room %d: %s', self.index, client_id, vnum, text)
+        if vnum not in self.rooms:
+            logger.error('Shard %d was sent a command for room %d, which it does not own', self.index, vnum)
+            return
+        self.players[client_id] = vnum
+        words = text.split()
+        verb = words[0].lower() if words else ''
+        if not verb or 'look'.startswith(verb):
+            self.show_room(client_id, vnum)
+            return
+        for direction in DIRECTIONS:
+            if direction.startswith(verb):
+                to_room = self.rooms[vnum].exits.get(direction)
+                if to_room is None:
+                    self.send_output(client_id, 'Alas, you cannot go that way.\n')
+                else:
+                    self.move_player(client_id, to_room)
+                return
+
+    def handle_enter(self, client_id: int or None, vnum: int, blob: bytes):
+        """
+        Takes delivery of an entity handed off by another worker.
+        """
+        entity = serialization.unpack(blob)
+        if client_id is None:
+            self.entities.setdefault(vnum, []).append(entity)
+            return
+        if vnum in self.rooms:
+            self.players[client_id] = vnum
+            self.show_room(client_id, vnum)
+        elif vnum != START_ROOM:
+            logger.error('Shard %d: player %d arrived in room %d, which does not exist', self.index, client_id, vnum)
+            self.move_player(client_id, START_ROOM)
+
+    def handle_message(self, message: tuple):
+        kind = message[0]
+        if kind == 'command':
+            self.handle_command(*message[1:])
+        elif kind == 'enter':
+            self.handle_enter(*message[1:])
+        elif kind == 'stop':
+            self.done = True
+        else:
+            logger.warning('Shard %d: unknown message %r', self.index, kind)
+
+    def run(self):
+        from db_system import Session
+        from pulse import Pulse
+        session = Session()
+        pulse = session.query(Pulse).first()
+        self.rooms = read_rooms(self.zones)
+        logger.boot('Shard %d running %d rooms in zones %s', self.index, len(self.rooms),
+                    ', '.join(str(z.vnum) for z in self.zones))
+        while not self.done:
+            top_of_loop = time.time()
+            while self.conn.poll():
+                self.handle_message(self.conn.recv())
+            pulse.perform_updates()
+            nap_time = pulse.width - (time.time() - top_of_loop)
+            # Wake up early if the front has something for us.
+            if nap_time > 0.0:
+                if self.conn.poll(nap_time):
+                    continue
+            else:
+                logger.warn('Shard %d exceeded time slice by %.3f seconds!', self.index, abs(nap_time))
+        logger.boot('Shard %d halted.', self.index)
+
+
+def _worker_main(index: int, zones: list, conn):
+    os.environ['PYKUMUD_SHARD'] = str(index)
+    try:
+        ZoneWorker(index, zones, conn).run()
+    except (KeyboardInterrupt, EOFError):
+        pass
+
+
+class ShardManager(object):
+    """
+    Runs in the front process, starting the workers and routing messages
+    between them and the connected clients.
+    """
+
+    def __init__(self, zones: list, workers: int, weights: dict=None):
+        self.shares = partition_zones(zones, workers, weights)
+        self.map = ShardMap(self.shares)
+        self.rooms = {}
+        self.restarts = 0
+        self._conns = []  # None while that worker is dead
+        self._processes = []
+        self._restart_at = {}  # index of a dead worker -> when to start it again
+        self._context = None
+
+    @property
+    def running(self):
+        return bool(self._conns)
+
+    def start(self):
+        self._context = multiprocessing.get_context('spawn')
+        self._conns = [None] * len(self.shares)
+        self._processes = [None] * len(self.shares)
+        self._restart_at = {}
+        for i in range(len(self.shares)):
+            self._spawn(i)
+        logger.boot('Started %d zone shards.', len(self._processes))
+
+    def _spawn(self, index: int):
+        front_end, worker_end = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(index, self.shares[index], worker_end),
+                                        name='shard-%d' % index, daemon=True)
+        process.start()
+        worker_end.close()
+        self._conns[index] = front_end
+        self._processes[index] = process
+
+    def _lost(self, index: int, err):
+        """
+        Marks a worker dead, after its pipe broke.  Its zones are unreachable
+        until poll() starts it again, RESTART_DELAY seconds from now.
+        """
+        if self._conns[index] is None:
+            return
+        process = self._processes[index]
+        logger.critical('Shard %d died (%s, exit code %s), restarting in %.0f seconds.',
+                        index, err or 'pipe closed', process.exitcode, RESTART_DELAY)
+        self._conns[index].close()
+        self._conns[index] = None
+        if process.is_alive():
+            process.terminate()
+        self._restart_at[index] = time.time() + RESTART_DELAY
+
+    def _send(self, index: int, message: tuple):
+        conn = self._conns[index]
+        if conn is None:
+            return False
+        try:
+            conn.send(message)
+        except (OSError, EOFError) as err:
+            self._lost(index, err)
+            return False
+        return True
+
+    def place(self, client_id: int, vnum: int):
+        """
+        Records which room a client's character is in, for routing.
+        """
+        self.rooms[client_id] = vnum
+
+    def forget(self, client_id: int):
+        self.rooms.pop(client_id, None)
+
+    def route_command(self, client_id: int, text: str):
+        """
+        Sends a command to the worker owning the client's current room.
+
+        :return: False if it couldn't be delivered
+        """
+        if not self._conns:
+            return False
+        vnum = self.rooms.setdefault(client_id, START_ROOM)
+        owner = self.map.owner(vnum)
+        if owner is None:
+            logger.error('No shard owns room %d, dropping command from %d', vnum, client_id)
+            return False
+        if not self._send(owner, ('command', client_id, vnum, text)):
+            logger.warning('Shard %d is down, dropping command from %d', owner, client_id)
+            return False
+        return True
+
+    def poll(self):
+        """
+        Collects output from every worker, forwards any handoffs, and
+        restarts workers which have died.
+
+        :return: list of (client_id, text) to be sent to clients
+        """
+        output = []
+        if not self._conns:
+            return output
+        if self._restart_at:
+            now = time.time()
+            for index, when in list(self._restart_at.items()):
+                if now >= when:
+                    del self._restart_at[index]
+                    self._spawn(index)
+                    self.restarts += 1
+        for index, conn in enumerate(self._conns):
+            if conn is None:
+                continue
+            try:
+                while conn.poll():
+                    message = conn.recv()
+                    kind = message[0]
+                    if kind == 'output':
+                        output.append((message[1], message[2]))
+                    elif kind == 'moved':
+                        self.rooms[message[1]] = message[2]
+                    elif kind == 'handoff':
+                        client_id, vnum, blob = message[1], message[2], message[3]
+                        owner = self.map.owner(vnum)
+                        if owner is None:
+                            logger.error('Handoff to room %d, which no shard owns', vnum)
+                            continue
+                        if client_id is not None:
+                            self.rooms[client_id] = vnum
+                        if not self._send(owner, ('enter', client_id, vnum, blob)):
+                            logger.error('Handoff to room %d lost, shard %d is down', vnum, owner)
+                    else:
+                        logger.warning('Unknown message %r from a shard', kind)
+            except (OSError, EOFError) as err:
+                self._lost(index, err)
+        return output
+
+    def stop(self, timeout: float=5.0):
+        for conn in self._conns:
+            if conn is None:
+                continue
+            try:
+                conn.send(('stop',))
+            except (OSError, EOFError):
+                pass
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        for conn in self._conns:
+            if conn is not None:
+                conn.close()
+        self._conns = []
+        self._processes = []
+        self._restart_at = {}
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*- line endings: unix -*-
+__author__ = 'quixadhal'
+
+"""
+This module publishes a small summary of the game's state once per tick, in
+a memory mapped file, so other threads and processes (the web server, metrics
+scrapers, admin tools) can read it without taking any lock the game uses.
+
+The file starts with a header holding a sequence number and the length of
+the current payload, followed by the payload, which is a dict encoded with
+serialization's binary codec.
+
+Access is controlled with a seqlock.  The writer (only ever the game loop)
+makes the sequence odd, writes the new payload, then makes it even again.
+A reader notes the sequence, copies the payload, and checks the sequence
+again.  If it was odd, or changed while copying, the copy may be torn and the
+reader simply tries again.  Readers never block the writer, and the writer
+never waits for readers.
+
+Who is online, and how many players are in each room, goes in a second
+file (WHO_FILE), as encoding it for a full house costs several milliseconds.
+The game loop only republishes it every WHO_INTERVAL seconds.  Each entry
+holds timestamps rather than durations, so it doesn't go stale in between.
+"""
+
+import os
+import mmap
+import time
+import struct
+import log_system
+import serialization
+
+logger = log_system.init_logging(__name__)
+
+SNAPSHOT_FILE = 'pykumud.snapshot'
+SNAPSHOT_SIZE = 64 * 1024
+WHO_FILE = 'pykumud.who'
+WHO_SIZE = 1024 * 1024
+WHO_INTERVAL = 1.0
+WHO_FIELDS = ('client_id', 'protocol', 'logged_in', 'connect_time', 'last_input_time')
+
+HEADER = struct.Struct('<QI')  # sequence, payload length
+
+
+class SnapshotWriter(object):
+    """
+    The game loop's end of the snapshot file.
+    """
+
+    def __init__(self, filename: str=SNAPSHOT_FILE, size: int=SNAPSHOT_SIZE):
+        self.filename = filename
+        self.size = size
+        self.sequence = 0
+        self.published = 0
+        self.skipped = 0
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size, access=mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self._map, 0, self.sequence, 0)
+
+    def publish(self, data: dict):
+        """
+        Replaces the published snapshot.
+
+        :param data: dict of simple values
+        :return: True if it was written, False if it was too big
+        """
+        payload = serialization.pack(data, 'binary')
+        if HEADER.size + len(payload) > self.size:
+            self.skipped += 1
+            if self.skipped == 1:
+                logger.error('Snapshot of %d bytes does not fit in %s, skipping.', len(payload), self.filename)
+            return False
+        self.sequence += 1
+        struct.pack_into('<Q', self._map, 0, self.sequence)
+        self._map[HEADER.size:HEADER.size + len(payload)] = payload
+        self.sequence += 1
+        HEADER.pack_into(self._map, 0, self.sequence, len(payload))
+        self.published += 1
+        return True
+
+    def close(self):
+        self._map.close()
+
+
+def who_summary(clients, rooms: dict or None=None):
+    """
+    Builds the data for WHO_FILE.
+
+    :param clients: Every connected client, of any server
+    :param rooms: client_id -> room vnum, where known (the shards track it)
+    :return: dict with 'online', a list of WHO_FIELDS values for each
+        client, and 'rooms', vnum -> number of players there
+    """
+    online = [[client.client_id, client.protocol, client.logged_in, client.connect_time, client.last_input_time]
+              for client in clients if client.active]
+    occupancy = {}
+    if rooms:
+        for entry in online:
+            vnum = rooms.get(entry[0])
+            if vnum is not None:
+                occupancy[vnum] = occupancy.get(vnum, 0) + 1
+    return {'online': online, 'rooms': occupancy}
+
+
+class SnapshotReader(object):
+    """
+    Reads the latest snapshot, from any thread or process.
+    """
+
+    def __init__(self, filename: str=SNAPSHOT_FILE):
+        self.filename = filename
+        self._map = None
+        self.retries = 0
+
+    def _open(self):
+        with open(self.filename, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read_bytes(self, attempts: int=100):
+        """
+        Returns the raw payload of the latest consistent snapshot.
+
+        :param attempts: How many torn reads to tolerate before giving up
+        :return: bytes, or None if no snapshot could be read
+        """
+        if self._map is None:
+            try:
+                self._open()
+            except (OSError, ValueError):
+                return None
+        for attempt in range(attempts):
+            before, length = HEADER.unpack_from(self._map, 0)
+            if before & 1 == 0 and before != 0:
+                payload = self._map[HEADER.size:HEADER.size + length]
+                after = HEADER.unpack_from(self._map, 0)[0]
+                if after == before:
+                    return payload
+            self.retries += 1
+            if attempt:
+                time.sleep(0)
+        return None
+
+    def read(self, attempts: int=100):
+        """
+        Returns the latest snapshot.
+
+        :param attempts: How many torn reads to tolerate before giving up
+        :return: dict, or None if no snapshot could be read
+        """
+        payload = self.read_bytes(attempts)
+        if payload is None:
+            return None
+        return serialization.unpack(payload)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
@@ -3,9 +3,11 @@ __author__ = 'quixadhal'
 
 import psutil
 import time
+from collections import deque, namedtuple
 from datetime import datetime
 import log_system
-logger = log_system.init_logging()
+import metrics
+logger = log_system.init_logging(__name__)
 
 
 def sysTimeStamp(timeval):
@@ -21,10 +23,15 @@ def sysTimeStamp(timeval):
 class ResourceSnapshot:
     """
     Creates a snapshot of system information as an object.
+
+    Looking up our own process is the most expensive part of this, so
+    anything taking snapshots repeatedly should pass in a psutil.Process
+    handle it keeps around, as ResourceSampler does.
     """
-    def __init__(self):
+    def __init__(self, proc: psutil.Process=None):
         sysmem = psutil.virtual_memory()
-        proc = psutil.Process()
+        if proc is None:
+            proc = psutil.Process()
         proc_io = proc.io_counters()
         proc_mem = proc.memory_info()
         self._time = time.time()
@@ -166,3 +173,87 @@ class ResourceSnapshot:
         spaces = '\n' + ' ' * 51
         output = spaces.join(results)
         return output
+
+
+ResourceSample = namedtuple('ResourceSample', ('tick', 'snapshot', 'elapsed', 'cpu_percent', 'rss_delta',
+                                               'io_read_rate', 'io_write_rate'))
+
+
+class ResourceSampler:
+    """
+    Takes ResourceSnapshots at regular intervals, normally from a Pulse
+    category, and works out how things changed since the previous one.
+
+    A single psutil.Process handle is reused for every sample, and only the
+    last few samples are kept, so this can run for the life of the driver.
+    """
+    def __init__(self, history: int=120):
+        self._proc = psutil.Process()
+        self._proc.cpu_percent(None)  # The first call only sets the baseline
+        self._tick = 0
+        self.history = deque(maxlen=history)
+        self._rss_gauge = metrics.registry.gauge('pykumud_process_rss_bytes', 'Resident memory of the driver.')
+        self._cpu_gauge = metrics.registry.gauge('pykumud_process_cpu_percent', 'CPU used by the driver.')
+
+    def tick(self):
+        """
+        Counts a main loop iteration, so samples can be matched up with
+        the ticks they were taken on.
+        """
+        self._tick += 1
+
+    def sample(self):
+        """
+        Takes a new snapshot, compares it to the previous one, and adds
+        the result to the history.
+
+        :return: The new sample
+        :rtype: ResourceSample
+        """
+        snapshot = ResourceSnapshot(self._proc)
+        cpu_percent = self._proc.cpu_percent(None)
+        previous = self.history[-1].snapshot if self.history else None
+        if previous is None:
+            elapsed = 0.0
+            rss_delta = 0
+            io_read_rate = 0.0
+            io_write_rate = 0.0
+        else:
+            elapsed = snapshot.current_time(True) - previous.current_time(True)
+            rss_delta = snapshot.process_memory(True) - previous.process_memory(True)
+            if elapsed > 0.0:
+                io_read_rate = (snapshot.process_io() - previous.process_io()) / elapsed
+                io_write_rate = (snapshot.process_io(True) - previous.process_io(True)) / elapsed
+            else:
+                io_read_rate = 0.0
+                io_write_rate = 0.0
+        result = ResourceSample(self._tick, snapshot, elapsed, cpu_percent, rss_delta, io_read_rate, io_write_rate)
+        self.history.append(result)
+        self._rss_gauge.set(snapshot.process_memory(True))
+        self._cpu_gauge.set(cpu_percent)
+        return result
+
+    def rss_growth(self):
+        """
+        Returns the number of bytes the driver's RSS has grown across the
+        whole history we still have.
+
+        :return: bytes
+        """
+        if len(self.history) < 2:
+            return 0
+        return self.history[-1].snapshot.process_memory(True) - self.history[0].snapshot.process_memory(True)
+
+    def log_data(self):
+        """
+        Returns a one line summary of the latest sample, formatted for the
+        logging system.
+
+        :return:
+        """
+        if not self.history:
+            return 'No resource samples taken yet.'
+        last = self.history[-1]
+        return 'Tick %d: %dM RSS (%+dK), %.1f%% CPU, %.1f reads/s, %.1f writes/s' % (
+            last.tick, last.snapshot.process_memory(), last.rss_delta // 1024, last.cpu_percent,
+            last.io_read_rate, last.io_write_rate)
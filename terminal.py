@@ -9,7 +9,7 @@ terminal-like systems
 import re
 import log_system
 
-logger = log_system.init_logging()
+logger = log_system.init_logging(__name__)
 
 from colors import TERMINAL_TYPES, COLOR_MAP, TTYPE_MAP
 
@@ -2,23 +2,198 @@
 __author__ = 'quixadhal'
 
 import os
+import gzip
+import hashlib
+import functools
+import threading
+import time
+from collections import namedtuple
 import cherrypy
 import log_system
+import metrics
+import snapshot
+from db_system import ReadSession
 
-logger = log_system.init_logging()
+logger = log_system.init_logging(__name__)
+
+
+def _release_read_session():
+    """
+    Hands the thread's read-only connection back to the pool once a request
+    has been served, so no web thread sits on an open read transaction.
+    """
+    ReadSession.remove()
+
+cherrypy.tools.read_session = cherrypy.Tool('on_end_request', _release_read_session)
+
+
+# The gzip copy is a different representation, so it gets its own ETag,
+# or caches honouring Vary: Accept-Encoding could mix the two up.
+CachedPage = namedtuple('CachedPage', ('version', 'body', 'gzip_body', 'etag', 'gzip_etag'))
+
+
+class PageCache(object):
+    """
+    Holds pre-rendered copies of the dynamic web pages.
+
+    Pages are built from game state, which only changes when the game loop
+    says so.  The game calls invalidate() whenever something visible on the
+    web has changed, and each page is rendered (and gzipped) at most once per
+    version, no matter how many times it gets requested.
+    """
+
+    def __init__(self, max_entries: int=256):
+        self._version = 0
+        self._pages_version = 0
+        self._pages = {}
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+
+    @property
+    def version(self):
+        return self._version
+
+    def invalidate(self):
+        """
+        Marks every cached page as stale.  This is cheap enough to call from
+        the game loop, as the actual re-rendering happens on the next request.
+        """
+        self._version += 1
+
+    def get(self, key, render):
+        """
+        Returns the CachedPage for key, calling render() to rebuild it only if
+        the game state has changed since it was last built.
+
+        :param key: Unique name for this page (and its arguments)
+        :param render: Callable returning the page body as str or bytes
+        :return: CachedPage
+        """
+        version = self._version
+        entry = self._pages.get(key)
+        if entry is not None and entry.version == version:
+            return entry
+        with self._lock:
+            if self._pages_version != version or len(self._pages) >= self.max_entries:
+                self._pages.clear()
+                self._pages_version = version
+            entry = self._pages.get(key)
+            if entry is None or entry.version != version:
+                body = render()
+                if isinstance(body, str):
+                    body = body.encode('utf-8')
+                digest = hashlib.sha1(body).hexdigest()
+                entry = CachedPage(version, body, gzip.compress(body, 9), '"%s"' % digest, '"%s-gz"' % digest)
+                self._pages[key] = entry
+        return entry
+
+
+page_cache = PageCache()
+
+
+def _etag_matches(etag: str, header: str or None):
+    """
+    Checks an If-None-Match header against our current ETag.
+    """
+    if not header:
+        return False
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == '*' or candidate == etag:
+            return True
+    return False
+
+
+def cached_page(content_type: str='text/html;charset=utf-8'):
+    """
+    Decorator for WebServer pages which are rendered from game state.
+
+    The page body comes from page_cache, a matching If-None-Match gets a 304
+    with no body, and clients that accept gzip get the pre-compressed copy.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            key = func.__name__
+            if args or kwargs:
+                key += repr((args, sorted(kwargs.items())))
+            entry = page_cache.get(key, lambda: func(self, *args, **kwargs))
+            request = cherrypy.request
+            response = cherrypy.response
+            compressed = 'gzip' in request.headers.get('Accept-Encoding', '')
+            etag = entry.gzip_etag if compressed else entry.etag
+            response.headers['ETag'] = etag
+            response.headers['Vary'] = 'Accept-Encoding'
+            response.headers['Cache-Control'] = 'no-cache'
+            if _etag_matches(etag, request.headers.get('If-None-Match')):
+                response.status = 304
+                return b''
+            response.headers['Content-Type'] = content_type
+            if compressed:
+                response.headers['Content-Encoding'] = 'gzip'
+                return entry.gzip_body
+            return entry.body
+        return wrapper
+    return decorator
+
+
+snapshot_reader = snapshot.SnapshotReader()
+who_reader = snapshot.SnapshotReader(snapshot.WHO_FILE)
 
 
 def start_web_server():
     # server_config = os.path.join()
     server = WebServer()
     # cherrypy.config.update(server_config)
-    cherrypy.tree.mount(server, "")  # , config=server_config)
+    app_config = {
+        '/': {
+            'tools.read_session.on': True,
+        },
+    }
+    cherrypy.tree.mount(server, "", config=app_config)
     cherrypy.engine.start()
     logger.boot('Web server started')
 
 
 class WebServer(object):
+    """
+    Pages served to the outside world.
+
+    This runs in CherryPy's worker threads, alongside the game loop.  Any
+    database access done here must go through db_system.ReadSession, never
+    db_system.Session, so web traffic can't hold locks the game needs.
+
+    Pages built from game state should be wrapped with @cached_page, so
+    they are only rendered again after page_cache.invalidate().
+    """
     @cherrypy.expose
+    @cached_page()
     def index(self):
         return "Testing"
 
+    @cherrypy.expose
+    def metrics(self):
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return metrics.registry.render()
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def status(self):
+        """
+        The game's latest per-tick snapshot, plus who is online and where,
+        read without touching game state.
+        """
+        status = snapshot_reader.read() or {}
+        who = who_reader.read()
+        if who is not None:
+            now = time.time()
+            online = []
+            for entry in who['online']:
+                player = dict(zip(snapshot.WHO_FIELDS, entry))
+                player['idle'] = round(now - player['last_input_time'], 1)
+                online.append(player)
+            status['online'] = online
+            status['rooms'] = who['rooms']
+        return status
@@ -0,0 +1,563 @@
+# -*- coding: utf-8 -*- line endings: unix -*-
+__author__ = 'quixadhal'
+
+"""
+This module lets browsers connect to the game over WebSockets (RFC 6455).
+
+It is written in the same style as miniboa: a WebSocketServer owns a
+listening socket and all its clients, and its poll() does one select() over
+all of them, so there's no thread per connection.  It runs in the game loop
+next to the TelnetServer, rather than inside CherryPy, whose thread per
+request model would tie up a worker for as long as each player stayed on.
+
+WebSocketClient has the same interface as miniboa.TelnetClient (send,
+get_command, cmd_ready, active, terminal_type, and so on), so the game
+doesn't need to care how a player is connected.
+
+Output is converted with the 'mxp' terminal type, which turns color tokens
+into MXP's HTML-like tags for the browser to render.  The browser picks a
+framing with the WebSocket subprotocol:
+
+    mxp     each send() becomes one text frame of MXP marked up text
+    json    each send() becomes {"text": "..."} (still MXP marked up),
+            GMCP updates become {"gmcp": "Package", "data": {...}}, and
+            input may be plain text or {"command": "..."}
+
+A client asking for neither gets mxp.
+"""
+
+import json
+import time
+import base64
+import select
+import socket
+import struct
+import hashlib
+import log_system
+import miniboa
+import terminal
+
+logger = log_system.init_logging(__name__)
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+SUBPROTOCOLS = ('mxp', 'json')
+OUTPUT_TYPE = 'mxp'
+MAX_HANDSHAKE = 8192
+HANDSHAKE_TIMEOUT = 10.0
+MAX_MESSAGE = 65536
+RECV_SIZE = 4096
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+MAX_CONTROL_PAYLOAD = 125
+
+
+def accept_key(key: str):
+    """
+    Works out the Sec-WebSocket-Accept value for a client's key.
+    """
+    return base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+
+
+def encode_frame(opcode: int, payload: bytes):
+    """
+    Builds a single, final, unmasked frame, as servers send them.
+    """
+    size = len(payload)
+    if size < 126:
+        header = struct.pack('!BB', 0x80 | opcode, size)
+    elif size < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, size)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, size)
+    return header + payload
+
+
+def _unmask(payload: bytes, mask: bytes):
+    size = len(payload)
+    if not size:
+        return payload
+    key = (mask * (size // 4 + 1))[:size]
+    return (int.from_bytes(payload, 'little') ^ int.from_bytes(key, 'little')).to_bytes(size, 'little')
+
+
+def decode_frames(buffer: bytearray):
+    """
+    Removes every complete frame from the front of buffer.
+
+    :param buffer: Bytes received so far, which is consumed in place
+    :return: (list of (fin, opcode, payload), close code if the client broke
+        the protocol or None).  Frames before a bad one are still returned.
+    """
+    frames = []
+    offset = 0
+    size = len(buffer)
+    error = None
+    while size - offset >= 2:
+        first, second = buffer[offset], buffer[offset + 1]
+        fin, opcode = bool(first & 0x80), first & 0x0F
+        if first & 0x70 or not second & 0x80:
+            # No extensions were agreed, so RSV bits must be clear, and
+            # clients must mask everything they send.
+            error = CLOSE_PROTOCOL_ERROR
+            break
+        length = second & 0x7F
+        if opcode & 0x8 and (not fin or length > MAX_CONTROL_PAYLOAD):
+            # Control frames can't be fragmented, or longer than 125 bytes.
+            error = CLOSE_PROTOCOL_ERROR
+            break
+        pos = offset + 2
+        if length == 126:
+            if size - pos < 2:
+                break
+            length = struct.unpack_from('!H', buffer, pos)[0]
+            pos += 2
+        elif length == 127:
+            if size - pos < 8:
+                break
+            length = struct.unpack_from('!Q', buffer, pos)[0]
+            pos += 8
+        if length > MAX_MESSAGE:
+            error = CLOSE_TOO_BIG
+            break
+        if size - pos < 4 + length:
+            break
+        mask = bytes(buffer[pos:pos + 4])
+        pos += 4
+        frames.append((fin, opcode, _unmask(bytes(buffer[pos:pos + length]), mask)))
+        offset = pos + length
+    if offset:
+        del buffer[:offset]
+    return frames, error
+
+
+class WebSocketClient(object):
+    """
+    A player connected by WebSocket, with the same interface as
+    miniboa.TelnetClient.
+    """
+
+    def __init__(self, sock, addr_tup, term_handler=terminal.color_convert):
+        self.protocol = 'websocket'
+        self.client_id = miniboa.next_client_id()
+        self.active = True
+        self.sock = sock
+        self.fileno = sock.fileno()
+        self.address = addr_tup[0]
+        self.port = addr_tup[1]
+        self.terminal_type = OUTPUT_TYPE
+        self.term_handler = term_handler
+        self.subprotocol = None  # 'mxp' or 'json', once the handshake is done
+        self.handshaken = False
+        self.columns = 80
+        self.rows = 24
+        self.send_pending = False
+        self.send_blocked = False  # The last send() came up short
+        self.send_wire = None
+        self.recv_buffer = bytearray()
+        self.message = None  # Fragments of a message still arriving
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.cmd_ready = False
+        self.command_list = None
+        self.gmcp = False
+        self.gmcp_state = None
+        self.gmcp_supports = None
+        self.gmcp_inbox = None
+        self.logged_in = False
+        self.connect_time = self.last_input_time = time.time()
+
+    # ---[ The TelnetClient interface ]-----------------------------------------
+
+    def get_command(self):
+        cmd = None
+        if self.command_list:
+            cmd = self.command_list.pop(0)
+        self.cmd_ready = bool(self.command_list)
+        return cmd
+
+    def send(self, text: str, ttype: str or None=None):
+        """
+        Sends text to the browser, converting color tokens to MXP.
+        """
+        if not text or not isinstance(text, str) or not self.handshaken:
+            return
+        text = text.replace('\n\r', '\n').replace('\r\n', '\n')
+        text = self.term_handler(text, 'pyku', ttype or self.terminal_type)
+        if self.subprotocol == 'json':
+            text = json.dumps({'text': text})
+        self._queue(OP_TEXT, text.encode('utf-8'))
+
+    def deactivate(self):
+        self.active = False
+
+    def mark_logged_in(self):
+        self.logged_in = True
+
+    def addrport(self):
+        return "{}:{}".format(self.address, self.port)
+
+    def idle(self):
+        return time.time() - self.last_input_time
+
+    def duration(self):
+        return time.time() - self.connect_time
+
+    # The browser does its own echo and line editing, so there's nothing to
+    # negotiate.  Password fields are up to the web page.
+
+    def request_do_sga(self):
+        pass
+
+    def request_will_echo(self):
+        pass
+
+    def request_wont_echo(self):
+        pass
+
+    def password_mode_on(self):
+        pass
+
+    def password_mode_off(self):
+        pass
+
+    def request_naws(self):
+        pass
+
+    def request_terminal_type(self):
+        pass
+
+    def gmcp_update(self, package: str, data: dict):
+        if self.gmcp_state is None:
+            self.gmcp_state = miniboa.GmcpState()
+        self.gmcp_state.update(package, data)
+
+    def gmcp_flush(self):
+        if self.gmcp and self.gmcp_state is not None and self.gmcp_state.pending:
+            for package, fields in self.gmcp_state.changes():
+                self.gmcp_send(package, fields)
+
+    def gmcp_send(self, package: str, data=None):
+        if self.gmcp and self.handshaken:
+            self._queue(OP_TEXT, json.dumps({'gmcp': package, 'data': data}).encode('utf-8'))
+
+    # ---[ WebSocket protocol ]-------------------------------------------------
+
+    def _queue(self, opcode: int, payload: bytes):
+        frame = encode_frame(opcode, payload)
+        if self.send_wire is None:
+            self.send_wire = bytearray(frame)
+        else:
+            self.send_wire += frame
+        self.send_pending = True
+
+    def close(self, code: int=CLOSE_NORMAL, reason: str=''):
+        """
+        Sends a close frame and drops the connection once it has gone out.
+        """
+        if self.handshaken:
+            self._queue(OP_CLOSE, struct.pack('!H', code) + reason.encode('utf-8'))
+            self.socket_send()
+        self.active = False
+
+    def socket_send(self):
+        if self.send_wire:
+            try:
+                sent = self.sock.send(self.send_wire)
+            except (BlockingIOError, InterruptedError):
+                self.send_blocked = True
+                return
+            except socket.error as err:
+                logger.error("SEND error '%s' from %s", err, self.addrport())
+                self.active = False
+                return
+            self.bytes_sent += sent
+            if sent == len(self.send_wire):
+                self.send_wire = None
+                self.send_pending = self.send_blocked = False
+            else:
+                del self.send_wire[:sent]
+                self.send_blocked = True
+        else:
+            self.send_pending = False
+
+    def socket_recv(self):
+        """
+        Reads whatever the browser has sent.
+
+        :return: The number of complete commands received
+        """
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return 0
+        except socket.error as err:
+            logger.error("RECEIVE socket error '%s' from %s", err, self.addrport())
+            raise miniboa.ConnectionLost()
+        if not data:
+            raise miniboa.ConnectionLost()
+        self.bytes_received += len(data)
+        self.recv_buffer += data
+        if not self.handshaken:
+            return self._handshake()
+        return self._read_frames()
+
+    def _handshake(self):
+        end = self.recv_buffer.find(b'\r\n\r\n')
+        if end == -1:
+            if len(self.recv_buffer) > MAX_HANDSHAKE:
+                raise miniboa.ConnectionLost()
+            return 0
+        lines = bytes(self.recv_buffer[:end]).decode('latin-1').split('\r\n')
+        del self.recv_buffer[:end + 4]
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        key = headers.get('sec-websocket-key')
+        if (not lines[0].startswith('GET ') or key is None or
+                'websocket' not in headers.get('upgrade', '').lower()):
+            try:
+                self.sock.send(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+            except OSError:
+                pass  # They're being dropped either way
+            raise miniboa.ConnectionLost()
+        offered = [p.strip() for p in headers.get('sec-websocket-protocol', '').split(',') if p.strip()]
+        chosen = next((p for p in offered if p in SUBPROTOCOLS), None)
+        response = ['HTTP/1.1 101 Switching Protocols', 'Upgrade: websocket', 'Connection: Upgrade',
+                    'Sec-WebSocket-Accept: ' + accept_key(key)]
+        if chosen is not None:
+            response.append('Sec-WebSocket-Protocol: ' + chosen)
+        self.send_wire = bytearray(('\r\n'.join(response) + '\r\n\r\n').encode('latin-1'))
+        self.send_pending = True
+        self.subprotocol = chosen or 'mxp'
+        self.gmcp = self.subprotocol == 'json'
+        self.handshaken = True
+        return self._read_frames() if self.recv_buffer else 0
+
+    def _read_frames(self):
+        frames, error = decode_frames(self.recv_buffer)
+        count = 0
+        for fin, opcode, payload in frames:
+            if opcode == OP_CLOSE:
+                self.close()
+                error = None
+                break
+            elif opcode == OP_PING:
+                self._queue(OP_PONG, payload)
+            elif opcode == OP_PONG:
+                pass
+            elif opcode in (OP_TEXT, OP_BINARY, OP_CONTINUATION):
+                if (opcode == OP_CONTINUATION) != (self.message is not None):
+                    # A continuation with nothing to continue, or a new
+                    # message before the last one was finished.
+                    error = CLOSE_PROTOCOL_ERROR
+                    break
+                if opcode != OP_CONTINUATION:
+                    self.message = bytearray()
+                self.message += payload
+                if len(self.message) > MAX_MESSAGE:
+                    error = CLOSE_TOO_BIG
+                    break
+                if fin:
+                    message = self.message.decode('utf-8', 'replace')
+                    self.message = None
+                    count += self._received(message)
+            else:
+                error = CLOSE_PROTOCOL_ERROR
+                break
+        if error is not None:
+            self.close(error)
+        if count:
+            self.last_input_time = time.time()
+        return count
+
+    def _received(self, message: str):
+        """
+        Files away one complete message from the browser.
+        """
+        if self.subprotocol == 'json' and message.startswith('{'):
+            try:
+                data = json.loads(message)
+            except ValueError:
+                data = None
+            if isinstance(data, dict):
+                if 'gmcp' in data:
+                    if self.gmcp_inbox is None:
+                        self.gmcp_inbox = []
+                    if len(self.gmcp_inbox) < miniboa.GMCP_INBOX_SIZE:
+                        self.gmcp_inbox.append((str(data['gmcp']), data.get('data')))
+                    return 0
+                if 'command' not in data:
+                    return 0
+                message = str(data['command'])
+        # A trailing newline ends the last command, it doesn't start another.
+        lines = [line.strip() for line in message.rstrip('\r\n').split('\n')]
+        if self.command_list is None:
+            self.command_list = []
+        self.command_list.extend(lines)
+        self.cmd_ready = True
+        return len(lines)
+
+
+class WebSocketServer(miniboa.ConnectionLimits):
+    """
+    Polls a listening socket and its WebSocket clients, like miniboa.TelnetServer,
+    with the same per-address and idle limits.
+    """
+
+    def __init__(self, port: int=4480, address: str='', on_connect=miniboa._on_connect,
+                 on_disconnect=miniboa._on_disconnect, max_connections: int=miniboa.MAX_CONNECTIONS,
+                 timeout: float=miniboa.DEFAULT_TIMEOUT, term_handler=terminal.color_convert,
+                 listen_backlog: int=miniboa.LISTEN_BACKLOG, nodelay: bool=miniboa.TCP_NODELAY,
+                 max_per_ip: int=miniboa.MAX_PER_IP, accept_rate: float=miniboa.ACCEPT_RATE,
+                 accept_burst: int=miniboa.ACCEPT_BURST, idle_pre_login: int=miniboa.IDLE_PRE_LOGIN,
+                 idle_logged_in: int=miniboa.IDLE_LOGGED_IN):
+        self.port = port
+        self.address = address
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.max_connections = min(max_connections, miniboa.MAX_CONNECTIONS)
+        self.timeout = timeout
+        self.term_handler = term_handler
+        self.nodelay = nodelay
+        self._init_limits(max_per_ip, accept_rate, accept_burst, idle_pre_login, idle_logged_in)
+
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            server_socket.bind((address, port))
+            server_socket.listen(listen_backlog)
+        except socket.error as err:
+            logger.critical("Unable to create the WebSocket server socket: %s", err)
+            raise
+        server_socket.setblocking(False)
+        self.server_socket = server_socket
+        self.server_fileno = server_socket.fileno()
+        self.clients = {}
+
+        self.connections_accepted = 0
+        self.connections_refused = 0
+        self.commands_received = 0
+        self.closed_bytes_sent = 0
+        self.closed_bytes_received = 0
+        self.flushes = 0
+        self.flush_sends = 0
+
+    def stop(self):
+        for client in self.client_list():
+            client.close(1001, 'Server shutting down')
+            client.sock.close()
+        self.server_socket.close()
+
+    def client_count(self):
+        return len(self.clients)
+
+    def client_list(self):
+        return self.clients.values()
+
+    def flush_gmcp(self):
+        for client in self.clients.values():
+            if client.active:
+                client.gmcp_flush()
+
+    def flush(self):
+        """
+        Writes each client's queued frames with a single send(), once per
+        tick, like miniboa.TelnetServer.flush().
+
+        :return: The number of sends made
+        """
+        sends = 0
+        for client in self.clients.values():
+            if client.active and client.send_pending:
+                client.socket_send()
+                sends += 1
+        self.flushes += 1
+        self.flush_sends += sends
+        return sends
+
+    def _accept(self):
+        try:
+            sock, addr_tup = self.server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error as err:
+            logger.error("ACCEPT socket error '%s'.", err)
+            return
+        if self.client_count() >= self.max_connections:
+            logger.warning("Refusing new WebSocket connection, maximum already in use.")
+            sock.close()
+            self.connections_refused += 1
+            return
+        if not self._accept_allowed(addr_tup[0], time.time()):
+            logger.debug("Refusing new WebSocket connection from %s, too many or too fast.", addr_tup[0])
+            sock.close()
+            self.connections_refused += 1
+            return
+        sock.setblocking(False)
+        if self.nodelay:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError as err:
+                logger.debug("Unable to set TCP_NODELAY: %s", err)
+        client = WebSocketClient(sock, addr_tup, self.term_handler)
+        self.clients[client.fileno] = client
+        self._track(client)
+
+    def poll(self):
+        """
+        Does one non-blocking pass over the listening socket and every
+        client, accepting, reading and writing as needed.
+        """
+        now = time.time()
+        self._check_limits(now)
+        recv_list = [self.server_fileno]
+        send_list = []
+        for client in list(self.clients.values()):
+            if not client.active or (not client.handshaken and now - client.connect_time > HANDSHAKE_TIMEOUT):
+                if client.handshaken:
+                    self.on_disconnect(client)
+                client.sock.close()
+                self.closed_bytes_sent += client.bytes_sent
+                self.closed_bytes_received += client.bytes_received
+                del self.clients[client.fileno]
+                self._untrack(client)
+                continue
+            recv_list.append(client.fileno)
+            if client.send_blocked:
+                send_list.append(client.fileno)
+
+        try:
+            rlist, slist, elist = select.select(recv_list, send_list, [], self.timeout)
+        except select.error as err:
+            logger.critical("SELECT socket error '%s'", err)
+            raise
+
+        for fileno in rlist:
+            if fileno == self.server_fileno:
+                self._accept()
+                continue
+            client = self.clients[fileno]
+            was_handshaken = client.handshaken
+            try:
+                self.commands_received += client.socket_recv()
+            except miniboa.ConnectionLost:
+                client.deactivate()
+                continue
+            if client.handshaken and not was_handshaken:
+                self.connections_accepted += 1
+                self.on_connect(client)
+
+        for fileno in slist:
+            client = self.clients.get(fileno)
+            if client is not None:
+                client.socket_send()